@@ -0,0 +1,263 @@
+#
+#   A batch manifest lists many independent combination jobs, to be run by one invocation of the
+#   program (so interpreter and library start-up, and the file description cache, are shared by all).
+#
+#   The manifest is a JSON file, or a YAML file (ending .yaml or .yml, read if PyYAML is installed).
+#   It contains either a list of jobs, or a dictionary with:
+#       "jobs"              List of jobs (required)
+#       "defaults"          Options applied to every job, unless the job gives its own
+#       "parallel_jobs"     Number of jobs run at once (the -bj command-line option overrides this)
+#   Each job is a dictionary of options named as the long command-line options are, e.g.
+#       {"name": "camera1", "filenames": ["/data/camera1/*.fits"], "sigma": 2.5,
+#        "groupsize": true, "grouptemperature": 5, "outputdirectory": "/data/masters/camera1"}
+#   "name" is optional and only labels the job's output.  File names may be glob patterns.  Relative paths
+#   of inputs and outputs are taken from the manifest's directory.  Options given on the command line along
+#   with the manifest apply to every job that doesn't give its own.  A job (or the defaults) naming a
+#   combination method replaces the method given by the defaults (or the command line), since only one
+#   method may be used.  Option values are checked against the command-line definitions: flags must be
+#   true or false, and other values of the option's type (numbers may also be given as strings).
+#
+import glob
+import json
+import os
+from argparse import Action, Namespace
+from typing import Optional
+
+import MasterMakerExceptions
+from CommandLineArguments import CommandLineArguments
+
+
+class BatchManifest:
+
+    # Keys of the manifest itself
+    JOBS_KEY = "jobs"
+    DEFAULTS_KEY = "defaults"
+    PARALLEL_JOBS_KEY = "parallel_jobs"
+    NAME_KEY = "name"
+
+    # Job options that are paths, resolved relative to the manifest's directory
+    FILE_NAMES_OPTION = "filenames"
+    PATH_OPTIONS = ("output", "outputdirectory")
+
+    # Command-line options that apply to the whole batch, so can't be given per job
+    BATCH_WIDE_OPTIONS = ("gui", "batch", "batchjobs", "daemon", "watch", "watchcount", "watchquiet",
+                          "stagetimes", "stagereport")
+
+    def __init__(self, contents, directory: str):
+        """
+        Initialize the manifest from its contents
+        Exceptions thrown:
+            InvalidManifest     The contents aren't laid out as a manifest
+        :param contents:    Parsed contents of a manifest: list of jobs, or dictionary with the list of jobs
+        :param directory:   Directory relative paths in the jobs are taken from
+        """
+        self._directory = directory
+        if isinstance(contents, list):
+            contents = {self.JOBS_KEY: contents}
+        if not isinstance(contents, dict) or not isinstance(contents.get(self.JOBS_KEY), list):
+            raise MasterMakerExceptions.InvalidManifest("The manifest has no list of jobs")
+        defaults = contents.get(self.DEFAULTS_KEY, {})
+        if not isinstance(defaults, dict):
+            raise MasterMakerExceptions.InvalidManifest("Defaults must be a dictionary of options")
+        self._jobs: [(str, {})] = []
+        for (index, job) in enumerate(contents[self.JOBS_KEY]):
+            if not isinstance(job, dict):
+                raise MasterMakerExceptions.InvalidManifest(f"Job {index + 1} is not a dictionary of options")
+            options = self.merge_options(defaults, job)
+            name = str(options.pop(self.NAME_KEY, f"{index + 1}"))
+            self._jobs.append((name, options))
+        self._parallel_jobs: Optional[int] = contents.get(self.PARALLEL_JOBS_KEY)
+        if self._parallel_jobs is not None \
+                and (not isinstance(self._parallel_jobs, int) or self._parallel_jobs < 1):
+            raise MasterMakerExceptions.InvalidManifest(f"Parallel jobs must be a number > 0, "
+                                                        f"not {self._parallel_jobs}")
+
+    @classmethod
+    def read(cls, path: str) -> "BatchManifest":
+        """
+        Read the manifest at the given path
+        Exceptions thrown:
+            InvalidManifest     The file can't be read or isn't laid out as a manifest
+        :param path:    Path to the JSON or YAML manifest file
+        :return:        The manifest
+        """
+        return BatchManifest(cls.read_file(path), os.path.dirname(os.path.abspath(path)))
+
+    @classmethod
+    def read_file(cls, path: str):
+        """
+        Read the contents of a manifest file, as JSON or (by its extension) YAML
+        Exceptions thrown:
+            InvalidManifest     The file can't be read or parsed
+        :param path:    Path to the manifest file
+        :return:        Parsed contents
+        """
+        is_yaml = path.lower().endswith((".yaml", ".yml"))
+        try:
+            with open(path, "r", encoding="utf-8") as manifest_file:
+                if not is_yaml:
+                    return json.load(manifest_file)
+                # YAML support is optional, so it is only imported when a YAML manifest is used
+                try:
+                    import yaml
+                except ImportError:
+                    raise MasterMakerExceptions.InvalidManifest("YAML manifests need the PyYAML package; "
+                                                                "install it, or use a JSON manifest")
+                try:
+                    return yaml.safe_load(manifest_file)
+                except yaml.YAMLError as exception:
+                    raise MasterMakerExceptions.InvalidManifest(f"Unable to parse \"{path}\": {exception}")
+        except OSError as exception:
+            raise MasterMakerExceptions.InvalidManifest(f"Unable to read \"{path}\": {exception.strerror}")
+        except ValueError as exception:
+            # Includes json.JSONDecodeError
+            raise MasterMakerExceptions.InvalidManifest(f"Unable to parse \"{path}\": {exception}")
+
+    def get_jobs(self) -> [(str, {})]:
+        """
+        Get the jobs, with the manifest's defaults filled in
+        :return:    List of tuples: job name, and dictionary of options
+        """
+        return self._jobs
+
+    def get_parallel_jobs(self) -> Optional[int]:
+        """
+        Get the number of jobs the manifest asks to run at once, if given
+        """
+        return self._parallel_jobs
+
+    def job_arguments(self, batch_args: Namespace, options: {}) -> Namespace:
+        """
+        Make the arguments for one job, as if it had been given on the command line: the options of the
+        batch's own command line, replaced by those the job gives
+        Exceptions thrown:
+            InvalidManifest     The job gives an option that doesn't exist or isn't allowed per job,
+                                an option value of the wrong type, or more than one combination method
+        :param batch_args:  Parsed command-line arguments of the batch invocation
+        :param options:     Options of the job
+        :return:            Arguments for the job
+        """
+        arguments = dict(vars(batch_args))
+        actions = CommandLineArguments.option_actions()
+        job_arguments: {} = {}
+        for (option, value) in options.items():
+            if option not in arguments or option not in actions:
+                raise MasterMakerExceptions.InvalidManifest(f"Unknown option \"{option}\"")
+            if option in self.BATCH_WIDE_OPTIONS:
+                raise MasterMakerExceptions.InvalidManifest(f"Option \"{option}\" applies to the whole batch, "
+                                                            f"so can only be given on the command line")
+            if option == self.FILE_NAMES_OPTION:
+                continue
+            value = self.option_value(option, value, actions[option])
+            if option in self.PATH_OPTIONS and value is not None:
+                value = self.resolve_path(value)
+            job_arguments[option] = value
+        methods = [method for method in CommandLineArguments.METHOD_OPTIONS if self.selects(job_arguments, method)]
+        if len(methods) > 1:
+            raise MasterMakerExceptions.InvalidManifest(f"Only one combination method may be given, "
+                                                        f"not {', '.join(methods)}")
+        arguments = self.merge_options(arguments, job_arguments)
+        arguments[self.FILE_NAMES_OPTION] = self.expand_file_names(options.get(self.FILE_NAMES_OPTION, []))
+        return Namespace(**arguments)
+
+    @classmethod
+    def merge_options(cls, options: {}, overrides: {}) -> {}:
+        """
+        Replace options with the given overrides.  If the overrides select a combination method, the
+        method selected by the options is cleared, as only one may be used.
+        :param options:     Options to be replaced
+        :param overrides:   Options replacing them
+        :return:            Merged dictionary of options
+        """
+        result = dict(options)
+        if any(cls.selects(overrides, method) for method in CommandLineArguments.METHOD_OPTIONS):
+            actions = CommandLineArguments.option_actions()
+            for method in CommandLineArguments.METHOD_OPTIONS:
+                if method in result:
+                    result[method] = actions[method].default
+        result.update(overrides)
+        return result
+
+    @classmethod
+    def selects(cls, options: {}, method: str) -> bool:
+        """
+        Determine if options select the given combination method (a flag that is set, or a parameter that is given)
+        """
+        return options.get(method) not in (None, False)
+
+    @classmethod
+    def option_value(cls, option: str, value, action: Action):
+        """
+        Check an option value from the manifest against the option's command-line definition, converting
+        it to the option's type as the command line would
+        Exceptions thrown:
+            InvalidManifest     The value isn't of the option's type, or isn't one of its choices
+        :param option:      Name of the option
+        :param value:       Value from the manifest
+        :param action:      Command-line definition of the option
+        :return:            Value for the option's argument
+        """
+        if value is None:
+            return action.default
+        if action.nargs == 0:
+            # A flag, such as "groupsize"
+            if not isinstance(value, bool):
+                raise MasterMakerExceptions.InvalidManifest(f"Option \"{option}\" must be true or false, "
+                                                            f"not {json.dumps(value, default=str)}")
+            return value
+        option_type = action.type or str
+        converted = value
+        if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            converted = None
+        elif isinstance(value, str) and option_type is not str:
+            try:
+                converted = option_type(value)
+            except ValueError:
+                converted = None
+        elif option_type is float and isinstance(value, int):
+            converted = float(value)
+        elif not isinstance(value, option_type):
+            converted = None
+        if converted is None:
+            raise MasterMakerExceptions.InvalidManifest(f"Option \"{option}\" must be "
+                                                        f"{cls.type_description(option_type)}, "
+                                                        f"not {json.dumps(value, default=str)}")
+        if action.choices is not None and converted not in action.choices:
+            raise MasterMakerExceptions.InvalidManifest(f"Option \"{option}\" must be one of "
+                                                        f"{', '.join(json.dumps(choice) for choice in action.choices)}"
+                                                        f", not {json.dumps(value, default=str)}")
+        return converted
+
+    @classmethod
+    def type_description(cls, option_type) -> str:
+        if option_type is int:
+            return "a whole number"
+        if option_type is float:
+            return "a number"
+        return "a string"
+
+    def expand_file_names(self, file_names) -> [str]:
+        """
+        Turn a job's input file names (a name or a list of them, which may be glob patterns) into a list of paths.
+        Names that are not patterns are kept even if the file doesn't exist, so validation can report them.
+        :param file_names:  Name, or list of names, from the manifest
+        :return:            List of paths, in sorted order within each pattern
+        """
+        if isinstance(file_names, str):
+            file_names = [file_names]
+        result: [str] = []
+        for name in file_names:
+            path = self.resolve_path(str(name))
+            if any(character in path for character in "*?["):
+                result.extend(sorted(glob.glob(path)))
+            else:
+                result.append(path)
+        return result
+
+    def resolve_path(self, path: str) -> str:
+        """
+        Resolve a path from the manifest, relative to the manifest's directory
+        :param path:    Path as given, with "~" allowed for the home directory
+        :return:        Absolute path
+        """
+        return os.path.join(self._directory, os.path.expanduser(path))
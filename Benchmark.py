@@ -0,0 +1,356 @@
+#
+#   Benchmark of the combination methods, so that changes in speed, memory use or results
+#   show up before a release.
+#
+#   A synthetic stack of bias frames is written to a temporary directory (or a given one): a pedestal
+#   with gaussian read noise, hot pixels (high in every frame, at fixed positions) and cosmic-ray hits
+#   (high values at random positions in each frame).  Every other frame's header gives BZERO as a floating
+#   point value (32768.0), as many cameras write it, so both header styles are read.  Every combination
+#   method is run with each of its engines and the requested precisions, timing it and measuring the peak
+#   memory it allocates.  Each result is compared, as the 16-bit values that would be written to the master
+#   file, with a reference calculated directly from the whole stack in memory by the plain definition of
+#   the method.
+#
+#   Run from the command line, e.g.
+#       python Benchmark.py -f 50 -x 2048 -y 2048 -j results.json
+#   A summary is printed, and the results can be written as JSON for comparison between versions.
+#
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from typing import Callable, Optional
+
+import numpy
+from astropy.io import fits
+from numpy import ma
+from numpy.core.multiarray import ndarray
+
+from ConsoleBuffer import ConsoleBuffer
+from Constants import Constants
+from ImageMath import ImageMath
+from SessionController import SessionController
+
+
+class Benchmark:
+
+    # Sigma clipping can tip a value lying almost exactly at the threshold either way, moving that
+    # pixel's mean by a few ADU.  Where that is expected, up to this fraction of pixels may differ.
+    THRESHOLD_PIXEL_FRACTION = 0.001
+
+    # Synthetic bias frame values, in ADU
+    PEDESTAL = 1000.0
+    HOT_PIXEL_VALUE = 45000.0
+    COSMIC_RAY_VALUE = 60000.0
+
+    def __init__(self, number_frames: int, shape: (int, int),
+                 noise: float = 8.0,
+                 hot_pixel_fraction: float = 0.0005,
+                 cosmic_ray_fraction: float = 0.0002,
+                 seed: int = 0):
+        """
+        Initialize the benchmark with the description of the synthetic stack
+        :param number_frames:           Number of bias frames in the stack
+        :param shape:                   Dimensions of each frame, in numpy (rows, columns) order
+        :param noise:                   Standard deviation of the read noise, in ADU
+        :param hot_pixel_fraction:      Fraction of pixels that are hot (high in every frame)
+        :param cosmic_ray_fraction:     Fraction of pixels in each frame hit by a cosmic ray
+        :param seed:                    Seed for the random numbers, so stacks can be reproduced
+        """
+        assert number_frames > 0
+        self._number_frames = number_frames
+        self._shape = tuple(shape)
+        self._noise = noise
+        self._hot_pixel_fraction = hot_pixel_fraction
+        self._cosmic_ray_fraction = cosmic_ray_fraction
+        self._seed = seed
+
+    def get_configuration(self) -> {}:
+        return {"frames": self._number_frames,
+                "rows": self._shape[0],
+                "columns": self._shape[1],
+                "noise": self._noise,
+                "hot_pixel_fraction": self._hot_pixel_fraction,
+                "cosmic_ray_fraction": self._cosmic_ray_fraction,
+                "seed": self._seed}
+
+    def make_stack(self, directory: str) -> [str]:
+        """
+        Write the synthetic stack of bias frames, as unsigned 16-bit FITS files like a camera produces.
+        Odd-numbered frames have BZERO written as a floating point value, as some cameras do.
+        :param directory:   Directory to receive the files
+        :return:            Paths of the files written
+        """
+        generator = numpy.random.default_rng(self._seed)
+        hot_pixels = generator.random(self._shape) < self._hot_pixel_fraction
+        file_names: [str] = []
+        for index in range(self._number_frames):
+            frame = generator.normal(self.PEDESTAL, self._noise, self._shape)
+            frame[hot_pixels] = self.HOT_PIXEL_VALUE + generator.normal(0, self._noise, numpy.count_nonzero(hot_pixels))
+            frame[generator.random(self._shape) < self._cosmic_ray_fraction] = self.COSMIC_RAY_VALUE
+            header = fits.Header()
+            header["IMAGETYP"] = "Bias Frame"
+            header["EXPTIME"] = 0.0
+            header["CCD-TEMP"] = -10.0
+            header["XBINNING"] = 1
+            header["YBINNING"] = 1
+            file_name = os.path.join(directory, f"bias-{index:04d}.fits")
+            fits.PrimaryHDU(frame.round().clip(0, 65535).astype(numpy.uint16), header=header) \
+                .writeto(file_name, overwrite=True)
+            if index % 2 == 1:
+                bzero = fits.getval(file_name, "BZERO", do_not_scale_image_data=True)
+                fits.setval(file_name, "BZERO", value=float(bzero), do_not_scale_image_data=True)
+            file_names.append(file_name)
+        return file_names
+
+    @classmethod
+    def read_stack(cls, file_names: [str]) -> ndarray:
+        """
+        Read the whole stack into memory, for calculating the reference results
+        :param file_names:  Paths of the files in the stack
+        :return:            3-dimensional array of the frames
+        """
+        return numpy.stack([fits.getdata(file_name).astype(numpy.float64) for file_name in file_names])
+
+    @classmethod
+    def reference_results(cls, stack: ndarray, number_clipped: int, sigma_threshold: float) -> {}:
+        """
+        Calculate the result of each method from the whole stack, by the plain definition of the method
+        :param stack:               3-dimensional array of the frames
+        :param number_clipped:      Number of values dropped from each end for min-max clipping
+        :param sigma_threshold:     Z-score threshold for sigma clipping
+        :return:                    Dictionary of reference results, by method name (or method-engine
+                                    name, for an engine defined differently from the method)
+        """
+        number_frames = stack.shape[0]
+        sorted_stack = numpy.sort(stack, axis=0)
+        number_dropped = min(number_clipped, (number_frames - 1) // 2)
+        min_max = sorted_stack[number_dropped:number_frames - number_dropped].mean(axis=0)
+        mean = stack.mean(axis=0)
+        standard_deviation = stack.std(axis=0)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            z_scores = numpy.abs(stack - mean) / standard_deviation
+        kept = ~(z_scores > sigma_threshold)
+        sigma_clipped = (stack * kept).sum(axis=0) / kept.sum(axis=0)
+        return {"mean": mean,
+                "median": numpy.median(stack, axis=0),
+                "minmax": min_max,
+                "minmax-masked": cls.masked_min_max_reference(stack, number_clipped),
+                "sigma": sigma_clipped}
+
+    @classmethod
+    def masked_min_max_reference(cls, stack: ndarray, number_clipped: int) -> ndarray:
+        """
+        Calculate the min-max clipped mean as the program originally defined it: number_clipped times,
+        every value equal to the column's remaining minimum is dropped, then every value equal to its
+        remaining maximum.  A column emptied that way is the mean given by calc_mm_clipped_mean with one
+        fewer value dropped from each end.
+        :param stack:               3-dimensional array of the frames
+        :param number_clipped:      Number of times the extremes are dropped
+        :return:                    2-dimensional array of the clipped means
+        """
+        masked_stack = ma.MaskedArray(stack)
+        for _ in range(number_clipped):
+            masked_stack = ma.masked_where(masked_stack == masked_stack.min(axis=0), masked_stack)
+            masked_stack = ma.masked_where(masked_stack == masked_stack.max(axis=0), masked_stack)
+        result = masked_stack.mean(axis=0).filled(numpy.nan)
+        eliminated_columns = numpy.nonzero(ma.getmaskarray(masked_stack).all(axis=0))
+        for (row, column) in zip(*eliminated_columns):
+            result[row, column] = round(ImageMath.calc_mm_clipped_mean(stack[:, row, column], number_clipped - 1,
+                                                                       ConsoleBuffer(), SessionController()))
+        return result
+
+    @classmethod
+    def cases(cls, number_clipped: int, sigma_threshold: float,
+              memory_budget_mb: int, reader_workers: int) -> [(str, str, Callable, Optional[tuple])]:
+        """
+        The combinations to be timed: every method with each of its engines
+        :param number_clipped:      Number of values dropped from each end for min-max clipping
+        :param sigma_threshold:     Z-score threshold for sigma clipping
+        :param memory_budget_mb:    Memory budget given to the combination
+        :param reader_workers:      Number of files read concurrently
+        :return:                    For each case: method name, engine name, function of (file names,
+                                    console, session controller, working dtype), and the tolerance:
+                                    the difference (in ADU) allowed from the reference, and the fraction
+                                    of pixels allowed to differ by more.  None if the engine is defined
+                                    differently, so isn't compared.
+        """
+        def mean(engine: int, summation: int):
+            return lambda names, console, controller, dtype: \
+                ImageMath.combine_mean(names, console, controller, memory_budget_mb, reader_workers,
+                                       engine, summation, dtype)
+
+        def min_max(engine: int):
+            return lambda names, console, controller, dtype: \
+                ImageMath.combine_min_max_clip(names, number_clipped, console, controller, memory_budget_mb,
+                                               reader_workers, engine, dtype)
+
+        def sigma(engine: int):
+            return lambda names, console, controller, dtype: \
+                ImageMath.combine_sigma_clip(names, sigma_threshold, console, controller, memory_budget_mb,
+                                             reader_workers, engine, dtype)
+
+        def median(names, console, controller, dtype):
+            return ImageMath.combine_median(names, console, controller, memory_budget_mb, reader_workers, dtype)
+
+        # The masked min-max engine also drops values tied with the extremes, so has a reference of its own.
+        # Streaming sigma clip may treat values lying exactly at the threshold differently.
+        return [("mean", "streaming-simple",
+                 mean(Constants.COMBINE_ENGINE_STREAMING, Constants.SUMMATION_SIMPLE), (0, 0.0)),
+                ("mean", "streaming-compensated",
+                 mean(Constants.COMBINE_ENGINE_STREAMING, Constants.SUMMATION_COMPENSATED), (1, 0.0)),
+                ("mean", "streaming-pairwise",
+                 mean(Constants.COMBINE_ENGINE_STREAMING, Constants.SUMMATION_PAIRWISE), (1, 0.0)),
+                ("mean", "tiled", mean(Constants.COMBINE_ENGINE_TILED, Constants.SUMMATION_SIMPLE), (0, 0.0)),
+                ("median", "tiled", median, (0, 0.0)),
+                ("minmax", "partition", min_max(Constants.MIN_MAX_ENGINE_PARTITION), (1, 0.0)),
+                ("minmax", "masked", min_max(Constants.MIN_MAX_ENGINE_MASKED), (0, 0.0)),
+                ("sigma", "streaming", sigma(Constants.COMBINE_ENGINE_STREAMING),
+                 (1, cls.THRESHOLD_PIXEL_FRACTION)),
+                ("sigma", "tiled", sigma(Constants.COMBINE_ENGINE_TILED), (0, 0.0))]
+
+    @classmethod
+    def run_case(cls, function: Callable, file_names: [str], working_dtype: numpy.dtype,
+                 repeats: int) -> ({}, ndarray):
+        """
+        Time one case, keeping the fastest of the repeats, and measure the peak memory it allocates
+        :param function:        Function running the combination
+        :param file_names:      Paths of the files in the stack
+        :param working_dtype:   Floating point type for the math
+        :param repeats:         Number of times to run the case
+        :return:                Tuple: dictionary of measurements, and the combined result
+        """
+        best_seconds = None
+        best_cpu_seconds = None
+        result = None
+        for _ in range(repeats):
+            wall_start = time.perf_counter()
+            cpu_start = time.process_time()
+            result = function(file_names, ConsoleBuffer(), SessionController(), working_dtype)
+            wall_seconds = time.perf_counter() - wall_start
+            cpu_seconds = time.process_time() - cpu_start
+            if best_seconds is None or wall_seconds < best_seconds:
+                (best_seconds, best_cpu_seconds) = (wall_seconds, cpu_seconds)
+        # Memory is measured in a separate run, since tracing slows the allocations being timed
+        tracemalloc.start()
+        function(file_names, ConsoleBuffer(), SessionController(), working_dtype)
+        (_, peak_bytes) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {"seconds": best_seconds,
+                "cpu_seconds": best_cpu_seconds,
+                "peak_allocated_mb": peak_bytes / (1024 * 1024)}, result
+
+    def run(self, file_names: [str], precisions: [int], number_clipped: int, sigma_threshold: float,
+            memory_budget_mb: int, reader_workers: int, repeats: int,
+            report: Callable[[str], None]) -> [{}]:
+        """
+        Run every case on the given stack, in each of the given precisions
+        :param file_names:          Paths of the files in the stack
+        :param precisions:          Precisions to run in (Constants.PRECISION_xxx)
+        :param number_clipped:      Number of values dropped from each end for min-max clipping
+        :param sigma_threshold:     Z-score threshold for sigma clipping
+        :param memory_budget_mb:    Memory budget given to the combination
+        :param reader_workers:      Number of files read concurrently
+        :param repeats:             Number of times to run each case
+        :param report:              Function called with a line of text describing each result
+        :return:                    List of dictionaries, one per case, of measurements and comparisons
+        """
+        references = self.reference_results(self.read_stack(file_names), number_clipped, sigma_threshold)
+        results: [{}] = []
+        for precision in precisions:
+            working_dtype = ImageMath.working_dtype_for_precision(precision)
+            bits = numpy.dtype(working_dtype).itemsize * 8
+            for (method, engine, function, tolerance) in self.cases(number_clipped, sigma_threshold,
+                                                                      memory_budget_mb, reader_workers):
+                (measurements, combined) = self.run_case(function, file_names, working_dtype, repeats)
+                # Compare the 16-bit values that would be written to the master file
+                reference = references.get(f"{method}-{engine}", references[method])
+                differences = numpy.abs(combined.round() - reference.round())
+                max_difference = float(differences.max())
+                matches = None
+                (allowed_adu, allowed_fraction) = (None, None)
+                if tolerance is not None:
+                    (allowed_adu, allowed_fraction) = tolerance
+                    if bits == 32:
+                        # Single precision may move any method by 1 ADU, and tip sigma clipping thresholds
+                        allowed_adu = max(allowed_adu, 1)
+                        if method == "sigma":
+                            allowed_fraction = max(allowed_fraction, self.THRESHOLD_PIXEL_FRACTION)
+                    fraction_beyond = numpy.count_nonzero(differences > allowed_adu) / differences.size
+                    matches = bool(fraction_beyond <= allowed_fraction)
+                result = {"method": method,
+                          "engine": engine,
+                          "precision_bits": bits,
+                          **measurements,
+                          "max_difference_adu": max_difference,
+                          "differing_pixels": int(numpy.count_nonzero(differences)),
+                          "allowed_difference_adu": allowed_adu,
+                          "allowed_fraction_beyond": allowed_fraction,
+                          "matches_reference": matches}
+                results.append(result)
+                report(f"{method:8s} {engine:22s} {bits:2d}-bit  {result['seconds']:9.3f} s  "
+                       f"{result['cpu_seconds']:9.3f} s cpu  {result['peak_allocated_mb']:9.1f} MB  "
+                       f"max diff {max_difference:g} ADU"
+                       + ("" if result["matches_reference"] is None
+                          else ("  ok" if result["matches_reference"] else "  DIFFERS FROM REFERENCE")))
+        return results
+
+    @classmethod
+    def environment(cls) -> {}:
+        return {"python": sys.version.split()[0],
+                "numpy": numpy.__version__,
+                "platform": platform.platform(),
+                "processors": os.cpu_count()}
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser(description="Time the combination methods on a synthetic stack of bias frames")
+    arg_parser.add_argument("-f", "--frames", type=int, default=25, help="Number of frames in the stack")
+    arg_parser.add_argument("-x", "--width", type=int, default=1024, help="Frame width in pixels")
+    arg_parser.add_argument("-y", "--height", type=int, default=1024, help="Frame height in pixels")
+    arg_parser.add_argument("-ns", "--noise", type=float, default=8.0, help="Read noise, in ADU")
+    arg_parser.add_argument("-hp", "--hotpixels", type=float, default=0.0005, help="Fraction of pixels that are hot")
+    arg_parser.add_argument("-cr", "--cosmicrays", type=float, default=0.0002,
+                            help="Fraction of pixels per frame hit by cosmic rays")
+    arg_parser.add_argument("-sd", "--seed", type=int, default=0, help="Random number seed")
+    arg_parser.add_argument("-mm", "--minmax", type=int, default=2, help="Values clipped from each end for min-max")
+    arg_parser.add_argument("-s", "--sigma", type=float, default=2.0, help="Z-score threshold for sigma clip")
+    arg_parser.add_argument("-mb", "--memorybudget", type=int, default=Constants.DEFAULT_MEMORY_BUDGET_MB,
+                            help="Memory budget, in megabytes, for the combination")
+    arg_parser.add_argument("-rw", "--readerworkers", type=int, default=Constants.DEFAULT_READER_WORKERS,
+                            help="Number of files to read concurrently (0 = choose automatically)")
+    arg_parser.add_argument("-fp", "--floatprecision", type=int, choices=[64, 32], nargs="+", default=[64, 32],
+                            help="Precisions to run the math in")
+    arg_parser.add_argument("-r", "--repeats", type=int, default=3, help="Times each case is run; fastest is kept")
+    arg_parser.add_argument("-d", "--directory", help="Directory for the synthetic files (default: temporary)")
+    arg_parser.add_argument("-j", "--json", metavar="<output path>", help="Write the results to this JSON file")
+    args = arg_parser.parse_args()
+
+    benchmark = Benchmark(args.frames, (args.height, args.width), args.noise, args.hotpixels, args.cosmicrays,
+                          args.seed)
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        stack_directory = args.directory if args.directory is not None else temporary_directory
+        os.makedirs(stack_directory, exist_ok=True)
+        print(f"Writing {args.frames} frames of {args.width} x {args.height} to {stack_directory}")
+        stack_files = benchmark.make_stack(stack_directory)
+        run_precisions = [Constants.PRECISION_SINGLE if bits == 32 else Constants.PRECISION_DOUBLE
+                          for bits in args.floatprecision]
+        benchmark_results = benchmark.run(stack_files, run_precisions, args.minmax, args.sigma,
+                                          args.memorybudget, args.readerworkers, args.repeats, print)
+    if args.json is not None:
+        with open(args.json, "w") as json_file:
+            json.dump({"configuration": {**benchmark.get_configuration(),
+                                         "min_max_clipped": args.minmax,
+                                         "sigma_threshold": args.sigma,
+                                         "memory_budget_mb": args.memorybudget,
+                                         "reader_workers": args.readerworkers,
+                                         "repeats": args.repeats},
+                       "environment": Benchmark.environment(),
+                       "results": benchmark_results}, json_file, indent=2)
+        print(f"Results written to {args.json}")
+    # Exit status shows whether every compared result matched its reference
+    sys.exit(0 if all(result["matches_reference"] is not False for result in benchmark_results) else 1)
@@ -0,0 +1,363 @@
+#
+#   Long-running server that combines files on request, so automation (e.g. acquisition software)
+#   can submit jobs without paying for starting Python and loading numpy and astropy each time.
+#   The file description cache stays open, and group worker processes are kept running, between jobs.
+#
+#   Jobs are submitted over HTTP, on the local machine only (the server listens on 127.0.0.1).
+#   Requests and responses are JSON:
+#       POST /jobs                  Submit a job.  The body is a job as in a batch manifest: options named
+#                                   as the long command-line options, "filenames", and optionally "name".
+#                                   Relative paths are taken from the daemon's working directory.
+#                                   Returns 202 with the job's status, or 400 with the validation messages.
+#       GET /jobs                   Status of all jobs (without their console lines)
+#       GET /jobs/<id>              Status of one job, with its console lines.  "?from=<n>" returns only
+#                                   the lines after the first n, for following a job as it runs.
+#       POST /jobs/<id>/cancel      Cancel a queued or running job (DELETE /jobs/<id> does the same)
+#   A job's status gives its state (queued, running, succeeded, failed, cancelled), and its progress
+#   through the current step as items completed and total.
+#
+#   Options given on the daemon's command line apply to every job that doesn't give its own.
+#
+#   Listening only on 127.0.0.1 doesn't stop a web page in the user's browser sending requests there, and a job
+#   can name any output path, so every request must show the daemon is really being asked:
+#       Authorization: Bearer <token>   The token is made afresh at startup, and written (readable by the user
+#                                       only) to the file named in the startup message
+#       Host                            127.0.0.1:<port> or localhost:<port> (rejecting DNS rebinding)
+#       Content-Type                    application/json, for submitted jobs (browsers can't send it unasked)
+#
+import copy
+import hmac
+import json
+import os
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import urlparse, parse_qs
+
+import MasterMakerExceptions
+from BatchManifest import BatchManifest
+from CommandLineHandler import CommandLineHandler
+from ConsoleCallback import ConsoleCallback
+from DataModel import DataModel
+from DescriptorCache import DescriptorCache
+from GroupProcessPool import GroupProcessPool
+from MultiOsUtil import MultiOsUtil
+from SessionController import SessionController
+
+
+class CombineDaemon:
+
+    # Job states
+    STATE_QUEUED = "queued"
+    STATE_RUNNING = "running"
+    STATE_SUCCEEDED = "succeeded"
+    STATE_FAILED = "failed"
+    STATE_CANCELLED = "cancelled"
+    FINISHED_STATES = (STATE_SUCCEEDED, STATE_FAILED, STATE_CANCELLED)
+
+    # Finished jobs are remembered, for their status to be fetched, up to this many
+    MAXIMUM_FINISHED_JOBS = 1000
+
+    # File, in the user's data directory, that the access token is written to
+    TOKEN_FILE_NAME = "daemon-token"
+    # Host names requests may be addressed to
+    LOCAL_HOST_NAMES = ("127.0.0.1", "localhost")
+
+    def __init__(self, args, data_model: DataModel, parallel_jobs: int = 1):
+        """
+        Initialize the daemon
+        :param args:            Parsed command-line arguments, giving the defaults for every job
+        :param data_model:      Data model with the preferences and command-line options, copied for each job
+        :param parallel_jobs:   Number of jobs run at once
+        """
+        assert parallel_jobs > 0
+        self._args = args
+        self._data_model = data_model
+        self._executor = ThreadPoolExecutor(max_workers=parallel_jobs)
+        self._lock = threading.Lock()
+        self._next_job_id = 1
+        # Status of each job (as returned to clients), and the controller for cancelling it
+        self._jobs: {int: {}} = {}
+        self._controllers: {int: SessionController} = {}
+        # Secret every request must carry, and the port listened on, set when serving starts
+        self._token = secrets.token_urlsafe(32)
+        self._port = 0
+
+    def serve(self, port: int):
+        """
+        Accept requests on the given port of the local machine until interrupted
+        :param port:    TCP port number
+        """
+        # Open the cache and start the workers now, rather than in the first job
+        if self._data_model.get_use_descriptor_cache():
+            cache_message = DescriptorCache.get_shared_cache().get_unavailable_message()
+            if cache_message is not None:
+                # Each job also reports it, in its own console lines
+                print(cache_message)
+        group_workers = self._data_model.get_group_workers()
+        if group_workers != 1:
+            GroupProcessPool.keep_workers(group_workers if group_workers > 0 else os.cpu_count() or 1)
+        server = ThreadingHTTPServer(("127.0.0.1", port), self.make_request_handler_class())
+        self._port = server.server_address[1]
+        token_path = self.write_token_file()
+        print(f"Combine daemon listening on http://127.0.0.1:{self._port}/jobs")
+        if token_path is not None:
+            print(f"Requests need the header \"Authorization: Bearer <token>\", with the token in {token_path}")
+        else:
+            print(f"Requests need the header \"Authorization: Bearer {self._token}\"")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if token_path is not None:
+                self.remove_token_file(token_path)
+            with self._lock:
+                for controller in self._controllers.values():
+                    controller.cancel_thread()
+            self._executor.shutdown(wait=True)
+            GroupProcessPool.shutdown_kept_workers()
+            print("Combine daemon stopped")
+
+    def write_token_file(self) -> Optional[str]:
+        """
+        Write the access token to a file only the user can read, for clients to read it from
+        :return:    Path of the file, or None if it couldn't be written
+        """
+        try:
+            token_path = os.path.join(MultiOsUtil.user_data_directory(), self.TOKEN_FILE_NAME)
+            descriptor = os.open(token_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            # The mode only applies if the file is created; an existing file may have been more open
+            os.chmod(token_path, 0o600)
+            with os.fdopen(descriptor, "w") as token_file:
+                token_file.write(self._token + "\n")
+            return token_path
+        except OSError:
+            return None
+
+    @classmethod
+    def remove_token_file(cls, token_path: str):
+        try:
+            os.remove(token_path)
+        except OSError:
+            pass
+
+    def request_refusal(self, headers, needs_json: bool) -> (int, str):
+        """
+        Determine if a request must be refused because it may not come from a client of the daemon
+        :param headers:     Headers of the request
+        :param needs_json:  The request has a JSON body, so must say so in its Content-Type
+        :return:            Tuple: HTTP status code and message, or None if the request may go ahead
+        """
+        host = headers.get("Host", "").strip().lower()
+        if host not in [f"{name}:{self._port}" for name in self.LOCAL_HOST_NAMES]:
+            return 403, "Requests must be addressed to this machine (Host 127.0.0.1 or localhost, with the port)"
+        (scheme, _, token) = headers.get("Authorization", "").strip().partition(" ")
+        if scheme.lower() != "bearer" or not hmac.compare_digest(token.strip().encode("utf-8"),
+                                                                  self._token.encode("utf-8")):
+            return 401, "Missing or incorrect token (Authorization: Bearer <token>)"
+        if needs_json and headers.get_content_type() != "application/json":
+            return 415, "Content-Type must be application/json"
+        return None
+
+    def submit_job(self, options: {}) -> (bool, {}):
+        """
+        Validate a job and, if it is valid, queue it to be run
+        :param options:     Options of the job, as in a batch manifest job
+        :return:            Tuple: whether the job was accepted, and its status (or the validation messages)
+        """
+        try:
+            manifest = BatchManifest([options], os.getcwd())
+            [(job_name, job_options)] = manifest.get_jobs()
+            job_args = manifest.job_arguments(self._args, job_options)
+        except MasterMakerExceptions.InvalidManifest as exception:
+            return False, {"error": exception.get_message()}
+        lines: [str] = []
+        with self._lock:
+            job_id = self._next_job_id
+            self._next_job_id += 1
+        job = {"id": job_id, "name": job_name,
+               "state": self.STATE_QUEUED, "progress": [0, 0], "lines": lines}
+
+        def add_line(line: str):
+            with self._lock:
+                lines.append(line)
+
+        controller = SessionController()
+        handler = CommandLineHandler(job_args, copy.copy(self._data_model), ConsoleCallback(add_line), controller)
+        try:
+            (valid, output_path, file_names) = handler.validate_inputs()
+        except (TypeError, ValueError) as exception:
+            lines.append(f"Invalid option value: {exception}")
+            valid = False
+        if not valid:
+            return False, {"error": "Invalid job", "lines": lines}
+        with self._lock:
+            self._jobs[job_id] = job
+            self._controllers[job_id] = controller
+            self.forget_old_jobs_locked()
+        self._executor.submit(self.run_job, job, handler, controller, output_path, file_names)
+        return True, self.get_job_status(job_id, include_lines=False)
+
+    def run_job(self, job: {}, handler: CommandLineHandler, controller: SessionController,
+                output_path: str, file_names: [str]):
+        """
+        Run a queued job, recording its outcome in its status
+        :param job:             Status of the job
+        :param handler:         Handler for the job's validated arguments
+        :param controller:      Controller through which the job can be cancelled
+        :param output_path:     Output path if specified
+        :param file_names:      List of input file paths
+        """
+        with self._lock:
+            if controller.thread_cancelled():
+                return
+            job["state"] = self.STATE_RUNNING
+        try:
+            success = handler.process_files(file_names, output_path, handler.get_groups_output_directory())
+            state = self.STATE_SUCCEEDED if success else self.STATE_FAILED
+        except MasterMakerExceptions.SessionCancelled:
+            state = self.STATE_CANCELLED
+        except Exception as exception:
+            with self._lock:
+                job["lines"].append(f"*** ERROR *** {type(exception).__name__}: {exception}")
+            state = self.STATE_FAILED
+        with self._lock:
+            job["state"] = self.STATE_CANCELLED if controller.thread_cancelled() else state
+            job["progress"] = list(controller.get_progress())
+
+    def cancel_job(self, job_id: int) -> bool:
+        """
+        Cancel a job.  A queued job won't run; a running job stops at its next cancellation check.
+        :param job_id:  Id of the job
+        :return:        False if there is no such job
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return False
+            if job["state"] not in self.FINISHED_STATES:
+                self._controllers[job_id].cancel_thread()
+                if job["state"] == self.STATE_QUEUED:
+                    job["state"] = self.STATE_CANCELLED
+            return True
+
+    def get_job_status(self, job_id: int, include_lines: bool = True, first_line: int = 0) -> {}:
+        """
+        Get the status of a job
+        :param job_id:          Id of the job
+        :param include_lines:   Include the job's console lines
+        :param first_line:      Index of the first console line wanted
+        :return:                Dictionary of the job's status, or None if there is no such job
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            result = {key: value for (key, value) in job.items() if key != "lines"}
+            if job["state"] == self.STATE_RUNNING:
+                result["progress"] = list(self._controllers[job_id].get_progress())
+            result["line_count"] = len(job["lines"])
+            if include_lines:
+                result["lines"] = job["lines"][first_line:]
+            return result
+
+    def get_all_job_statuses(self) -> [{}]:
+        with self._lock:
+            job_ids = list(self._jobs.keys())
+        statuses = [self.get_job_status(job_id, include_lines=False) for job_id in job_ids]
+        return [status for status in statuses if status is not None]
+
+    def forget_old_jobs_locked(self):
+        """
+        Forget the oldest finished jobs, if more are remembered than allowed.  Called holding the lock.
+        """
+        finished_ids = [job_id for (job_id, job) in self._jobs.items() if job["state"] in self.FINISHED_STATES]
+        for job_id in finished_ids[:max(0, len(finished_ids) - self.MAXIMUM_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+            del self._controllers[job_id]
+
+    def make_request_handler_class(self):
+        """
+        Make the class that handles the HTTP requests, calling this daemon
+        :return:    Subclass of BaseHTTPRequestHandler
+        """
+        daemon = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if not self.allowed(needs_json=False):
+                    return
+                url = urlparse(self.path)
+                parts = [part for part in url.path.split("/") if part != ""]
+                if parts == ["jobs"]:
+                    self.send_json(200, {"jobs": daemon.get_all_job_statuses()})
+                elif len(parts) == 2 and parts[0] == "jobs" and parts[1].isdigit():
+                    first_line = parse_qs(url.query).get("from", ["0"])[0]
+                    status = daemon.get_job_status(int(parts[1]),
+                                                   first_line=int(first_line) if first_line.isdigit() else 0)
+                    if status is None:
+                        self.send_json(404, {"error": "No such job"})
+                    else:
+                        self.send_json(200, status)
+                else:
+                    self.send_json(404, {"error": "Unknown resource"})
+
+            def do_POST(self):
+                parts = [part for part in urlparse(self.path).path.split("/") if part != ""]
+                if not self.allowed(needs_json=parts == ["jobs"]):
+                    return
+                if parts == ["jobs"]:
+                    try:
+                        length = int(self.headers.get("Content-Length", "0"))
+                        options = json.loads(self.rfile.read(length).decode("utf-8"))
+                    except ValueError as exception:
+                        self.send_json(400, {"error": f"Invalid JSON: {exception}"})
+                        return
+                    (accepted, response) = daemon.submit_job(options)
+                    self.send_json(202 if accepted else 400, response)
+                elif len(parts) == 3 and parts[0] == "jobs" and parts[1].isdigit() and parts[2] == "cancel":
+                    self.cancel(int(parts[1]))
+                else:
+                    self.send_json(404, {"error": "Unknown resource"})
+
+            def do_DELETE(self):
+                if not self.allowed(needs_json=False):
+                    return
+                parts = [part for part in urlparse(self.path).path.split("/") if part != ""]
+                if len(parts) == 2 and parts[0] == "jobs" and parts[1].isdigit():
+                    self.cancel(int(parts[1]))
+                else:
+                    self.send_json(404, {"error": "Unknown resource"})
+
+            def allowed(self, needs_json: bool) -> bool:
+                refusal = daemon.request_refusal(self.headers, needs_json)
+                if refusal is not None:
+                    (status_code, message) = refusal
+                    self.send_json(status_code, {"error": message})
+                    return False
+                return True
+
+            def cancel(self, job_id: int):
+                if daemon.cancel_job(job_id):
+                    self.send_json(200, daemon.get_job_status(job_id, include_lines=False))
+                else:
+                    self.send_json(404, {"error": "No such job"})
+
+            def send_json(self, status_code: int, contents: {}):
+                body = json.dumps(contents).encode("utf-8")
+                self.send_response(status_code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format_string: str, *arguments):
+                # Requests aren't logged; jobs report through their status
+                pass
+
+        return RequestHandler
@@ -13,6 +13,7 @@ from ConsoleCallback import ConsoleCallback
 from DataModel import DataModel
 from FileCombiner import FileCombiner
 from FileDescriptor import FileDescriptor
+from Instrumentation import Instrumentation
 from SessionController import SessionController
 
 
@@ -52,6 +53,7 @@ class CombineThreadWorker(QObject):
         console = ConsoleCallback(self.console_callback)
 
         console.message("Starting session", 0)
+        Instrumentation.reset()
         file_combiner = FileCombiner(self._session_controller, self.file_moved_callback)
 
         # Do actual work
@@ -89,6 +91,8 @@ class CombineThreadWorker(QObject):
         except MasterMakerExceptions.SessionCancelled:
             self.console_callback("*** Session cancelled ***")
 
+        if self._data_model.get_show_stage_times():
+            Instrumentation.output_summary(console)
         self.finished.emit()
 
     #
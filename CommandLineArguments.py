@@ -0,0 +1,112 @@
+#
+#   Definition of the command-line arguments.  The program parses its own command line with these,
+#   and batch manifest jobs and daemon jobs (which give the same options by their long names) are
+#   checked against the same definitions.
+#
+from argparse import Action, ArgumentParser
+
+
+class CommandLineArguments:
+
+    # Options selecting the combination method; only one may be given
+    METHOD_OPTIONS = ("mean", "median", "minmax", "sigma")
+
+    @classmethod
+    def make_parser(cls) -> ArgumentParser:
+        """
+        Make the parser for the program's command-line arguments
+        :return:    Argument parser
+        """
+        arg_parser = ArgumentParser(description="Combine Bias-Frame FITS files into a master bias")
+        arg_parser.add_argument("-g", "--gui", action="store_true",
+                                help="Force GUI interface to open, ignoring other arguments")
+
+        # combination algorithm options - only one may be used
+        method_arg_group = arg_parser.add_mutually_exclusive_group()
+        method_arg_group.add_argument("-m", "--mean", action="store_true",
+                                      help="Combine by simple mean")
+        method_arg_group.add_argument("-n", "--median", action="store_true",
+                                      help="Combine by simple median")
+        method_arg_group.add_argument("-mm", "--minmax", type=int, metavar="<# values to clip>",
+                                      help="Min-max clipping of <n> values, then mean")
+        arg_parser.add_argument("-me", "--minmaxengine", choices=["partition", "masked"],
+                                help="Min-max method: also drop values tied with the extremes (masked, default), "
+                                     "or drop exactly <n> values per end (partition)")
+        method_arg_group.add_argument("-s", "--sigma", type=float, metavar="<z threshold>",
+                                      help="Remove values with z-score greater than threshold, then mean")
+
+        # Grouping
+        arg_parser.add_argument("-gs", "--groupsize", action="store_true",
+                                help="Group files by size (dimensions and binning)")
+        arg_parser.add_argument("-gt", "--grouptemperature", type=float, metavar="<Grouping bandwidth>",
+                                help="Group by temperature with given bandwidth")
+        arg_parser.add_argument("-tb", "--temperaturebin", type=float, metavar="<Bin width>",
+                                help="Round temperatures to multiples of this before grouping them")
+        arg_parser.add_argument("-mg", "--minimumgroup", type=int, metavar="<Minimum group size>",
+                                help="Ignore groups smaller than given size")
+        arg_parser.add_argument("-od", "--outputdirectory", type=str, metavar="Output directory",
+                                help="Directory to receive outputs of grouped combines")
+
+        # File disposition and other options
+        arg_parser.add_argument("-v", "--moveinputs", metavar="<directory>",
+                                help="After successful processing, move input files to directory")
+        arg_parser.add_argument("-t", "--ignoretype", action="store_true",
+                                help="Ignore the internal FITS file type (flat, dark, bias, etc)")
+        arg_parser.add_argument("-o", "--output", metavar="<output path>",
+                                help="Name of output file (default: constructed name at location of inputs)")
+
+        # Resource limits
+        arg_parser.add_argument("-mb", "--memorybudget", type=int, metavar="<megabytes>",
+                                help="Memory the image stack may use while combining; larger stacks are done in bands")
+        arg_parser.add_argument("-rw", "--readerworkers", type=int, metavar="<number of readers>",
+                                help="Number of files to read concurrently (0 = choose automatically)")
+        arg_parser.add_argument("-ce", "--combineengine", choices=["streaming", "tiled"],
+                                help="Combine the whole stack in bands (tiled, default), or frame-at-a-time into "
+                                     "running sums for mean and sigma clip (streaming)")
+        arg_parser.add_argument("-su", "--summation", choices=["simple", "compensated", "pairwise"],
+                                help="How the streaming engine sums frames; "
+                                     "compensated or pairwise for very large stacks")
+        arg_parser.add_argument("-fp", "--floatprecision", type=int, choices=[64, 32],
+                                help="Bits of floating point precision for the combination math "
+                                     "(32 uses half the memory)")
+        arg_parser.add_argument("-of", "--outputformat", choices=["int16", "uint16"],
+                                help="Store the master as signed (default) or unsigned 16-bit integers")
+        arg_parser.add_argument("-gw", "--groupworkers", type=int, metavar="<number of processes>",
+                                help="Number of groups to combine at once in separate processes "
+                                     "(0 = choose automatically)")
+        arg_parser.add_argument("-nc", "--nocache", action="store_true",
+                                help="Don't use the cache of file descriptions; re-read every file header")
+        arg_parser.add_argument("-st", "--stagetimes", action="store_true",
+                                help="Show the time used by each stage of the work, and the peak memory")
+        arg_parser.add_argument("-sr", "--stagereport", metavar="<output path>",
+                                help="Write the time used by each stage of the work, and the peak memory, "
+                                     "to a JSON file")
+
+        # Batch of jobs
+        arg_parser.add_argument("-b", "--batch", metavar="<manifest path>",
+                                help="Run all the jobs listed in a JSON or YAML manifest file")
+        arg_parser.add_argument("-bj", "--batchjobs", type=int, metavar="<number of jobs>",
+                                help="Number of batch (or daemon) jobs to run at once")
+
+        # Watching a directory for frames as they arrive
+        arg_parser.add_argument("-w", "--watch", metavar="<directory>",
+                                help="Watch directory, making masters from bias frames as they arrive")
+        arg_parser.add_argument("-wc", "--watchcount", type=int, metavar="<number of frames>",
+                                help="When watching, make a group's master when it has this many frames")
+        arg_parser.add_argument("-wq", "--watchquiet", type=float, metavar="<seconds>",
+                                help="When watching, make a group's master when no frame has arrived for this long")
+
+        # Daemon accepting jobs over HTTP on the local machine
+        arg_parser.add_argument("-d", "--daemon", type=int, metavar="<port>",
+                                help="Run as a daemon, accepting jobs over HTTP on this port of the local machine")
+
+        arg_parser.add_argument("filenames", nargs="*")
+        return arg_parser
+
+    @classmethod
+    def option_actions(cls) -> {str: Action}:
+        """
+        Get the definition of each command-line option
+        :return:    Dictionary of argparse actions, by option (destination) name
+        """
+        return {action.dest: action for action in cls.make_parser()._actions}
@@ -3,42 +3,240 @@
 #   (i.e. no GUI interface).
 #
 
+import copy
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import MasterMakerExceptions
+from BatchManifest import BatchManifest
+from Console import Console
+from ConsoleBuffer import ConsoleBuffer
 from ConsoleSimplePrint import ConsoleSimplePrint
 from Constants import Constants
 from DataModel import DataModel
+from DirectoryWatcher import DirectoryWatcher
 from FileCombiner import FileCombiner
 from FileDescriptor import FileDescriptor
+from GroupProcessPool import GroupProcessPool
+from Instrumentation import Instrumentation
 from RmFitsUtil import RmFitsUtil
 from SessionController import SessionController
+from SharedUtils import SharedUtils
+from WatchCombiner import WatchCombiner
 
 
 class CommandLineHandler:
 
-    def __init__(self, args, data_model: DataModel):
+    def __init__(self, args, data_model: DataModel, console: Console = None,
+                 session_controller: SessionController = None):
         """
         Initialize this object
-        :param args:        Text arguments given on the unix command line
-        :param data_model:  Data model describing the program options (initialized with defaults)
+        :param args:                Text arguments given on the unix command line
+        :param data_model:          Data model describing the program options (initialized with defaults)
+        :param console:             Console for the session's output (default: print it)
+        :param session_controller:  Controller allowing the session to be cancelled (default: never cancelled)
         """
         self._args = args
         self._data_model: DataModel = data_model
+        self._console: Console = console if console is not None else ConsoleSimplePrint()
+        # A "session controller" is necessary, but has an interesting effect only in the GUI version
+        # and the daemon.  Otherwise we create one but its state never changes so it does nothing
+        self._session_controller = session_controller if session_controller is not None else SessionController()
 
     def execute(self):
         """
         Execute the program with the options specified on the command line, no GUI
         """
+        if self._args.batch is not None:
+            Instrumentation.reset()
+            self.execute_batch()
+            self.output_stage_times()
+            return
+        if self._args.watch is not None:
+            self.execute_watch()
+            return
         valid: bool
         file_names: [str]
         single_output_path: str
         (valid, single_output_path, file_names) = self.validate_inputs()
         if valid:
             groups_output_directory = self._args.outputdirectory
+            Instrumentation.reset()
             if self.process_files(file_names, single_output_path, groups_output_directory):
                 print("Successful completion")
+            self.output_stage_times()
+
+    def output_stage_times(self):
+        """
+        Show, and write to a file, the time and memory used by each stage, if the command line asks for them
+        """
+        if self._data_model.get_show_stage_times():
+            Instrumentation.output_summary(ConsoleSimplePrint())
+        if self._args.stagereport is not None:
+            Instrumentation.write_report(self._args.stagereport)
+
+    # Run all the jobs listed in a batch manifest.  Every job is validated before any is run, so a
+    # mistake in the manifest doesn't leave the batch half done.  Jobs are then run in threads of this
+    # process, sharing the file description cache; when several run at once, each job's output is
+    # held back and shown in one piece when the job finishes.
+
+    def execute_batch(self):
+        """
+        Validate and run the jobs in the batch manifest given on the command line
+        """
+        if len(self._args.filenames) > 0:
+            print("File names can't be given with a batch manifest; list them in the manifest's jobs")
+            return
+        try:
+            manifest = BatchManifest.read(self._args.batch)
+        except MasterMakerExceptions.InvalidManifest as exception:
+            self.error_dialog("Invalid batch manifest", exception.get_message())
+            return
+        parallel_jobs = self._args.batchjobs if self._args.batchjobs is not None \
+            else manifest.get_parallel_jobs() or 1
+        if parallel_jobs < 1:
+            print(f"Number of batch jobs must be > 0, not {parallel_jobs}")
+            return
+
+        # Validate every job, each with its own copy of the data model
+        jobs: [(str, CommandLineHandler, str, [str])] = []
+        all_valid = True
+        for (job_name, options) in manifest.get_jobs():
+            print(f"Job {job_name}:")
+            try:
+                job_args = manifest.job_arguments(self._args, options)
+                job_handler = CommandLineHandler(job_args, copy.copy(self._data_model),
+                                                 ConsoleBuffer() if parallel_jobs > 1 else None)
+                (valid, output_path, file_names) = job_handler.validate_inputs()
+                job_handler.show_held_back_output()
+            except MasterMakerExceptions.InvalidManifest as exception:
+                print(f"   {exception.get_message()}")
+                valid = False
+            except (TypeError, ValueError) as exception:
+                print(f"   Invalid option value: {exception}")
+                valid = False
+            if valid:
+                jobs.append((job_name, job_handler, output_path, file_names))
+            all_valid = all_valid and valid
+        if not all_valid:
+            print("Batch not run: correct the jobs above")
+            return
+
+        # Run the jobs
+        print(f"Running {len(jobs)} jobs, {min(parallel_jobs, len(jobs))} at a time")
+        # Jobs running at once share one set of group worker processes, as in the daemon, so together
+        # they don't start more processes than there are processors and memory for
+        share_workers = parallel_jobs > 1 and len(jobs) > 1
+        if share_workers:
+            GroupProcessPool.keep_workers(self.shared_group_worker_count([job[1] for job in jobs]))
+        output_lock = threading.Lock()
+        try:
+            with ThreadPoolExecutor(max_workers=parallel_jobs) as executor:
+                results = list(executor.map(lambda job: job[1].run_batch_job(job[0], job[2], job[3], output_lock),
+                                            jobs))
+        finally:
+            if share_workers:
+                GroupProcessPool.shutdown_kept_workers()
+        number_succeeded = sum(1 for success in results if success)
+        print(f"Batch complete: {number_succeeded} of {len(jobs)} jobs succeeded")
+
+    @classmethod
+    def shared_group_worker_count(cls, job_handlers: ["CommandLineHandler"]) -> int:
+        """
+        Decide how many group worker processes the batch jobs share: the most any job asks for if they all
+        give a number, otherwise as many as there are processors and memory for at the largest memory budget
+        :param job_handlers:    Handlers of the jobs, whose inputs have been validated
+        :return:                Number of worker processes
+        """
+        data_models = [job_handler._data_model for job_handler in job_handlers]
+        requested_workers = [data_model.get_group_workers() for data_model in data_models]
+        if all(workers > 0 for workers in requested_workers):
+            return max(requested_workers)
+        bytes_per_group = max(data_model.get_memory_budget_mb() for data_model in data_models) * 1024 * 1024
+        return GroupProcessPool.automatic_worker_count(os.cpu_count() or 1, bytes_per_group)
+
+    def run_batch_job(self, job_name: str, output_path: str, file_names: [str], output_lock: threading.Lock) -> bool:
+        """
+        Run one job of a batch, whose arguments have been validated
+        :param job_name:        Name of the job, for its output
+        :param output_path:     Output path if specified
+        :param file_names:      List of input file paths
+        :param output_lock:     Lock held while the job's held-back output is shown
+        :return:                Success indicator
+        """
+        self._console.message(f"Job {job_name}: {len(file_names)} files", 0)
+        success = self.process_files(file_names, output_path, self.get_groups_output_directory())
+        self._console.message(f"Job {job_name} {'complete' if success else 'failed'}", 0)
+        with output_lock:
+            self.show_held_back_output()
+        return success
+
+    def get_groups_output_directory(self) -> str:
+        return self._args.outputdirectory
+
+    def show_held_back_output(self):
+        """
+        Print the output held back for this session, if it is being held back
+        """
+        if isinstance(self._console, ConsoleBuffer):
+            for line in self._console.take_lines():
+                print(line)
+
+    # Watch a directory, making masters from the frames as they arrive, until interrupted.
+    # Frames are always grouped by size (frames of different sizes can't be combined), and by
+    # temperature if requested; masters go to the output directory, which must be given.
+
+    def execute_watch(self):
+        """
+        Validate the options, then watch the directory given on the command line
+        """
+        valid: bool
+        (valid, _, _) = self.validate_inputs(file_names_required=False)
+        watch_directory = self._args.watch
+        output_directory = self._args.outputdirectory
+        frame_count = self._args.watchcount if self._args.watchcount is not None \
+            else Constants.DEFAULT_WATCH_FRAME_COUNT
+        quiet_seconds = self._args.watchquiet if self._args.watchquiet is not None \
+            else Constants.DEFAULT_WATCH_QUIET_SECONDS
+        if len(self._args.filenames) > 0:
+            print("File names can't be given when watching a directory")
+            valid = False
+        if not os.path.isdir(watch_directory):
+            print(f"Directory to watch does not exist: {watch_directory}")
+            valid = False
+        if output_directory is None:
+            print("When watching a directory, the output directory option is mandatory")
+            valid = False
+        elif os.path.abspath(output_directory) == os.path.abspath(watch_directory):
+            print("The output directory can't be the directory being watched")
+            valid = False
+        if frame_count < 0:
+            print(f"Watch frame count must be >= 0, not {frame_count}")
+            valid = False
+        if quiet_seconds <= 0:
+            print(f"Watch quiet time must be > 0, not {quiet_seconds}")
+            valid = False
+        if not valid:
+            return
+        if not SharedUtils.ensure_directory_exists(output_directory):
+            self.error_dialog("Group Directory Missing",
+                              f"The specified output directory \"{output_directory}\""
+                              f" does not exist and could not be created.")
+            return
+        print(f"   Watching {watch_directory}: master made at "
+              f"{str(frame_count) + ' frames or ' if frame_count > 0 else ''}{quiet_seconds:g} seconds without "
+              f"a new frame")
+        self._data_model.set_group_by_size(True)
+        watcher = DirectoryWatcher(watch_directory)
+        try:
+            WatchCombiner(self._data_model, output_directory, frame_count, quiet_seconds,
+                          self._console, self._session_controller).watch(watcher)
+        except KeyboardInterrupt:
+            print("Stopped watching; frames not yet made into masters remain in the directory")
+        finally:
+            watcher.close()
 
     # Make sure the command-line inputs are valid.  Fill in any give parameters into the existing
     # data model (which is already set up with defaults).
@@ -48,13 +246,16 @@ class CommandLineHandler:
     #   -   If a sigma threshold is specified, it is > 0
     #   -   If -gt used, threshold is 0 to 100
     #   -   If -mg used, group size is > 0
+    #   -   If -mb used, memory budget is > 0
+    #   -   If -rw used, number of readers is >= 0
     #   Returns:  validity flag, output path if specified, array of file names
 
-    def validate_inputs(self) -> (bool, [str]):
+    def validate_inputs(self, file_names_required: bool = True) -> (bool, [str]):
         """
         Validate command-line arguments already stored in the object,
         and consolidate them with preferences for any missing settings.
         See the method source for an introductory comment listing all the validations that are done.
+        :param file_names_required:     Input files must be given (not so when watching a directory)
         :return: Tuple, a validity boolean, the output path, and a list of input file paths
         """
         valid = True
@@ -63,92 +264,187 @@ class CommandLineHandler:
         output_path = ""
 
         # File names
-        if len(args.filenames) > 0:
+        if not file_names_required:
+            pass
+        elif len(args.filenames) > 0:
             for file_name in args.filenames:
                 if os.path.isfile(file_name):
                     # This file is OK, we're good here
                     pass
                 else:
-                    print(f"File does not exist: {file_name}")
+                    self._console.output_message(f"File does not exist: {file_name}")
                     valid = False
             file_names = args.filenames
         else:
-            print("No file names given")
+            self._console.output_message("No file names given")
             valid = False
 
         # Master frame combination algorithm and parameters
         if args.mean:
-            print(f"   Setting MEAN combination")
+            self._console.output_message(f"   Setting MEAN combination")
             self._data_model.set_master_combine_method(Constants.COMBINE_MEAN)
         elif args.median:
-            print(f"   Setting MEDIAN combination")
+            self._console.output_message(f"   Setting MEDIAN combination")
             self._data_model.set_master_combine_method(Constants.COMBINE_MEDIAN)
         elif args.minmax is not None:
             self._data_model.set_master_combine_method(Constants.COMBINE_MINMAX)
             if args.minmax >= 1:
-                print(f"   Setting MIN-MAX combination, clipping {args.minmax} extremes")
+                self._console.output_message(f"   Setting MIN-MAX combination, clipping {args.minmax} extremes")
                 self._data_model.set_min_max_number_clipped_per_end(args.minmax)
             else:
-                print(f"Min-Max clipping argument must be > 0, not {args.minmax}")
+                self._console.output_message(f"Min-Max clipping argument must be > 0, not {args.minmax}")
                 valid = False
         elif args.sigma is not None:
             self._data_model.set_master_combine_method(Constants.COMBINE_SIGMA_CLIP)
             if args.sigma > 0:
-                print(f"   Setting SIGMA combination, z-threshold = {args.sigma}")
+                self._console.output_message(f"   Setting SIGMA combination, z-threshold = {args.sigma}")
                 self._data_model.set_sigma_clip_threshold(args.sigma)
             else:
-                print(f"Sigma clipping threshold must be > 0, not {args.sigma}")
+                self._console.output_message(f"Sigma clipping threshold must be > 0, not {args.sigma}")
                 valid = False
 
         # Insist on same file type in all files?
         if args.ignoretype:
-            print(f"   Ignoring file types")
+            self._console.output_message(f"   Ignoring file types")
             self._data_model.set_ignore_file_type(True)
 
         # What to do with input files after a successful run
         if args.moveinputs is not None:
             self._data_model.set_input_file_disposition(Constants.INPUT_DISPOSITION_SUBFOLDER)
             self._data_model.set_disposition_subfolder_name(args.moveinputs)
-            print(f"   After processing move files to {args.moveinputs}")
+            self._console.output_message(f"   After processing move files to {args.moveinputs}")
 
         # Where should output files go?
         if args.output is not None:
-            print(f"   Output path: {args.output}")
+            self._console.output_message(f"   Output path: {args.output}")
             output_path = args.output
 
         # Grouping   gs   gt <threshold>  mg <minimum>
         #   -   If -gt used, threshold is 0 to 100
         #   -   If -mg used, group size is > 0
         if args.groupsize:
-            print("   Group files by size")
+            self._console.output_message("   Group files by size")
             self._data_model.set_group_by_size(True)
         if args.grouptemperature is not None:
             self._data_model.set_group_by_temperature(True)
             bandwidth = float(args.grouptemperature)
             if 0.1 <= bandwidth <= 50:
-                print(f"   Group files by temperature with bandwidth {bandwidth}")
+                self._console.output_message(f"   Group files by temperature with bandwidth {bandwidth}")
                 self._data_model.set_temperature_group_bandwidth(bandwidth)
             else:
-                print("-gt bandwidth must be between 0.1 and 50")
+                self._console.output_message("-gt bandwidth must be between 0.1 and 50")
+                valid = False
+        if args.temperaturebin is not None:
+            if 0 <= args.temperaturebin <= 50:
+                self._console.output_message(f"   Round temperatures to multiples of {args.temperaturebin} "
+                                             f"before grouping")
+                self._data_model.set_temperature_bin_width(args.temperaturebin)
+            else:
+                self._console.output_message("-tb bin width must be between 0 and 50")
                 valid = False
         if args.minimumgroup is not None:
             self._data_model.set_ignore_groups_fewer_than(True)
             minimum_size = int(args.minimumgroup)
             if minimum_size > 0:
-                print(f"   Ignore groups smaller than {minimum_size}")
+                self._console.output_message(f"   Ignore groups smaller than {minimum_size}")
                 self._data_model.set_minimum_group_size(minimum_size)
             else:
-                print(f"   Minimum group size must be > 0, not {minimum_size}")
+                self._console.output_message(f"   Minimum group size must be > 0, not {minimum_size}")
+                valid = False
+
+        # Memory budget for the combination math
+        if args.memorybudget is not None:
+            if args.memorybudget > 0:
+                self._console.output_message(f"   Memory budget {args.memorybudget} MB")
+                self._data_model.set_memory_budget_mb(args.memorybudget)
+            else:
+                self._console.output_message(f"Memory budget must be > 0, not {args.memorybudget}")
+                valid = False
+
+        # How many files to read at once
+        if args.readerworkers is not None:
+            if args.readerworkers >= 0:
+                self._console.output_message(f"   Read {self.count_description(args.readerworkers, 'file')} "
+                                             f"concurrently")
+                self._data_model.set_reader_workers(args.readerworkers)
+            else:
+                self._console.output_message(f"Number of reader workers must be >= 0, not {args.readerworkers}")
                 valid = False
 
+        # Which min-max clipping engine
+        if args.minmaxengine is not None:
+            self._console.output_message(f"   Min-max clipping engine: {args.minmaxengine}")
+            self._data_model.set_min_max_engine(Constants.MIN_MAX_ENGINE_PARTITION
+                                                if args.minmaxengine == "partition"
+                                                else Constants.MIN_MAX_ENGINE_MASKED)
+
+        # Streaming or tiled combination, and how streaming sums are kept
+        if args.combineengine is not None:
+            self._console.output_message(f"   Combination engine: {args.combineengine}")
+            self._data_model.set_combine_engine(Constants.COMBINE_ENGINE_STREAMING
+                                                if args.combineengine == "streaming"
+                                                else Constants.COMBINE_ENGINE_TILED)
+        if args.summation is not None:
+            self._console.output_message(f"   Summation: {args.summation}")
+            self._data_model.set_summation({"simple": Constants.SUMMATION_SIMPLE,
+                                            "compensated": Constants.SUMMATION_COMPENSATED,
+                                            "pairwise": Constants.SUMMATION_PAIRWISE}[args.summation])
+
+        # Single or double precision math
+        if args.floatprecision is not None:
+            self._console.output_message(f"   {args.floatprecision}-bit floating point math")
+            self._data_model.set_precision(Constants.PRECISION_SINGLE if args.floatprecision == 32
+                                           else Constants.PRECISION_DOUBLE)
+
+        # How the master's values are stored
+        if args.outputformat is not None:
+            self._console.output_message(f"   Output values stored as {args.outputformat}")
+            self._data_model.set_output_format(Constants.OUTPUT_FORMAT_UNSIGNED_16 if args.outputformat == "uint16"
+                                               else Constants.OUTPUT_FORMAT_SIGNED_16)
+
+        # How many groups to combine at once
+        if args.groupworkers is not None:
+            if args.groupworkers >= 0:
+                self._console.output_message(f"   Combine {self.count_description(args.groupworkers, 'group')} "
+                                             f"concurrently")
+                self._data_model.set_group_workers(args.groupworkers)
+            else:
+                self._console.output_message(f"Number of group workers must be >= 0, not {args.groupworkers}")
+                valid = False
+
+        # Don't use the descriptor cache?
+        if args.nocache:
+            self._console.output_message("   Not using file description cache")
+            self._data_model.set_use_descriptor_cache(False)
+
+        # Report time and memory used by each stage of the work
+        if args.stagetimes:
+            self._data_model.set_show_stage_times(True)
+        if args.stagereport is not None:
+            self._console.output_message(f"   Writing time by stage, and peak memory, to {args.stagereport}")
+
         # If any of the grouping options are in use, then the output directory is mandatory
         if self._data_model.get_group_by_temperature() or self._data_model.get_group_by_size():
             if args.outputdirectory is None:
-                print("If any of the group-by options are used, then the output directory option is mandatory")
+                self._console.output_message("If any of the group-by options are used, "
+                                             "then the output directory option is mandatory")
                 valid = False
 
         return valid, output_path, file_names
 
+    # Describe a number of workers for the console, e.g. "1 file", "4 groups", "automatic number of files"
+    @classmethod
+    def count_description(cls, count: int, noun: str) -> str:
+        """
+        Describe a worker count option for the console
+        :param count:   Number given with the option; 0 means chosen automatically
+        :param noun:    What is counted, singular
+        :return:        Description, e.g. "1 file", "4 files", or "automatic number of files"
+        """
+        if count == 0:
+            return f"automatic number of {noun}s"
+        return f"{count} {noun}" if count == 1 else f"{count} {noun}s"
+
     #   The main processing method that combines the files using the selected algorithm
 
     def process_files(self, file_names: [str],
@@ -162,22 +458,26 @@ class CommandLineHandler:
         :return:                            Success indicator
         """
         success = True
-        file_descriptors = RmFitsUtil.make_file_descriptions(file_names)
+        cache = self._data_model.get_descriptor_cache()
+        if cache is not None and cache.get_unavailable_message() is not None:
+            self._console.output_message(cache.get_unavailable_message())
+        file_descriptors = RmFitsUtil.make_file_descriptions(file_names, self._data_model.get_reader_workers(),
+                                                             self._session_controller, cache=cache)
         # check types are all bias
         if self._data_model.get_ignore_file_type() \
                 or FileCombiner.all_of_type(file_descriptors, FileDescriptor.FILE_TYPE_BIAS):
             output_file_path = self.make_output_path(output_path, file_descriptors)
-            self.run_combination_session(file_descriptors, output_file_path, groups_output_directory)
+            success = self.run_combination_session(file_descriptors, output_file_path, groups_output_directory)
         else:
-            print("Files are not all Bias files.  (Use -t option to suppress this check.)")
+            self._console.output_message("Files are not all Bias files.  (Use -t option to suppress this check.)")
             success = False
         return success
 
     def run_combination_session(self, descriptors: [FileDescriptor],
                                 output_path: str,
-                                output_directory: str):
+                                output_directory: str) -> bool:
         """
-        Create a console output object.  This is passed in to the various math routines
+        Use the console output object.  This is passed in to the various math routines
         to allow them to output progress.  We use this indirect method of getting progress
         so that it can go to the console window in this case, but the same worker code can send
         progress lines to the standard system output when being run from the command line
@@ -185,13 +485,11 @@ class CommandLineHandler:
         :param descriptors:         File descriptors of all input files to be processed
         :param output_path:         Path for single combined output file
         :param output_directory:    Path for output directory if grouping is in use
+        :return:                    Success indicator (False if an error was reported)
         """
-        console = ConsoleSimplePrint()
+        console = self._console
         console.message("Starting session", 0)
-        # A "session controller" is necessary, but has an interesting effect only in the GUI version.
-        # In our command-line case we'll create it but its state will never change so it does nothing
-        dummy_session_controller = SessionController()
-        file_combiner = FileCombiner(dummy_session_controller, self.file_moved_callback)
+        file_combiner = FileCombiner(self._session_controller, self.file_moved_callback)
 
         # Do the file combination - select method depending on whether we are processing by groups
         try:
@@ -208,23 +506,29 @@ class CommandLineHandler:
                                                               console)
         except FileNotFoundError as exception:
             self.error_dialog("File not found", f"File \"{exception.filename}\" not found or not readable")
+            return False
         except MasterMakerExceptions.NoGroupOutputDirectory as exception:
             self.error_dialog("Group Directory Missing",
                               f"The specified output directory \"{exception.get_directory_name()}\""
                               f" does not exist and could not be created.")
+            return False
         except MasterMakerExceptions.NotAllBiasFrames:
             self.error_dialog("The selected files are not all Bias Frames",
                               "If you know the files are bias frames, they may not have proper FITS data "
                               "internally. Check the \"Ignore FITS file type\" box to proceed anyway.")
+            return False
         except MasterMakerExceptions.IncompatibleSizes:
             self.error_dialog("The selected files can't be combined",
                               "To be combined into a master file, the files must have identical X and Y "
                               "dimensions, and identical Binning values.")
+            return False
         except PermissionError as exception:
             self.error_dialog("Unable to write file",
                               f"The specified output file, "
                               f"\"{exception.filename}\","
                               f" cannot be written or replaced: \"permission error\"")
+            return False
+        return True
 
     # Make output file name.
     # If file name is specified on command line, use that.
@@ -315,4 +619,4 @@ class CommandLineHandler:
         :param short_message:   Brief form of message
         :param long_message:    More detail if available
         """
-        print("*** ERROR *** " + short_message + ":\n   " + long_message)
+        self._console.output_message("*** ERROR *** " + short_message + ":\n   " + long_message)
@@ -70,6 +70,22 @@ class Console:
         """
         assert len(self._message_level_stack) == 0
 
+    #   Return the current indentation level
+    def get_message_level(self) -> int:
+        """
+        Return the current indentation level, e.g. so another console can continue at the same level
+        :return:        Integer indentation level
+        """
+        return self._message_level
+
+    #   Set the indentation level, e.g. to continue at the level another console had reached
+    def set_message_level(self, level: int):
+        """
+        Set the current indentation level, e.g. to continue at the level another console had reached
+        :param level:   Integer indentation level
+        """
+        self._message_level = level
+
     #   Return the size of the stack, to help users track mismatched push/pop
     def get_stack_size(self):
         """
@@ -0,0 +1,32 @@
+from Console import Console
+
+
+#
+#   A console handler that saves its output lines rather than displaying them.
+#   Used when work is done somewhere its output can't be displayed directly (such as in a
+#   separate process), or where output must be held back so that it can be displayed in order
+#   with output from other work.  The saved lines, already formatted with time and indentation,
+#   are later passed to the output_message method of the real console.
+#
+class ConsoleBuffer(Console):
+
+    def __init__(self, initial_level: int = 0):
+        """
+        Initialize this object with an empty buffer
+        :param initial_level:   Indentation level to start at, so saved lines line up with the real console
+        """
+        Console.__init__(self)
+        self.set_message_level(initial_level)
+        self._lines: [str] = []
+
+    def output_message(self, message: str):
+        self._lines.append(message)
+
+    def take_lines(self) -> [str]:
+        """
+        Get the lines saved so far, and empty the buffer
+        :return:    List of formatted lines, in the order they were produced
+        """
+        result = self._lines
+        self._lines = []
+        return result
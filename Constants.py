@@ -10,6 +10,27 @@ class Constants:
     COMBINE_MINMAX = -6233  # Remove min and max values then mean
     COMBINE_SIGMA_CLIP = -6345  # Remove values outside a given sigma then mean
 
+    # How is min-max clipping computed?
+    MIN_MAX_ENGINE_PARTITION = -5417  # Drop exactly n lowest and n highest values using a partial sort
+    MIN_MAX_ENGINE_MASKED = -5423  # Original masked-array method: drop every value tied with a min or max
+
+    # How are the frames fed to the combination math?
+    COMBINE_ENGINE_STREAMING = -5531  # One frame at a time into running sums, where the method allows
+    COMBINE_ENGINE_TILED = -5537  # The whole stack, one band of rows at a time
+
+    # How are frames summed by the streaming engine?
+    SUMMATION_SIMPLE = -5641  # Add into a single sum (identical to numpy.mean on the stack)
+    SUMMATION_COMPENSATED = -5647  # Neumaier compensated summation
+    SUMMATION_PAIRWISE = -5651  # Balanced tree of partial sums
+
+    # What floating point precision is the combination math done in?
+    PRECISION_DOUBLE = -5761  # float64
+    PRECISION_SINGLE = -5767  # float32: half the memory; see ImageMath for the bound on differences
+
+    # How are the master's pixel values stored?
+    OUTPUT_FORMAT_SIGNED_16 = -5881  # 16-bit signed integers (-32768 to 32767)
+    OUTPUT_FORMAT_UNSIGNED_16 = -5887  # 16-bit unsigned integers (0 to 65535), stored with BZERO = 32768
+
     # What do we do with the raw input files after files are combined to a master flat?
     INPUT_DISPOSITION_NOTHING = -8357  # Do nothing to the files
     INPUT_DISPOSITION_SUBFOLDER = -8361  # Move to a given named subfolder
@@ -25,6 +46,26 @@ class Constants:
 
     CONSOLE_INDENTATION_SIZE = 5
 
+    # Megabytes of memory the image stack may occupy while it is being combined.  Larger stacks
+    # are processed one band of rows at a time so they stay within this budget.
+    DEFAULT_MEMORY_BUDGET_MB = 1024
+
+    # How many files are read concurrently.  Zero means choose automatically from the number of processors.
+    DEFAULT_READER_WORKERS = 0
+
+    # How many groups are combined at once, in separate processes.  Zero means choose automatically
+    # from the number of processors and the memory available; one means one group at a time.
+    DEFAULT_GROUP_WORKERS = 0
+
+    # Width of the bins temperatures are rounded into before being clustered.  Zero means no binning,
+    # which suits cameras that report temperatures to a fixed precision.
+    DEFAULT_TEMPERATURE_BIN_WIDTH = 0.0
+
+    # When watching a directory, a group's master is made once the group has this many frames
+    # (zero means no limit), or once no frame has been added to it for this many seconds.
+    DEFAULT_WATCH_FRAME_COUNT = 0
+    DEFAULT_WATCH_QUIET_SECONDS = 300.0
+
     @classmethod
     def combine_method_string(cls, method: int) -> str:
         """
@@ -44,6 +85,47 @@ class Constants:
             print(f"combine_method_string({method}): Invalid method")
             assert False
 
+    @classmethod
+    def min_max_engine_string(cls, engine: int) -> str:
+        """
+        Translate min-max engine code to meaningful string
+        :param engine:  Integer code specifying min-max clipping engine
+        :return:        String suitable for display
+        """
+        if engine == cls.MIN_MAX_ENGINE_PARTITION:
+            return "partition"
+        else:
+            assert engine == cls.MIN_MAX_ENGINE_MASKED
+            return "masked"
+
+    @classmethod
+    def summation_string(cls, summation: int) -> str:
+        """
+        Translate summation method code to meaningful string
+        :param summation:   Integer code specifying summation method
+        :return:            String suitable for display
+        """
+        if summation == cls.SUMMATION_SIMPLE:
+            return "simple"
+        elif summation == cls.SUMMATION_COMPENSATED:
+            return "compensated"
+        else:
+            assert summation == cls.SUMMATION_PAIRWISE
+            return "pairwise"
+
+    @classmethod
+    def output_format_string(cls, output_format: int) -> str:
+        """
+        Translate output format code to meaningful string
+        :param output_format:   Integer code specifying how the master's values are stored
+        :return:                String suitable for display
+        """
+        if output_format == cls.OUTPUT_FORMAT_SIGNED_16:
+            return "int16"
+        else:
+            assert output_format == cls.OUTPUT_FORMAT_UNSIGNED_16
+            return "uint16"
+
     @classmethod
     def disposition_string(cls, value: int) -> str:
         """
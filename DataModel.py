@@ -7,7 +7,10 @@
 #   modified by command-line flags when using the command line.  It is initialized when
 #   created from values in the Preferences object
 #
+from typing import Optional
+
 from Constants import Constants
+from DescriptorCache import DescriptorCache
 from Preferences import Preferences
 
 
@@ -28,9 +31,20 @@ class DataModel:
         self._group_by_size: bool = preferences.get_group_by_size()
         self._group_by_temperature: bool = preferences.get_group_by_temperature()
         self._temperature_group_bandwidth: float = preferences.get_temperature_group_bandwidth()
+        self._temperature_bin_width: float = preferences.get_temperature_bin_width()
         self._ignore_file_type: bool = False
         self._ignore_groups_fewer_than: bool = preferences.get_ignore_groups_fewer_than()
         self._minimum_group_size: int = preferences.get_minimum_group_size()
+        self._memory_budget_mb: int = preferences.get_memory_budget_mb()
+        self._reader_workers: int = preferences.get_reader_workers()
+        self._group_workers: int = preferences.get_group_workers()
+        self._use_descriptor_cache: bool = preferences.get_use_descriptor_cache()
+        self._show_stage_times: bool = preferences.get_show_stage_times()
+        self._min_max_engine: int = preferences.get_min_max_engine()
+        self._combine_engine: int = preferences.get_combine_engine()
+        self._summation: int = preferences.get_summation()
+        self._precision: int = preferences.get_precision()
+        self._output_format: int = preferences.get_output_format()
 
     def get_master_combine_method(self) -> int:
         result = self._master_combine_method
@@ -114,6 +128,17 @@ class DataModel:
         assert 0.1 <= bandwidth <= 50.0
         self._temperature_group_bandwidth = bandwidth
 
+    # Width of bins temperatures are rounded into before clustering (zero for no binning)
+
+    def get_temperature_bin_width(self) -> float:
+        result = self._temperature_bin_width
+        assert 0 <= result <= 50.0
+        return result
+
+    def set_temperature_bin_width(self, value: float):
+        assert 0 <= value <= 50.0
+        self._temperature_bin_width = value
+
     def get_ignore_file_type(self) -> bool:
         return self._ignore_file_type
 
@@ -131,3 +156,113 @@ class DataModel:
 
     def set_minimum_group_size(self, minimum: int):
         self._minimum_group_size = minimum
+
+    # How much memory, in megabytes, may the image stack occupy while being combined?
+
+    def get_memory_budget_mb(self) -> int:
+        result = self._memory_budget_mb
+        assert result > 0
+        return result
+
+    def set_memory_budget_mb(self, value: int):
+        assert value > 0
+        self._memory_budget_mb = value
+
+    # How many files are read concurrently?  Zero means choose automatically.
+
+    def get_reader_workers(self) -> int:
+        result = self._reader_workers
+        assert result >= 0
+        return result
+
+    def set_reader_workers(self, value: int):
+        assert value >= 0
+        self._reader_workers = value
+
+    # How many groups are combined at once, in separate processes?  Zero means choose automatically.
+
+    def get_group_workers(self) -> int:
+        result = self._group_workers
+        assert result >= 0
+        return result
+
+    def set_group_workers(self, value: int):
+        assert value >= 0
+        self._group_workers = value
+
+    # Should file descriptions be kept in a cache so unchanged files needn't have their headers re-read?
+
+    def get_use_descriptor_cache(self) -> bool:
+        return self._use_descriptor_cache
+
+    def set_use_descriptor_cache(self, use_cache: bool):
+        self._use_descriptor_cache = use_cache
+
+    def get_descriptor_cache(self) -> Optional[DescriptorCache]:
+        """
+        Get the descriptor cache to be used when reading file headers, or None if caching is turned off
+        """
+        return DescriptorCache.get_shared_cache() if self._use_descriptor_cache else None
+
+    # Should a summary of time and memory used by each stage of the work be shown after a session?
+
+    def get_show_stage_times(self) -> bool:
+        return self._show_stage_times
+
+    def set_show_stage_times(self, show: bool):
+        self._show_stage_times = show
+
+    # How is min-max clipping computed?
+
+    def get_min_max_engine(self) -> int:
+        result = self._min_max_engine
+        assert result == Constants.MIN_MAX_ENGINE_PARTITION or result == Constants.MIN_MAX_ENGINE_MASKED
+        return result
+
+    def set_min_max_engine(self, value: int):
+        assert value == Constants.MIN_MAX_ENGINE_PARTITION or value == Constants.MIN_MAX_ENGINE_MASKED
+        self._min_max_engine = value
+
+    # Are frames combined one at a time into running sums (where the method allows), or as a whole stack?
+
+    def get_combine_engine(self) -> int:
+        result = self._combine_engine
+        assert result == Constants.COMBINE_ENGINE_STREAMING or result == Constants.COMBINE_ENGINE_TILED
+        return result
+
+    def set_combine_engine(self, value: int):
+        assert value == Constants.COMBINE_ENGINE_STREAMING or value == Constants.COMBINE_ENGINE_TILED
+        self._combine_engine = value
+
+    # How are the running sums of the streaming engine kept?
+
+    def get_summation(self) -> int:
+        result = self._summation
+        assert result in (Constants.SUMMATION_SIMPLE, Constants.SUMMATION_COMPENSATED, Constants.SUMMATION_PAIRWISE)
+        return result
+
+    def set_summation(self, value: int):
+        assert value in (Constants.SUMMATION_SIMPLE, Constants.SUMMATION_COMPENSATED, Constants.SUMMATION_PAIRWISE)
+        self._summation = value
+
+    # What floating point precision is the combination math done in?
+
+    def get_precision(self) -> int:
+        result = self._precision
+        assert result == Constants.PRECISION_DOUBLE or result == Constants.PRECISION_SINGLE
+        return result
+
+    def set_precision(self, value: int):
+        assert value == Constants.PRECISION_DOUBLE or value == Constants.PRECISION_SINGLE
+        self._precision = value
+
+    # How are the master's pixel values stored?
+
+    def get_output_format(self) -> int:
+        result = self._output_format
+        assert result == Constants.OUTPUT_FORMAT_SIGNED_16 or result == Constants.OUTPUT_FORMAT_UNSIGNED_16
+        return result
+
+    def set_output_format(self, value: int):
+        assert value == Constants.OUTPUT_FORMAT_SIGNED_16 or value == Constants.OUTPUT_FORMAT_UNSIGNED_16
+        self._output_format = value
@@ -0,0 +1,198 @@
+#
+#   Persistent cache of file descriptor metadata.
+#
+#   The same archive directories tend to be opened over and over, and re-reading every file's
+#   header each time is the bulk of the cost of loading a large set of files.  This cache keeps
+#   each descriptor's fields in a small SQLite database in the user's data directory, keyed by
+#   the file's absolute path.  The file's size and modification time are stored with the entry,
+#   and an entry is only used if they still match, so a changed file is automatically re-read.
+#   The size and modification time stored are taken before the header is read, and the entry isn't
+#   stored if they changed while it was being read; otherwise a file rewritten in the meantime (e.g. one
+#   arriving in a watched directory) would be cached under its new size and time with the old header.
+#
+#   The number of entries is capped; when the cap is exceeded the least recently used entries
+#   are discarded.
+#
+#   The cache is an optimization only.  If the database can't be opened or used for any reason,
+#   lookups simply miss and stores do nothing.  Why it is unavailable is kept, for the caller to report
+#   on its console.
+#
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from FileDescriptor import FileDescriptor
+from MultiOsUtil import MultiOsUtil
+
+
+class DescriptorCache:
+    DATABASE_FILE_NAME = "descriptor-cache.sqlite3"
+    DEFAULT_MAXIMUM_ENTRIES = 100000
+
+    # SQLite limits the number of parameters in one statement, so bulk operations are chunked
+    _CHUNK_SIZE = 500
+
+    _shared_cache = None
+    _shared_cache_lock = threading.Lock()
+
+    def __init__(self, database_path: str, maximum_entries: int = DEFAULT_MAXIMUM_ENTRIES):
+        """
+        Open (creating if necessary) the cache database at the given path
+        :param database_path:       Path to the SQLite database file
+        :param maximum_entries:     Cap on number of cached descriptors; least recently used are evicted
+        """
+        assert maximum_entries > 0
+        self._maximum_entries = maximum_entries
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+        self._open_error: Optional[str] = None
+        try:
+            self._connection = sqlite3.connect(database_path, check_same_thread=False)
+            # Exposure and temperature have no declared type so they come back as stored (int or float)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS descriptors ("
+                                     "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                                     "type INTEGER, binning INTEGER, x_size INTEGER, y_size INTEGER, "
+                                     "filter_name TEXT, exposure, temperature, last_used REAL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS descriptors_last_used "
+                                     "ON descriptors (last_used)")
+            self._connection.commit()
+        except sqlite3.Error as exception:
+            self._open_error = str(exception)
+            self._connection = None
+
+    @classmethod
+    def get_shared_cache(cls) -> "DescriptorCache":
+        """
+        Get the cache in the default location, shared by everything in this process
+        :return:    The shared cache object
+        """
+        with cls._shared_cache_lock:
+            if cls._shared_cache is None:
+                try:
+                    database_path = os.path.join(MultiOsUtil.user_data_directory(), cls.DATABASE_FILE_NAME)
+                except OSError:
+                    database_path = ":memory:"
+                cls._shared_cache = DescriptorCache(database_path)
+            return cls._shared_cache
+
+    def get_unavailable_message(self) -> Optional[str]:
+        """
+        Get a message explaining that the cache couldn't be opened, for the console
+        :return:    Message, or None if the cache is working
+        """
+        if self._open_error is None:
+            return None
+        return f"Descriptor cache unavailable ({self._open_error}); file headers will be read every time"
+
+    def lookup_many(self, file_names: [str]) -> {str: FileDescriptor}:
+        """
+        Look up descriptors for the given files.  Only entries whose size and modification time
+        still match the file on disk are returned.
+        :param file_names:      Paths of files wanted
+        :return:                Dictionary from given path to descriptor, for the files found in the cache
+        """
+        if self._connection is None:
+            return {}
+        # Key by absolute path, but remember the name the caller used
+        wanted: {str: (str, int, int)} = {}
+        for name in file_names:
+            try:
+                status = os.stat(name)
+            except OSError:
+                continue  # Let the normal reading code report the problem
+            wanted[os.path.abspath(name)] = (name, status.st_size, status.st_mtime_ns)
+
+        result: {str: FileDescriptor} = {}
+        hits: [str] = []
+        absolute_paths = list(wanted.keys())
+        try:
+            with self._lock:
+                for chunk_start in range(0, len(absolute_paths), self._CHUNK_SIZE):
+                    chunk = absolute_paths[chunk_start:chunk_start + self._CHUNK_SIZE]
+                    placeholders = ",".join("?" * len(chunk))
+                    rows = self._connection.execute(
+                        f"SELECT path, size, mtime_ns, type, binning, x_size, y_size, filter_name, "
+                        f"exposure, temperature FROM descriptors WHERE path IN ({placeholders})",
+                        chunk).fetchall()
+                    for (path, size, mtime_ns, type_code, binning, x_size, y_size,
+                         filter_name, exposure, temperature) in rows:
+                        (name, actual_size, actual_mtime_ns) = wanted[path]
+                        if size != actual_size or mtime_ns != actual_mtime_ns:
+                            continue  # File has changed since it was cached
+                        descriptor = FileDescriptor(name)
+                        descriptor.set_type(type_code)
+                        descriptor.set_binning(binning, binning)
+                        descriptor.set_dimensions(x_size, y_size)
+                        descriptor.set_filter_name(filter_name)
+                        descriptor.set_exposure(exposure)
+                        descriptor.set_temperature(temperature)
+                        result[name] = descriptor
+                        hits.append(path)
+                # Record the use, for least-recently-used eviction
+                now = time.time()
+                self._connection.executemany("UPDATE descriptors SET last_used = ? WHERE path = ?",
+                                             [(now, path) for path in hits])
+                self._connection.commit()
+        except sqlite3.Error:
+            return {}
+        return result
+
+    @classmethod
+    def file_statuses(cls, file_names: [str]) -> {str: (int, int)}:
+        """
+        Get the size and modification time of the given files, before their headers are read, for store_many
+        :param file_names:      Paths of the files about to be read
+        :return:                Dictionary from absolute path to size and modification time (ns), for the
+                                files that could be examined
+        """
+        result: {str: (int, int)} = {}
+        for name in file_names:
+            try:
+                status = os.stat(name)
+            except OSError:
+                continue
+            result[os.path.abspath(name)] = (status.st_size, status.st_mtime_ns)
+        return result
+
+    def store_many(self, descriptors: [FileDescriptor], file_statuses: {str: (int, int)}):
+        """
+        Add or replace the cache entries for the given descriptors, then evict old entries if over the cap.
+        A file whose size or modification time is not the same as before it was read isn't stored.
+        :param descriptors:     Descriptors of files that have just been read
+        :param file_statuses:   Sizes and modification times of the files before they were read (see file_statuses)
+        """
+        if self._connection is None or len(descriptors) == 0:
+            return
+        now = time.time()
+        rows = []
+        for descriptor in descriptors:
+            path = os.path.abspath(descriptor.get_absolute_path())
+            status_before_read = file_statuses.get(path)
+            if status_before_read is None or self.file_statuses([path]).get(path) != status_before_read:
+                continue  # Changed while being read; the header may not match the stored size and time
+            (size, mtime_ns) = status_before_read
+            rows.append((path, size, mtime_ns,
+                         descriptor.get_type(), descriptor.get_binning(),
+                         descriptor.get_x_dimension(), descriptor.get_y_dimension(),
+                         descriptor.get_filter_name(), descriptor.get_exposure(), descriptor.get_temperature(),
+                         now))
+        try:
+            with self._lock:
+                self._connection.executemany("INSERT OR REPLACE INTO descriptors VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                                             rows)
+                (count,) = self._connection.execute("SELECT COUNT(*) FROM descriptors").fetchone()
+                if count > self._maximum_entries:
+                    self._connection.execute("DELETE FROM descriptors WHERE path IN "
+                                             "(SELECT path FROM descriptors ORDER BY last_used LIMIT ?)",
+                                             (count - self._maximum_entries,))
+                self._connection.commit()
+        except sqlite3.Error:
+            pass
+
+    def close(self):
+        if self._connection is not None:
+            with self._lock:
+                self._connection.close()
+                self._connection = None
@@ -0,0 +1,167 @@
+#
+#   Watch a directory for FITS files arriving in it, reporting each file once it has been completely
+#   written (so its header and data can be read).
+#
+#   On Linux, the kernel's inotify facility (used through ctypes, so nothing needs installing) tells us
+#   when a file that was open for writing is closed, or when a file is moved into the directory.
+#   Elsewhere, or if inotify can't be used, the directory is polled: a file is taken to be complete
+#   once its size and modification time are unchanged from one poll to the next.
+#
+#   Files already in the directory when watching starts are reported by the first call, as complete.
+#   Only the directory itself is watched, not its subdirectories (so input files moved to a subfolder
+#   after processing aren't seen again).
+#
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from typing import Optional
+
+from SharedUtils import SharedUtils
+
+
+class DirectoryWatcher:
+
+    # How often the directory is polled, when inotify isn't available
+    POLL_INTERVAL_SECONDS = 2.0
+
+    # inotify event flags (from <sys/inotify.h>): file open for writing was closed, file moved in
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    # Header of each inotify event: watch descriptor, mask, cookie, length of the name that follows
+    INOTIFY_EVENT_HEADER = struct.Struct("iIII")
+    INOTIFY_READ_BYTES = 64 * 1024
+
+    def __init__(self, directory_path: str, use_inotify: bool = True):
+        """
+        Start watching the given directory
+        :param directory_path:  Directory to be watched
+        :param use_inotify:     Use inotify if it is available (otherwise always poll)
+        """
+        self._directory_path = os.path.abspath(directory_path)
+        # Watch before listing the files already present, so none can arrive unseen in between
+        self._inotify_descriptor: Optional[int] = self.open_inotify() if use_inotify else None
+        # Files reported, or already present, so they aren't reported again
+        self._known_files: {str} = set()
+        self._pending_files: [str] = sorted(SharedUtils.files_in_directory(self._directory_path, False))
+        self._known_files.update(self._pending_files)
+        # For polling: size and modification time of files not yet complete, as of the last poll
+        self._unfinished_files: {str: (int, int)} = {}
+        self._last_poll = 0.0
+
+    def is_using_inotify(self) -> bool:
+        return self._inotify_descriptor is not None
+
+    def open_inotify(self) -> Optional[int]:
+        """
+        Set up an inotify watch on the directory, if this system offers inotify
+        :return:    File descriptor to read events from, or None if inotify can't be used
+        """
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            descriptor = libc.inotify_init()
+            if descriptor < 0:
+                return None
+            if libc.inotify_add_watch(descriptor, os.fsencode(self._directory_path),
+                                      self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+                os.close(descriptor)
+                return None
+            return descriptor
+        except (OSError, AttributeError):
+            return None
+
+    def close(self):
+        """
+        Stop watching
+        """
+        if self._inotify_descriptor is not None:
+            os.close(self._inotify_descriptor)
+            self._inotify_descriptor = None
+
+    def wait_for_files(self, timeout_seconds: float) -> [str]:
+        """
+        Wait for FITS files to be completely written into the directory
+        :param timeout_seconds:     Longest time to wait if no files arrive
+        :return:                    Paths of the files that have arrived, possibly none
+        """
+        if len(self._pending_files) == 0:
+            if self._inotify_descriptor is not None:
+                self._pending_files = self.read_inotify_events(timeout_seconds)
+            else:
+                self._pending_files = self.poll_for_files(timeout_seconds)
+        result = self._pending_files
+        self._pending_files = []
+        return result
+
+    def read_inotify_events(self, timeout_seconds: float) -> [str]:
+        """
+        Wait for inotify to report files closed after writing, or moved into the directory
+        :param timeout_seconds:     Longest time to wait
+        :return:                    Paths of FITS files reported
+        """
+        (readable, _, _) = select.select([self._inotify_descriptor], [], [], max(0.0, timeout_seconds))
+        if len(readable) == 0:
+            return []
+        buffer = os.read(self._inotify_descriptor, self.INOTIFY_READ_BYTES)
+        result: [str] = []
+        offset = 0
+        while offset + self.INOTIFY_EVENT_HEADER.size <= len(buffer):
+            (_, _, _, name_length) = self.INOTIFY_EVENT_HEADER.unpack_from(buffer, offset)
+            offset += self.INOTIFY_EVENT_HEADER.size
+            name = os.fsdecode(buffer[offset:offset + name_length].rstrip(b"\0"))
+            offset += name_length
+            path = os.path.join(self._directory_path, name)
+            if SharedUtils.is_fits_file_name(name) and path not in result:
+                result.append(path)
+        self._known_files.update(result)
+        return result
+
+    def poll_for_files(self, timeout_seconds: float) -> [str]:
+        """
+        Poll the directory until new files are complete, or the time runs out
+        :param timeout_seconds:     Longest time to wait
+        :return:                    Paths of FITS files found complete
+        """
+        deadline = time.monotonic() + timeout_seconds
+        while True:
+            # Keep to the poll interval, even if called again soon after the last poll
+            next_poll = self._last_poll + self.POLL_INTERVAL_SECONDS
+            now = time.monotonic()
+            if now < next_poll:
+                if next_poll > deadline:
+                    time.sleep(max(0.0, deadline - now))
+                    return []
+                time.sleep(next_poll - now)
+            self._last_poll = time.monotonic()
+            result = self.poll_once()
+            if len(result) > 0 or time.monotonic() >= deadline:
+                return result
+
+    def poll_once(self) -> [str]:
+        """
+        Look at the directory once: files whose size and modification time haven't changed since the
+        last look are complete; new or changed files are remembered to be looked at again
+        :return:    Paths of files found complete
+        """
+        result: [str] = []
+        still_unfinished: {str: (int, int)} = {}
+        for path in SharedUtils.files_in_directory(self._directory_path, False):
+            if path in self._known_files:
+                continue
+            try:
+                status = os.stat(path)
+            except OSError:
+                continue  # Gone again already
+            signature = (status.st_size, status.st_mtime_ns)
+            if self._unfinished_files.get(path) == signature:
+                result.append(path)
+            else:
+                still_unfinished[path] = signature
+        self._unfinished_files = still_unfinished
+        self._known_files.update(result)
+        return sorted(result)
@@ -1,19 +1,26 @@
 #
 #   Object for combining FITS files using different algorithms
 #
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
 from itertools import groupby
-from typing import Callable
+from typing import Callable, Optional
 
 import numpy
-import mean_shift as ms
 # from sklearn.cluster import MeanShift Replaced by Matt Nedrich mean_shift.py file
 
 import MasterMakerExceptions
 from Console import Console
+from ConsoleBuffer import ConsoleBuffer
+from ConsoleCallback import ConsoleCallback
 from Constants import Constants
 from DataModel import DataModel
 from FileDescriptor import FileDescriptor
+from GroupProcessPool import GroupProcessPool
 from ImageMath import ImageMath
+from Instrumentation import Instrumentation
+from MeanShift1D import MeanShift1D
+from MultiOsUtil import MultiOsUtil
 from RmFitsUtil import RmFitsUtil
 from SessionController import SessionController
 from SharedUtils import SharedUtils
@@ -22,14 +29,18 @@ from SharedUtils import SharedUtils
 class FileCombiner:
 
     def __init__(self, session_controller: SessionController,
-                 file_moved_callback: Callable[[str], None]):
+                 file_moved_callback: Callable[[str], None],
+                 keep_existing_outputs: bool = False):
         """
         Initialize this object
         :param session_controller:      Controller the parent uses to control this subtask
         :param file_moved_callback:     Callback method to inform that we have moved a processed file
+        :param keep_existing_outputs:   Give a group's output a new name, rather than replacing an existing
+                                        file of the same name (e.g. a master of the same kind made a minute ago)
         """
         self.callback_method = file_moved_callback
         self._session_controller = session_controller
+        self._keep_existing_outputs = keep_existing_outputs
 
     # Process one set of files.  Output to the given path, if provided.  If not provided, prompt the user for it.
     
@@ -90,7 +101,6 @@ class FileCombiner:
         """
         console.push_level()
         self.check_cancellation()
-        temperature_bandwidth = data_model.get_temperature_group_bandwidth()
         disposition_folder = data_model.get_disposition_subfolder_name()
         substituted_folder_name = SharedUtils.substitute_date_time_filter_in_string(disposition_folder)
         console.message("Process groups into output directory: " + output_directory, +1)
@@ -99,7 +109,55 @@ class FileCombiner:
         minimum_group_size = data_model.get_minimum_group_size() \
             if data_model.get_ignore_groups_fewer_than() else 0
 
-        #  Process size groups, or all sizes if not grouping
+        # Walk through the groups, deciding which are to be processed.  Messages from the walk are held
+        # back, so they can be output in order with those from processing the groups.
+        combine_method = data_model.get_master_combine_method()
+        walk_console = ConsoleBuffer(console.get_message_level())
+        planned_groups: [([str], [FileDescriptor], int)] = []
+
+        def plan_group(group: [FileDescriptor], group_console: Console):
+            planned_groups.append((walk_console.take_lines(), group, group_console.get_message_level()))
+
+        with Instrumentation.stage(Instrumentation.STAGE_GROUPING):
+            self.walk_groups(data_model, selected_files, minimum_group_size, walk_console, plan_group)
+        final_lines = walk_console.take_lines()
+
+        number_workers = self.group_worker_count(data_model, [group for (_, group, _) in planned_groups])
+        if number_workers > 1:
+            console.message(f"Processing {len(planned_groups)} groups using {number_workers} processes", 0)
+            self.process_planned_groups_in_parallel(data_model, planned_groups, number_workers,
+                                                    output_directory, combine_method,
+                                                    substituted_folder_name, console)
+        elif len(planned_groups) > 1:
+            self.process_planned_groups_pipelined(data_model, planned_groups, output_directory, combine_method,
+                                                  substituted_folder_name, console)
+        else:
+            for (lines, group, group_level) in planned_groups:
+                self.output_lines(lines, console)
+                # Continue at the indentation level the walk had reached for this group
+                group_console = ConsoleCallback(console.output_message)
+                group_console.set_message_level(group_level)
+                self.process_one_group(data_model, group, output_directory, combine_method,
+                                       substituted_folder_name, group_console)
+        self.output_lines(final_lines, console)
+        console.message("Group combining complete", 0)
+        console.pop_level()
+
+    def walk_groups(self, data_model: DataModel,
+                    selected_files: [FileDescriptor],
+                    minimum_group_size: int,
+                    console: Console,
+                    process_group: Callable[[[FileDescriptor], Console], None]):
+        """
+        Divide the given files into groups by size and temperature (as the data model requests), reporting
+        on each group, and call the given function for each group that is large enough to be processed
+        :param data_model:          Data model specifying options for the current run
+        :param selected_files:      List of descriptions of files to be grouped
+        :param minimum_group_size:  Groups smaller than this are ignored
+        :param console:             Re-directable console output object
+        :param process_group:       Function called with each group to be processed, and the console
+        """
+        temperature_bandwidth = data_model.get_temperature_group_bandwidth()
         groups_by_size = self.get_groups_by_size(selected_files, data_model.get_group_by_size())
         grouping_by_size = data_model.get_group_by_size()
         grouping_by_temperature = data_model.get_group_by_temperature()
@@ -119,7 +177,8 @@ class FileCombiner:
                 groups_by_temperature = \
                     self.get_groups_by_temperature(size_group,
                                                    data_model.get_group_by_temperature(),
-                                                   temperature_bandwidth)
+                                                   temperature_bandwidth,
+                                                   data_model.get_temperature_bin_width())
                 for temperature_group in groups_by_temperature:
                     console.push_level()
                     self.check_cancellation()
@@ -134,15 +193,204 @@ class FileCombiner:
                                             f"files with mean temperature {mean_temperature:.1f} "
                                             f"({temperature_bandwidth} bandwidth)", +1)
                         # Now we have a list of descriptors, grouped as appropriate, to process
-                        self.process_one_group(data_model, temperature_group,
-                                               output_directory,
-                                               data_model.get_master_combine_method(),
-                                               substituted_folder_name,
-                                               console)
+                        process_group(temperature_group, console)
                     console.pop_level()
             console.pop_level()
-        console.message("Group combining complete", 0)
-        console.pop_level()
+
+    def group_worker_count(self, data_model: DataModel, groups: [[FileDescriptor]]) -> int:
+        """
+        Decide how many worker processes should combine the given groups
+        :param data_model:  Data model giving the group workers setting and memory budget
+        :param groups:      The groups to be processed
+        :return:            Number of worker processes; 1 means process the groups here, one at a time
+        """
+        if len(groups) < 2:
+            return 1
+        group_workers = data_model.get_group_workers()
+        if group_workers > 0:
+            return min(group_workers, len(groups))
+        # Each worker may use the memory budget, plus a few frames being read or accumulated
+        largest_frame_bytes = max(group[0].get_x_dimension() * group[0].get_y_dimension() for group in groups) \
+            * numpy.dtype(numpy.float64).itemsize
+        bytes_per_group = data_model.get_memory_budget_mb() * 1024 * 1024 + 4 * largest_frame_bytes
+        return GroupProcessPool.automatic_worker_count(len(groups), bytes_per_group)
+
+    def process_planned_groups_in_parallel(self, data_model: DataModel,
+                                           planned_groups: [([str], [FileDescriptor], int)],
+                                           number_workers: int,
+                                           output_directory: str,
+                                           combine_method: int,
+                                           disposition_folder_name: str,
+                                           console: Console):
+        """
+        Process the given groups in a pool of worker processes.  Each group's console output and list of
+        moved files are collected in its worker and passed back here, where they are output in the
+        original order of the groups.  If a group fails, the groups not yet started are cancelled, but
+        those already running are allowed to finish, and their output and moved files are still delivered.
+        Exceptions thrown:
+            (any exception)     Raised while processing a group; the first is re-raised here after
+                                the output of every group that ran
+
+        :param data_model:                  Data model giving options for current run
+        :param planned_groups:              For each group: console lines to precede it, its files, console level
+        :param number_workers:              Number of worker processes
+        :param output_directory:            Path to directory to receive the output files
+        :param combine_method:              Code saying how files should be combined
+        :param disposition_folder_name:     If files to be moved after processing, name of receiving folder
+        :param console:                     Re-directable console output object
+        """
+        argument_lists = [(data_model, group, output_directory, combine_method, disposition_folder_name, group_level)
+                          for (_, group, group_level) in planned_groups]
+        results = GroupProcessPool(number_workers).imap_in_order(FileCombiner.process_one_group_in_worker,
+                                                                 argument_lists, self._session_controller,
+                                                                 lambda result: result[3] is not None)
+        first_exception: Optional[Exception] = None
+        try:
+            for ((lines, _, _), result) in zip(planned_groups, results):
+                if result is None:
+                    continue  # Not started, because an earlier group failed
+                (group_lines, moved_files, records, exception) = result
+                Instrumentation.merge_records(records)
+                self.output_lines(lines, console)
+                self.output_lines(group_lines, console)
+                for moved_file in moved_files:
+                    self.callback_method(moved_file)
+                if first_exception is None:
+                    first_exception = exception
+        finally:
+            results.close()
+        if first_exception is not None:
+            raise first_exception
+
+    @classmethod
+    def process_one_group_in_worker(cls,
+                                    data_model: DataModel,
+                                    descriptor_list: [FileDescriptor],
+                                    output_directory: str,
+                                    combine_method: int,
+                                    disposition_folder_name: str,
+                                    console_level: int) -> ([str], [str], {str: {}}, Optional[Exception]):
+        """
+        Process one group of files, in a worker process.  Console output and the names of moved files are
+        collected and returned rather than being output, as are the instrumentation records and any
+        exception raised.
+        :param data_model:                  Data model giving options for current run
+        :param descriptor_list:             List of all the files in one group, for processing
+        :param output_directory:            Path to directory to receive the output file
+        :param combine_method:              Code saying how these files should be combined
+        :param disposition_folder_name:     If files to be moved after processing, name of receiving folder
+        :param console_level:               Console indentation level to start at
+        :return:                            Tuple: console lines, paths of moved files, instrumentation
+                                            records, exception or None
+        """
+        # Worker processes are re-used, so start this group's records afresh
+        Instrumentation.reset()
+        console = ConsoleBuffer(console_level)
+        moved_files: [str] = []
+        file_combiner = FileCombiner(GroupProcessPool.make_worker_session_controller(), moved_files.append)
+        try:
+            file_combiner.process_one_group(data_model, descriptor_list, output_directory, combine_method,
+                                            disposition_folder_name, console)
+        except Exception as exception:
+            return console.take_lines(), moved_files, Instrumentation.take_records(), exception
+        return console.take_lines(), moved_files, Instrumentation.take_records(), None
+
+    def process_planned_groups_pipelined(self, data_model: DataModel,
+                                         planned_groups: [([str], [FileDescriptor], int)],
+                                         output_directory: str,
+                                         combine_method: int,
+                                         disposition_folder_name: str,
+                                         console: Console):
+        """
+        Process the given groups one at a time, but with the reading, combining and writing of different
+        groups overlapped.  While one group is combined here, the next group's files are read ahead, into
+        the operating system's file cache, on one background thread, and the previous group's output file
+        is written, and its input files put away, on another.  Only one group is read ahead and only one
+        waits to be written, so at most one extra combined image is held in memory.  Each group's console
+        output is held back and output, in order, when the group has been written.
+        Exceptions thrown:
+            (any exception)     Raised while processing a group; re-raised here after that group's output
+
+        :param data_model:                  Data model giving options for current run
+        :param planned_groups:              For each group: console lines to precede it, its files, console level
+        :param output_directory:            Path to directory to receive the output files
+        :param combine_method:              Code saying how files should be combined
+        :param disposition_folder_name:     If files to be moved after processing, name of receiving folder
+        :param console:                     Re-directable console output object
+        """
+        with ThreadPoolExecutor(max_workers=1) as prefetcher, ThreadPoolExecutor(max_workers=1) as writer:
+            prefetch: Optional[Future] = None
+            write: Optional[Future] = None
+            lines: [str] = []
+            group_console = ConsoleBuffer()
+            try:
+                for index, (lines, group, group_level) in enumerate(planned_groups):
+                    # Start reading the next group ahead, once the read-ahead of this one is finished
+                    if prefetch is not None:
+                        prefetch.result()
+                        prefetch = None
+                    if index + 1 < len(planned_groups):
+                        prefetch = prefetcher.submit(self.prefetch_group, data_model, planned_groups[index + 1][1])
+                    group_console = ConsoleBuffer(group_level)
+                    finish_group = self.combine_one_group(data_model, group, output_directory, combine_method,
+                                                          disposition_folder_name, group_console)
+                    # Hand this group to the writer once it has finished with the previous one
+                    if write is not None:
+                        write.result()
+                    write = writer.submit(self.finish_group_in_pipeline, finish_group, lines, group_console, console)
+                    lines = []
+                    group_console = ConsoleBuffer()
+                if write is not None:
+                    write.result()
+            except Exception:
+                # Output whatever the failed group produced, after any group still being written
+                writer.submit(self.finish_group_in_pipeline, None, lines, group_console, console)
+                raise
+
+    def finish_group_in_pipeline(self, finish_group: Optional[Callable[[], None]],
+                                 lines: [str],
+                                 group_console: ConsoleBuffer,
+                                 console: Console):
+        """
+        Complete a group in the pipeline's writer thread, then output the group's console lines
+        :param finish_group:    Function returned by combine_one_group, or None if the group failed
+        :param lines:           Console lines to precede the group's own output
+        :param group_console:   Console buffer that has collected the group's output
+        :param console:         Re-directable console output object
+        """
+        try:
+            if finish_group is not None:
+                finish_group()
+        finally:
+            self.output_lines(lines, console)
+            self.output_lines(group_console.take_lines(), console)
+
+    def prefetch_group(self, data_model: DataModel, group: [FileDescriptor]):
+        """
+        Read a group's files into the operating system's file cache, ready for combining, if they fit
+        in the memory currently available.  This is only an optimization, so read errors are ignored;
+        they will be reported when the files are combined.
+        :param data_model:  Data model giving the number of reader threads
+        :param group:       Files to be read
+        """
+        file_names = [descriptor.get_absolute_path() for descriptor in group]
+        try:
+            total_bytes = sum(os.path.getsize(file_name) for file_name in file_names)
+            if total_bytes < MultiOsUtil.available_memory_bytes() // 2:
+                with Instrumentation.stage(Instrumentation.STAGE_PREFETCH):
+                    RmFitsUtil.prefetch_files(file_names, data_model.get_reader_workers(), self._session_controller)
+        except OSError:
+            pass
+
+    @classmethod
+    def output_lines(cls, lines: [str], console: Console):
+        """
+        Output lines that were saved by a buffering console
+        :param lines:       Formatted console lines
+        :param console:     Console to receive them
+        """
+        for line in lines:
+            console.output_message(line)
 
     def process_one_group(self,
                           data_model: DataModel,
@@ -164,6 +412,25 @@ class FileCombiner:
         :param disposition_folder_name:     If files to be moved after processing, name of receiving folder
         :param console:                     Re-directable console output object
         """
+        finish_group = self.combine_one_group(data_model, descriptor_list, output_directory, combine_method,
+                                              disposition_folder_name, console)
+        finish_group()
+
+    def combine_one_group(self,
+                          data_model: DataModel,
+                          descriptor_list: [FileDescriptor],
+                          output_directory: str,
+                          combine_method: int,
+                          disposition_folder_name,
+                          console: Console) -> Callable[[], None]:
+        """
+        Do the first part of processing one group of files: check and combine them.  Return a function
+        that completes the processing by writing the output file and putting away the input files.
+        The returned function must be called, with nothing else written to the console in between,
+        since it finishes this group's console output.  See process_one_group for exceptions and parameters.
+
+        :return:        Function, taking no arguments, that writes the output and disposes of the inputs
+        """
         assert len(descriptor_list) > 0
         sample_file: FileDescriptor = descriptor_list[0]
         console.push_level()
@@ -174,6 +441,8 @@ class FileCombiner:
                                                       data_model.get_sigma_clip_threshold(),
                                                       data_model.get_min_max_number_clipped_per_end())
         output_file = f"{output_directory}/{file_name}"
+        if self._keep_existing_outputs:
+            output_file = SharedUtils.unused_file_path(output_file)
 
         # Confirm that these are all bias frames, and can be combined (same binning and dimensions)
         if self.all_compatible_sizes(descriptor_list):
@@ -185,19 +454,23 @@ class FileCombiner:
                 filter_name = SharedUtils.most_common_filter_name(descriptor_list)
 
                 # Do the combination
-                self.combine_files(descriptor_list, data_model, filter_name,
-                                   output_file, console)
-                self.check_cancellation()
-                # Files are combined.  Put away the inputs?
-                # Return list of any that were moved, in case the UI needs to be adjusted
-                self.handle_input_files_disposition(data_model.get_input_file_disposition(),
-                                                    disposition_folder_name,
-                                                    descriptor_list, console)
+                write_output = self.combine_files_deferring_write(descriptor_list, data_model, filter_name,
+                                                                  output_file, console)
             else:
                 raise MasterMakerExceptions.NotAllBiasFrames
         else:
             raise MasterMakerExceptions.IncompatibleSizes
-        console.pop_level()
+
+        def finish_group():
+            write_output()
+            self.check_cancellation()
+            # Files are combined.  Put away the inputs?
+            # Return list of any that were moved, in case the UI needs to be adjusted
+            self.handle_input_files_disposition(data_model.get_input_file_disposition(),
+                                                disposition_folder_name,
+                                                descriptor_list, console)
+            console.pop_level()
+        return finish_group
 
     def handle_input_files_disposition(self,
                                        disposition_type: int,
@@ -220,11 +493,12 @@ class FileCombiner:
             assert (disposition_type == Constants.INPUT_DISPOSITION_SUBFOLDER)
             console.message("Moving processed files to " + sub_folder_name, 0)
             # User wants us to move the input files into a sub-folder
-            for descriptor in descriptors:
-                self.check_cancellation()
-                if SharedUtils.dispose_one_file_to_sub_folder(descriptor, sub_folder_name):
-                    # Successfully moved the file;  tell the user interface
-                    self.callback_method(descriptor.get_absolute_path())
+            with Instrumentation.stage(Instrumentation.STAGE_FILE_MOVES):
+                for descriptor in descriptors:
+                    self.check_cancellation()
+                    if SharedUtils.dispose_one_file_to_sub_folder(descriptor, sub_folder_name):
+                        # Successfully moved the file;  tell the user interface
+                        self.callback_method(descriptor.get_absolute_path())
 
     @classmethod
     def all_of_type(cls, selected_files: [FileDescriptor], type_code: int):
@@ -329,7 +603,8 @@ class FileCombiner:
     def get_groups_by_temperature(self,
                                   selected_files: [FileDescriptor],
                                   is_grouped: bool,
-                                  bandwidth: float) -> [[FileDescriptor]]:
+                                  bandwidth: float,
+                                  bin_width: float = 0.0) -> [[FileDescriptor]]:
         """
         Given list of file descriptors, return a list of lists, where each outer list is all the
         file descriptors with the same temperature within a given tolerance
@@ -339,6 +614,7 @@ class FileCombiner:
         :param selected_files:      List of files to be grouped
         :param is_grouped:          Flag whether size grouping is to be performed
         :param bandwidth:           Bandwidth of sensitivity of clustering algorithm
+        :param bin_width:           If not zero, temperatures are rounded to multiples of this before clustering
         :return:                    List of lists - one outer list per temperature group
         """
         if is_grouped:
@@ -347,8 +623,9 @@ class FileCombiner:
             result_array: [[FileDescriptor]] = []
             temperatures: [float] = [file.get_temperature() for file in selected_files]
             data_to_cluster = numpy.array(temperatures).reshape(-1, 1)
-            mean_shifter = ms.MeanShift()
-            mean_shift_result = mean_shifter.cluster(data_to_cluster, kernel_bandwidth=bandwidth)
+            mean_shifter = MeanShift1D()
+            mean_shift_result = mean_shifter.cluster(data_to_cluster, kernel_bandwidth=bandwidth,
+                                                     bin_width=bin_width)
             arbitrary_cluster_labels = mean_shift_result.cluster_ids
             # cluster_labels is an array of integers, with each "cluster" having the same integer label
             unique_labels = numpy.unique(arbitrary_cluster_labels)
@@ -424,6 +701,25 @@ class FileCombiner:
         :param output_path:     Path for output fiel to be created
         :param console:         Redirectable console output object
         """
+        write_output = self.combine_files_deferring_write(input_files, data_model, filter_name, output_path, console)
+        write_output()
+
+    def combine_files_deferring_write(self, input_files: [FileDescriptor],
+                                      data_model: DataModel,
+                                      filter_name: str,
+                                      output_path: str,
+                                      console: Console) -> Callable[[], None]:
+        """
+        Combine the given files as combine_files does, but rather than writing the output file,
+        return a function that will write it.  The writing can then be overlapped with other work.
+
+        :param input_files:     List of files to be combined
+        :param data_model:      Data model with options for this run
+        :param filter_name:     Human-readable filter name (for output file name and FITS comment)
+        :param output_path:     Path for output file to be created
+        :param console:         Redirectable console output object
+        :return:                Function, taking no arguments, that writes the combined output file
+        """
         console.push_level()
         substituted_file_name = SharedUtils.substitute_date_time_filter_in_string(output_path)
         file_names = [d.get_absolute_path() for d in input_files]
@@ -432,48 +728,48 @@ class FileCombiner:
         assert len(input_files) > 0
         binning: int = input_files[0].get_binning()
         (mean_exposure, mean_temperature) = ImageMath.mean_exposure_and_temperature(input_files)
-        if combine_method == Constants.COMBINE_MEAN:
-            mean_data = ImageMath.combine_mean(file_names, console, self._session_controller)
-            self.check_cancellation()
-            RmFitsUtil.create_combined_fits_file(substituted_file_name, mean_data,
-                                                 FileDescriptor.FILE_TYPE_BIAS,
-                                                 "Bias Frame",
-                                                 mean_exposure, mean_temperature, filter_name, binning,
-                                                 "Master Bias MEAN combined")
-        elif combine_method == Constants.COMBINE_MEDIAN:
-            median_data = ImageMath.combine_median(file_names, console, self._session_controller)
-            self.check_cancellation()
-            RmFitsUtil.create_combined_fits_file(substituted_file_name, median_data,
-                                                 FileDescriptor.FILE_TYPE_BIAS,
-                                                 "Bias Frame",
-                                                 mean_exposure, mean_temperature, filter_name, binning,
-                                                 "Master Bias MEDIAN combined")
-        elif combine_method == Constants.COMBINE_MINMAX:
-            number_dropped_points = data_model.get_min_max_number_clipped_per_end()
-            min_max_clipped_mean = ImageMath.combine_min_max_clip(file_names, number_dropped_points,
-                                                                  console, self._session_controller)
-            self.check_cancellation()
-            assert min_max_clipped_mean is not None
-            RmFitsUtil.create_combined_fits_file(substituted_file_name, min_max_clipped_mean,
-                                                 FileDescriptor.FILE_TYPE_BIAS,
-                                                 "Bias Frame",
-                                                 mean_exposure, mean_temperature, filter_name, binning,
-                                                 f"Master Bias Min/Max Clipped "
-                                                 f"(drop {number_dropped_points}) Mean combined")
-        else:
-            assert combine_method == Constants.COMBINE_SIGMA_CLIP
-            sigma_threshold = data_model.get_sigma_clip_threshold()
-            sigma_clipped_mean = ImageMath.combine_sigma_clip(file_names, sigma_threshold,
-                                                              console, self._session_controller)
-            self.check_cancellation()
-            assert sigma_clipped_mean is not None
-            RmFitsUtil.create_combined_fits_file(substituted_file_name, sigma_clipped_mean,
+        memory_budget_mb = data_model.get_memory_budget_mb()
+        reader_workers = data_model.get_reader_workers()
+        working_dtype = ImageMath.working_dtype_for_precision(data_model.get_precision())
+        unsigned = data_model.get_output_format() == Constants.OUTPUT_FORMAT_UNSIGNED_16
+        # Pixel reads are recorded as a stage of their own, within this one
+        with Instrumentation.stage(Instrumentation.STAGE_COMBINE):
+            if combine_method == Constants.COMBINE_MEAN:
+                combined_data = ImageMath.combine_mean(file_names, console, self._session_controller,
+                                                       memory_budget_mb, reader_workers,
+                                                       data_model.get_combine_engine(), data_model.get_summation(),
+                                                       working_dtype)
+                comment = "Master Bias MEAN combined"
+            elif combine_method == Constants.COMBINE_MEDIAN:
+                combined_data = ImageMath.combine_median(file_names, console, self._session_controller,
+                                                         memory_budget_mb, reader_workers, working_dtype)
+                comment = "Master Bias MEDIAN combined"
+            elif combine_method == Constants.COMBINE_MINMAX:
+                number_dropped_points = data_model.get_min_max_number_clipped_per_end()
+                combined_data = ImageMath.combine_min_max_clip(file_names, number_dropped_points,
+                                                               console, self._session_controller,
+                                                               memory_budget_mb, reader_workers,
+                                                               data_model.get_min_max_engine(), working_dtype)
+                comment = f"Master Bias Min/Max Clipped (drop {number_dropped_points}) Mean combined"
+            else:
+                assert combine_method == Constants.COMBINE_SIGMA_CLIP
+                sigma_threshold = data_model.get_sigma_clip_threshold()
+                combined_data = ImageMath.combine_sigma_clip(file_names, sigma_threshold,
+                                                             console, self._session_controller,
+                                                             memory_budget_mb, reader_workers,
+                                                             data_model.get_combine_engine(), working_dtype)
+                comment = f"Master Bias Sigma Clipped (threshold {sigma_threshold}) Mean combined"
+        self.check_cancellation()
+        assert combined_data is not None
+        console.pop_level()
+
+        def write_output():
+            RmFitsUtil.create_combined_fits_file(substituted_file_name, combined_data,
                                                  FileDescriptor.FILE_TYPE_BIAS,
                                                  "Bias Frame",
                                                  mean_exposure, mean_temperature, filter_name, binning,
-                                                 f"Master Bias Sigma Clipped "
-                                                 f"(threshold {sigma_threshold}) Mean combined")
-        console.pop_level()
+                                                 comment, unsigned)
+        return write_output
 
     def describe_group(self, data_model: DataModel, number_files: int, sample_file: FileDescriptor, console: Console):
         """
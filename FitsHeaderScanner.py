@@ -0,0 +1,182 @@
+#
+#   Fast reader for the primary header of a FITS file.
+#
+#   Building the file descriptors only needs a handful of keyword values from the primary header.
+#   Opening the file with astropy sets up its general HDU machinery (and verifies the whole header)
+#   which is slow when thousands of files are being catalogued.  This scanner reads the header's
+#   2880-byte blocks directly, stopping at the END card, and never touches the data unit.
+#
+#   Values are converted the way astropy converts them: quoted strings (with trailing blanks removed),
+#   T/F logicals, integers, and floating point numbers (including Fortran "D" exponents).
+#
+#   Compressed files are also described.  A gzip-compressed file (.gz) is decompressed as it is read,
+#   which for the header is only its first few blocks.  A tile-compressed file (e.g. from fpack) has an
+#   empty primary HDU followed by a compressed image extension, whose header holds the image's keywords;
+#   the image's dimensions are given there by ZNAXIS, ZNAXIS1 and ZNAXIS2.
+#
+import gzip
+import re
+from typing import Optional
+
+
+class FitsHeaderScanner:
+    BLOCK_SIZE = 2880
+    CARD_SIZE = 80
+
+    # Keywords used to build file descriptors
+    DESCRIPTOR_KEYWORDS = ("PICTTYPE", "IMAGETYP", "NAXIS", "NAXIS1", "NAXIS2", "XBINNING", "YBINNING",
+                           "FILTER", "EXPOSURE", "EXPTIME", "CCD-TEMP")
+
+    # Stop rather than read forever if a file is not really FITS and has no END card
+    MAXIMUM_HEADER_BLOCKS = 1000
+
+    # Keywords of a compressed image extension giving the compressed image's structure, and the image
+    # keywords they stand for
+    COMPRESSED_IMAGE_KEYWORDS = {"ZNAXIS": "NAXIS", "ZNAXIS1": "NAXIS1", "ZNAXIS2": "NAXIS2"}
+
+    _integer_pattern = re.compile(r"^[+-]?\d+$")
+
+    @classmethod
+    def read_primary_header(cls, file_name: str,
+                            wanted_keywords: Optional[tuple] = DESCRIPTOR_KEYWORDS) -> {str: object}:
+        """
+        Read the primary header of the given FITS file and return the values of the given keywords.
+        If a keyword appears more than once, the first occurrence is used (as astropy does).
+        Exceptions thrown:
+            ValueError      The file is not a FITS file, or its header could not be parsed
+
+        :param file_name:           Path to the FITS file
+        :param wanted_keywords:     Keywords whose values are wanted; None to get all of them
+        :return:                    Dictionary mapping keyword to value, for keywords present in the header
+        """
+        with cls.open_file(file_name) as file:
+            return cls.read_header_from_stream(file, wanted_keywords, must_be_primary=True)
+
+    @classmethod
+    def read_image_header(cls, file_name: str,
+                          wanted_keywords: Optional[tuple] = DESCRIPTOR_KEYWORDS) -> {str: object}:
+        """
+        Read the header describing the image in the given FITS file, and return the values of the given
+        keywords.  That is the primary header, unless the primary HDU is empty and followed by a compressed
+        image extension; then it is the primary header's keywords overridden by the extension's, with the
+        compressed image's dimensions.
+        Exceptions thrown:
+            ValueError      The file is not a FITS file, or its header could not be parsed
+
+        :param file_name:           Path to the FITS file
+        :param wanted_keywords:     Keywords whose values are wanted; None to get all of them
+        :return:                    Dictionary mapping keyword to value, for keywords present in the header
+        """
+        structure_keywords = ("NAXIS", "XTENSION", "ZIMAGE") + tuple(cls.COMPRESSED_IMAGE_KEYWORDS.keys())
+        reading_keywords = None if wanted_keywords is None else tuple(wanted_keywords) + structure_keywords
+        with cls.open_file(file_name) as file:
+            primary = cls.read_header_from_stream(file, reading_keywords, must_be_primary=True)
+            if primary.get("NAXIS", 0) != 0:
+                return cls.only_wanted(primary, wanted_keywords)
+            # No primary data unit, so an extension header, if there is one, follows immediately
+            try:
+                extension = cls.read_header_from_stream(file, reading_keywords, must_be_primary=False)
+            except ValueError:
+                return cls.only_wanted(primary, wanted_keywords)
+        if extension.get("XTENSION") != "BINTABLE" or extension.get("ZIMAGE") is not True:
+            return cls.only_wanted(primary, wanted_keywords)
+        image = {**primary, **extension}
+        for (compressed_keyword, image_keyword) in cls.COMPRESSED_IMAGE_KEYWORDS.items():
+            image.pop(image_keyword, None)
+            if compressed_keyword in extension:
+                image[image_keyword] = extension[compressed_keyword]
+        return cls.only_wanted(image, wanted_keywords)
+
+    @classmethod
+    def only_wanted(cls, values: {str: object}, wanted_keywords: Optional[tuple]) -> {str: object}:
+        if wanted_keywords is None:
+            return values
+        return {keyword: value for (keyword, value) in values.items() if keyword in wanted_keywords}
+
+    @classmethod
+    def open_file(cls, file_name: str):
+        """
+        Open a FITS file for reading, decompressing it as it is read if it is gzip-compressed
+        :param file_name:   Path to the file
+        :return:            Readable binary file-like object
+        """
+        if file_name.lower().endswith(".gz"):
+            return gzip.open(file_name, "rb")
+        return open(file_name, "rb")
+
+    @classmethod
+    def read_header_from_stream(cls, stream,
+                                wanted_keywords: Optional[tuple],
+                                must_be_primary: bool) -> {str: object}:
+        """
+        Read one header from the given binary stream, which must be positioned at the start of the header.
+        On return the stream is positioned just past the header (at the start of its data unit).
+        :param stream:              Readable binary file-like object
+        :param wanted_keywords:     Keywords whose values are wanted; None to get all of them
+        :param must_be_primary:     Insist the header start with SIMPLE (else XTENSION is expected)
+        :return:                    Dictionary mapping keyword to value
+        """
+        result: {str: object} = {}
+        wanted = None if wanted_keywords is None else set(wanted_keywords)
+        first_card = True
+        for block_number in range(cls.MAXIMUM_HEADER_BLOCKS):
+            block = stream.read(cls.BLOCK_SIZE)
+            if len(block) < cls.BLOCK_SIZE:
+                raise ValueError("FITS header ended before END card")
+            for card_start in range(0, cls.BLOCK_SIZE, cls.CARD_SIZE):
+                card = block[card_start:card_start + cls.CARD_SIZE].decode("ascii", errors="replace")
+                keyword = card[0:8].rstrip()
+                if first_card:
+                    first_card = False
+                    expected = "SIMPLE" if must_be_primary else "XTENSION"
+                    if keyword != expected:
+                        raise ValueError(f"Not a FITS header: starts with \"{keyword}\"")
+                if keyword == "END":
+                    return result
+                if card[8:10] != "= " or keyword in result:
+                    continue
+                if wanted is not None and keyword not in wanted:
+                    continue
+                result[keyword] = cls.parse_value(card[10:])
+        raise ValueError("No END card found in FITS header")
+
+    @classmethod
+    def parse_value(cls, value_field: str):
+        """
+        Convert the value field of a header card (everything after the "= ") to a python value
+        :param value_field:     Text of the card following the value indicator
+        :return:                String, bool, int, or float value; None if the value is undefined
+        """
+        text = value_field.lstrip()
+        if text.startswith("'"):
+            # Character string; a doubled quote represents a quote character
+            characters: [str] = []
+            index = 1
+            while index < len(text):
+                character = text[index]
+                if character == "'":
+                    if index + 1 < len(text) and text[index + 1] == "'":
+                        characters.append("'")
+                        index += 2
+                        continue
+                    break
+                characters.append(character)
+                index += 1
+            return "".join(characters).rstrip()
+        # Anything else ends at the comment delimiter
+        slash = text.find("/")
+        if slash >= 0:
+            text = text[0:slash]
+        text = text.strip()
+        if text == "":
+            return None
+        if text == "T":
+            return True
+        if text == "F":
+            return False
+        if cls._integer_pattern.match(text):
+            return int(text)
+        try:
+            return float(text.replace("D", "E").replace("d", "e"))
+        except ValueError:
+            raise ValueError(f"Unable to parse FITS header value \"{text}\"")
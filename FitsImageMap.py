@@ -0,0 +1,263 @@
+#
+#   Memory-mapped access to the image data of a FITS file.
+#
+#   The header is parsed once, when the object is created, to find where the image data starts
+#   in the file and how it is stored (BITPIX) and scaled (BZERO, BSCALE, BLANK).  After that,
+#   rows of the image are obtained as zero-copy views of the file contents through a memory map,
+#   and the scaling is applied only to the rows actually requested.  This avoids decoding the
+#   whole file and making a full floating-point copy of it before any math can start.
+#
+#   The scaling rules are the same ones astropy uses when it reads image data, so the values
+#   produced are identical to those from fits.open(...)[0].data
+#
+#   Integer data that is unscaled, or only offset to store unsigned values (BZERO = 32768 for 16-bit
+#   data), can also be read as integers, e.g. uint16, for algorithms that only compare and select values.
+#
+#   Compressed files can't be memory-mapped, so their rows are decoded instead, through astropy, when
+#   requested.  Two kinds are read:
+#       Tile-compressed images (e.g. RICE_1, as written by fpack, usually named .fz), stored in a
+#       compressed image extension following an empty primary HDU.  Only the tiles holding the requested
+#       rows are decoded, and the tiles are divided among several threads (the decompression code
+#       releases the interpreter lock), so the decoding keeps up with reading uncompressed files.  When
+#       several files are already being read at once, by a reader pool, each file's tiles are decoded
+#       in its reader thread, rather than multiplying the threads.  Decoding only some of the tiles needs
+#       astropy 5.3 or later; with earlier versions the whole image is decoded for each band read.
+#       Whole-file gzip compression (.fits.gz).  The file can only be decompressed from the start, so
+#       each band read decompresses up to the band; combining in many bands re-reads the file.
+#
+import math
+import os
+from typing import Optional
+
+import numpy
+from astropy.io import fits
+from numpy.core.multiarray import ndarray
+
+from ReaderPool import ReaderPool
+
+
+class FitsImageMap:
+
+    # How each BITPIX value is stored in the file.  FITS data is always big-endian.
+    RAW_DTYPES = {8: ">u1", 16: ">i2", 32: ">i4", 64: ">i8", -32: ">f4", -64: ">f8"}
+
+    # Can the rows of a tile-compressed image be decoded without decoding the whole image? (astropy 5.3 or later)
+    TILE_SECTIONS = hasattr(fits.CompImageHDU, "section")
+
+    def __init__(self, file_name: str):
+        """
+        Examine the given FITS file and remember where and how its image is stored
+        Exceptions thrown:
+            ValueError      The file contains no image
+        :param file_name:   Path to FITS file
+        """
+        self._file_name = file_name
+        with fits.open(file_name, do_not_scale_image_data=True) as hdul:
+            self._hdu_index = self.image_hdu_index(hdul)
+            image = hdul[self._hdu_index]
+            header = image.header
+            self._bitpix: int = header["BITPIX"]
+            self._bzero = header.get("BZERO", 0)
+            self._bscale = header.get("BSCALE", 1)
+            self._blank = header.get("BLANK") if self._bitpix > 0 else None
+            self._shape: (int, int) = image.shape
+            file_info = hdul.fileinfo(self._hdu_index)
+            self._data_offset: int = file_info["datLoc"]
+            self._tile_compressed = isinstance(image, fits.CompImageHDU)
+            self._tile_rows: int = int(image.tile_shape[0]) if self._tile_compressed and self.TILE_SECTIONS else 0
+            self._memory_mappable = not self._tile_compressed and file_info["file"].compression is None
+        self._raw_dtype = numpy.dtype(self.RAW_DTYPES[self._bitpix])
+
+    @classmethod
+    def image_hdu_index(cls, hdul: fits.HDUList) -> int:
+        """
+        Find the HDU holding a file's image: the primary HDU, unless it is empty and the image
+        is in an extension (as in tile-compressed files)
+        Exceptions thrown:
+            ValueError      The file contains no image
+        :param hdul:    Opened FITS file
+        :return:        Index of the image HDU
+        """
+        for (index, hdu) in enumerate(hdul):
+            if hdu.is_image and hdu.header.get("NAXIS", 0) > 0:
+                return index
+        raise ValueError(f"No image in FITS file \"{hdul.filename()}\"")
+
+    def get_file_name(self) -> str:
+        return self._file_name
+
+    def get_shape(self) -> (int, int):
+        """
+        Get the dimensions of the image, in numpy (rows, columns) order
+        """
+        return self._shape
+
+    def get_raw_dtype(self) -> numpy.dtype:
+        return self._raw_dtype
+
+    def get_bzero(self):
+        return self._bzero
+
+    def get_bscale(self):
+        return self._bscale
+
+    def is_pseudo_unsigned(self) -> bool:
+        """
+        Determine if the file uses the FITS convention of storing unsigned integers as signed
+        integers offset by BZERO (e.g. 16-bit camera data stored with BZERO = 32768)
+        """
+        if self._bscale != 1:
+            return False
+        if self._bitpix == 8:
+            return self._bzero == -128
+        return self._bitpix > 8 and self._bzero == 1 << (self._bitpix - 1)
+
+    def get_integer_dtype(self) -> Optional[numpy.dtype]:
+        """
+        Get the native integer type that holds this file's physical (scaled) values exactly, if there is one.
+        That is the case for integer data that is either unscaled, or offset by the pseudo-unsigned BZERO,
+        e.g. 16-bit camera data becomes uint16.
+        :return:    numpy integer type, or None if the values need floating point
+        """
+        if self._bitpix < 0 or self._bscale != 1:
+            return None
+        bits = abs(self._bitpix)
+        if self._bzero == 0:
+            return numpy.dtype(numpy.uint8) if bits == 8 else numpy.dtype(f"int{bits}")
+        if self.is_pseudo_unsigned():
+            return numpy.dtype(numpy.int8) if bits == 8 else numpy.dtype(f"uint{bits}")
+        return None
+
+    def is_compressed(self) -> bool:
+        return not self._memory_mappable
+
+    def is_data_complete(self) -> bool:
+        """
+        Determine if the file holds all the image data its header declares (it may not, if it was
+        truncated while being written or copied).  Only uncompressed files can be checked this cheaply;
+        compressed files are assumed complete, and a truncated one fails when it is decoded.
+        """
+        if not self._memory_mappable:
+            return True
+        (rows, columns) = self._shape
+        return os.path.getsize(self._file_name) >= self._data_offset + rows * columns * self._raw_dtype.itemsize
+
+    def raw_rows(self, first_row: int, end_row: int) -> ndarray:
+        """
+        Get the stored (unscaled) values of the given rows.  For an uncompressed file this is a
+        zero-copy view of the file contents; a compressed file's rows are decoded.
+        :param first_row:   Index of first row wanted
+        :param end_row:     Index one past the last row wanted
+        :return:            2-dimensional matrix (read-only, if mapped onto the file contents)
+        """
+        (rows, columns) = self._shape
+        assert 0 <= first_row <= end_row <= rows
+        if not self._memory_mappable:
+            return self.decode_rows(first_row, end_row)
+        return numpy.memmap(self._file_name, dtype=self._raw_dtype, mode="r",
+                            offset=self._data_offset + first_row * columns * self._raw_dtype.itemsize,
+                            shape=(end_row - first_row, columns))
+
+    def decode_rows(self, first_row: int, end_row: int) -> ndarray:
+        """
+        Decompress the stored values of the given rows of a compressed file.  For a tile-compressed
+        image, the rows are divided into runs of whole tiles, decoded concurrently, unless this is
+        already one of a reader pool's threads (several files are being read at once).  If astropy
+        can't decode part of a tile-compressed image, the whole image is decoded.
+        :param first_row:   Index of first row wanted
+        :param end_row:     Index one past the last row wanted
+        :return:            2-dimensional matrix of the stored values
+        """
+        with fits.open(self._file_name, do_not_scale_image_data=True) as hdul:
+            image = hdul[self._hdu_index]
+            if self._tile_compressed and not self.TILE_SECTIONS:
+                # Copy the rows, so the rest of the decoded image can be released
+                return numpy.array(image.data[first_row:end_row])
+            runs = self.tile_runs(first_row, end_row) \
+                if self._tile_compressed and not ReaderPool.in_worker_thread() else [(first_row, end_row)]
+            if len(runs) == 1:
+                return image.section[first_row:end_row]
+            # Load the table of compressed tiles once, rather than in each thread
+            _ = image.compressed_data
+            result = numpy.empty((end_row - first_row, self._shape[1]), dtype=self._raw_dtype.newbyteorder("="))
+
+            def decode_run(run: (int, int)):
+                (run_first, run_end) = run
+                result[run_first - first_row:run_end - first_row] = image.section[run_first:run_end]
+
+            ReaderPool(len(runs)).map_in_order(decode_run, runs)
+            return result
+
+    def tile_runs(self, first_row: int, end_row: int) -> [(int, int)]:
+        """
+        Divide a range of rows of a tile-compressed image into runs of whole tiles, one run for each of
+        the threads decoding them (no more threads than there are tiles, nor than automatic reading uses)
+        :param first_row:   Index of first row wanted
+        :param end_row:     Index one past the last row wanted
+        :return:            List of (first row, end row) of each run
+        """
+        first_tile = first_row // self._tile_rows
+        end_tile = math.ceil(end_row / self._tile_rows)
+        number_runs = max(1, min(ReaderPool.automatic_worker_count(), end_tile - first_tile))
+        tiles_per_run = math.ceil((end_tile - first_tile) / number_runs)
+        result: [(int, int)] = []
+        for run_first_tile in range(first_tile, end_tile, tiles_per_run):
+            run_first = max(first_row, run_first_tile * self._tile_rows)
+            run_end = min(end_row, (run_first_tile + tiles_per_run) * self._tile_rows)
+            result.append((run_first, run_end))
+        return result
+
+    def read_rows(self, first_row: int, end_row: int, out: ndarray = None) -> ndarray:
+        """
+        Get the physical (scaled) values of the given rows as floating point numbers
+        :param first_row:   Index of first row wanted
+        :param end_row:     Index one past the last row wanted
+        :param out:         Optional 2-dimensional matrix to receive the values
+        :return:            2-dimensional matrix of pixel values (out, if it was given)
+        """
+        raw_data = self.raw_rows(first_row, end_row)
+        if out is None:
+            out = numpy.empty(raw_data.shape)
+        if self._bzero == 0 and self._bscale == 1:
+            # No scaling in use, values are just converted
+            out[...] = raw_data
+        elif self.is_pseudo_unsigned():
+            # Offset integers; exact in floating point
+            out[...] = raw_data
+            out += self._bzero
+        else:
+            # General scaling.  Astropy does this arithmetic in single precision for 8 and 16-bit
+            # data, and we do the same so that the results are identical
+            working_dtype = numpy.float32 if 0 < self._bitpix <= 16 else numpy.float64
+            if self._bitpix < 0:
+                working_dtype = raw_data.dtype.newbyteorder("=")
+            scaled = numpy.array(raw_data, dtype=working_dtype)
+            if self._bscale != 1:
+                numpy.multiply(scaled, self._bscale, scaled)
+            if self._bzero != 0:
+                scaled += self._bzero
+            if self._blank is not None:
+                scaled[raw_data == self._blank] = numpy.nan
+            out[...] = scaled
+        del raw_data
+        return out
+
+    def read_integer_rows(self, first_row: int, end_row: int, out: ndarray) -> ndarray:
+        """
+        Get the physical values of the given rows as integers, without converting to floating point.
+        Only for files that have an integer type (see get_integer_dtype).
+        :param first_row:   Index of first row wanted
+        :param end_row:     Index one past the last row wanted
+        :param out:         2-dimensional matrix to receive the values, of this file's integer type or a wider one
+        :return:            out
+        """
+        assert self.get_integer_dtype() is not None
+        assert numpy.can_cast(self.get_integer_dtype(), out.dtype)
+        raw_data = self.raw_rows(first_row, end_row)
+        out[...] = raw_data
+        if self._bzero != 0:
+            # Offset integers.  Where out has only the width of the stored values, both the conversion
+            # above and this addition wrap around, and the result is the exact physical value.
+            out += int(self._bzero)
+        del raw_data
+        return out
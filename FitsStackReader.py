@@ -0,0 +1,146 @@
+#
+#   Reader that gives access to the same band of rows from every file in a stack of FITS images.
+#   The combination algorithms use this to work on one horizontal band of the image at a time,
+#   so the whole stack of frames (which can be far larger than memory) never has to be loaded at once.
+#
+#   Each file's header is read once, when the reader is created.  Bands are then taken from
+#   memory-mapped views of the files, with the FITS scaling applied only to the rows in the band.
+#   A file's memory map is released as soon as its rows are copied, so we never hold more than
+#   one open file at a time; large groups of files would otherwise exceed the operating system's
+#   open-file limit.  Several files' rows are read concurrently, using a pool of reader threads.
+#
+from typing import Iterator, Optional
+
+import numpy
+from numpy.core.multiarray import ndarray
+
+import MasterMakerExceptions
+from FitsImageMap import FitsImageMap
+from Instrumentation import Instrumentation
+from ReaderPool import ReaderPool
+from SessionController import SessionController
+
+
+class FitsStackReader:
+
+    def __init__(self, file_names: [str],
+                 reader_workers: int = 1,
+                 session_controller: Optional[SessionController] = None):
+        """
+        Initialize the reader for the given list of files, examining each file's header.
+        Exceptions thrown:
+            IncompatibleSizes       The files do not all have the same dimensions
+
+        :param file_names:          Paths of the FITS files making up the stack
+        :param reader_workers:      Number of files to read concurrently (0 to choose automatically)
+        :param session_controller:  Optional controller for this subtask, for cancellation and progress
+        """
+        assert len(file_names) > 0
+        self._file_names = file_names
+        self._reader_pool = ReaderPool(reader_workers)
+        self._session_controller = session_controller
+        with Instrumentation.stage(Instrumentation.STAGE_PIXEL_READ):
+            self._image_maps: [FitsImageMap] = self._reader_pool.map_in_order(FitsImageMap, file_names,
+                                                                              session_controller)
+        (self._rows, self._columns) = self._image_maps[0].get_shape()
+        for image_map in self._image_maps:
+            if image_map.get_shape() != (self._rows, self._columns):
+                raise MasterMakerExceptions.IncompatibleSizes
+
+    def get_number_files(self) -> int:
+        return len(self._file_names)
+
+    def get_dimensions(self) -> (int, int):
+        """
+        Get the dimensions of the images in the stack, in numpy (rows, columns) order
+        :return:    Tuple of number of rows and number of columns
+        """
+        return self._rows, self._columns
+
+    def get_image_maps(self) -> [FitsImageMap]:
+        return self._image_maps
+
+    def get_integer_dtype(self) -> Optional[numpy.dtype]:
+        """
+        Get the integer type that holds the physical values of every file in the stack exactly, if there is one
+        (e.g. uint16 for 16-bit camera data; a wider type if files are stored differently)
+        :return:    numpy integer type, or None if any file's values need floating point
+        """
+        integer_dtypes = [image_map.get_integer_dtype() for image_map in self._image_maps]
+        if any(integer_dtype is None for integer_dtype in integer_dtypes):
+            return None
+        return numpy.result_type(*integer_dtypes)
+
+    def read_band(self, first_row: int, end_row: int, out: ndarray = None,
+                  dtype: numpy.dtype = numpy.float64) -> ndarray:
+        """
+        Read the given range of rows from every file in the stack.
+        Values are converted to float exactly as astropy converts the image data when it reads a file,
+        so combining the bands gives the same result as combining the whole images.
+        If the band's type is an integer type (which must be get_integer_dtype or wider), the
+        physical values are read as integers instead.
+
+        :param first_row:   Index of first row to be read
+        :param end_row:     Index one past the last row to be read
+        :param out:         Optional 3-dimensional matrix to receive the band (e.g. a re-used buffer)
+        :param dtype:       Floating point or integer type of the band, if out is not given
+        :return:            3-dimensional matrix: one layer per file, each layer the band of rows
+        """
+        assert 0 <= first_row < end_row <= self._rows
+        if out is None:
+            out = numpy.empty((len(self._file_names), end_row - first_row, self._columns), dtype=dtype)
+        read_integers = numpy.issubdtype(out.dtype, numpy.integer)
+
+        def read_layer(index: int) -> ndarray:
+            image_map = self._image_maps[index]
+            if read_integers:
+                return image_map.read_integer_rows(first_row, end_row, out[index])
+            return image_map.read_rows(first_row, end_row, out=out[index])
+
+        with Instrumentation.stage(Instrumentation.STAGE_PIXEL_READ):
+            self._reader_pool.map_in_order(read_layer, range(len(self._image_maps)), self._session_controller)
+        return out
+
+    @classmethod
+    def stream_frames(cls, file_names: [str],
+                      reader_workers: int = 1,
+                      session_controller: Optional[SessionController] = None,
+                      dtype: numpy.dtype = numpy.float64) -> Iterator[ndarray]:
+        """
+        Read the given files one whole frame at a time, in order.  A few files are read ahead
+        concurrently, so the number of frames in memory at once is small and doesn't depend on
+        the number of files.
+        Exceptions thrown:
+            IncompatibleSizes       The files do not all have the same dimensions
+            SessionCancelled        The session controller reports that we have been cancelled
+
+        :param file_names:          Paths of the FITS files
+        :param reader_workers:      Number of files to read concurrently (0 to choose automatically)
+        :param session_controller:  Optional controller for this subtask, for cancellation and progress
+        :param dtype:               Floating point or integer type of the frames (an integer type must
+                                    be get_integer_dtype of the files, or wider)
+        :return:                    Iterator of 2-dimensional matrices of pixel values
+        """
+        read_integers = numpy.issubdtype(dtype, numpy.integer)
+
+        def read_frame(file_name: str) -> ndarray:
+            image_map = FitsImageMap(file_name)
+            (rows, columns) = image_map.get_shape()
+            frame = numpy.empty((rows, columns), dtype=dtype)
+            if read_integers:
+                return image_map.read_integer_rows(0, rows, frame)
+            return image_map.read_rows(0, rows, out=frame)
+
+        first_shape = None
+        frames = ReaderPool(reader_workers).imap_in_order(read_frame, file_names, session_controller)
+        while True:
+            # Time spent waiting for the next frame is reading time
+            with Instrumentation.stage(Instrumentation.STAGE_PIXEL_READ):
+                frame = next(frames, None)
+            if frame is None:
+                return
+            if first_shape is None:
+                first_shape = frame.shape
+            elif frame.shape != first_shape:
+                raise MasterMakerExceptions.IncompatibleSizes
+            yield frame
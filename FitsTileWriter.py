@@ -0,0 +1,194 @@
+#
+#   Writer of a 16-bit FITS image file that receives the image a band of rows (a "tile") at a time.
+#
+#   The header is written first, then each tile is converted to 16-bit big-endian integers and written
+#   as soon as it is given, so neither a whole-image integer copy nor a second pass over the data for
+#   the checksums is needed.  The FITS checksums (DATASUM for the data, CHECKSUM for the whole HDU,
+#   see the FITS checksum convention) are accumulated as the tiles are written; when the last tile is
+#   in, the data is padded to a whole FITS block and the header, now with the checksums, is written
+#   again over the original (it is the same size).
+#
+#   The file is written under a temporary name in the destination directory, and renamed to its real
+#   name only when complete, so a reader never sees a partly-written master, and an existing file of
+#   the same name is replaced in one step.
+#
+#   Values are rounded to integers, and stored either as signed 16-bit integers or, with BZERO = 32768,
+#   as unsigned 16-bit integers (0 to 65535, the range of camera data).  Values outside the range of the
+#   chosen type are clipped to it.
+#
+import os
+import uuid
+from datetime import datetime
+from typing import Optional
+
+import numpy
+from astropy.io import fits
+from numpy.core.multiarray import ndarray
+
+
+class FitsTileWriter:
+
+    # Length of a FITS block; the header and the data are each padded to a whole number of blocks
+    BLOCK_BYTES = 2880
+
+    # Offset of stored values from physical values for unsigned 16-bit output
+    UNSIGNED_BZERO = 32768
+
+    # Value the CHECKSUM keyword has while the HDU's sum is calculated
+    CHECKSUM_PLACEHOLDER = "0" * 16
+
+    def __init__(self, path: str, shape: (int, int), header: fits.Header, unsigned: bool = False):
+        """
+        Start writing a new FITS file
+        :param path:        Path of the file; an existing file is replaced when writing finishes
+        :param shape:       Dimensions of the image, in numpy (rows, columns) order
+        :param header:      Descriptive header cards (the structural cards are supplied here)
+        :param unsigned:    Store unsigned 16-bit values (BZERO = 32768) rather than signed ones
+        """
+        (rows, columns) = shape
+        self._path = path
+        self._shape = (rows, columns)
+        self._unsigned = unsigned
+        self._rows_written = 0
+        # Ones' complement sums of the even and odd 16-bit halves of the data's 32-bit words
+        self._high_halves_sum = 0
+        self._low_halves_sum = 0
+        self._header = self.make_header(shape, header, unsigned)
+        (directory, file_name) = os.path.split(os.path.abspath(path))
+        self._temporary_path: Optional[str] = os.path.join(directory, f".{file_name}.{uuid.uuid4().hex}.tmp")
+        self._file = open(self._temporary_path, "w+b")
+        self._file.write(self._header.tostring().encode("ascii"))
+
+    @classmethod
+    def make_header(cls, shape: (int, int), header: fits.Header, unsigned: bool) -> fits.Header:
+        """
+        Make the complete header: structural cards, then the given cards, then placeholder checksums
+        :param shape:       Dimensions of the image, in numpy (rows, columns) order
+        :param header:      Descriptive header cards
+        :param unsigned:    Unsigned 16-bit values are stored
+        :return:            The header
+        """
+        (rows, columns) = shape
+        result = fits.Header()
+        result["SIMPLE"] = (True, "conforms to FITS standard")
+        result["BITPIX"] = (16, "array data type")
+        result["NAXIS"] = (2, "number of array dimensions")
+        result["NAXIS1"] = columns
+        result["NAXIS2"] = rows
+        result["EXTEND"] = True
+        if unsigned:
+            result["BZERO"] = cls.UNSIGNED_BZERO
+            result["BSCALE"] = 1
+        result.extend(header)
+        result["CHECKSUM"] = (cls.CHECKSUM_PLACEHOLDER, "HDU checksum")
+        result["DATASUM"] = ("0", "data unit checksum")
+        return result
+
+    def get_path(self) -> str:
+        return self._path
+
+    def write_tile(self, tile: ndarray):
+        """
+        Write the next band of rows of the image
+        :param tile:    2-dimensional matrix of pixel values: some number of whole rows, following those written
+        """
+        (rows, columns) = self._shape
+        assert tile.ndim == 2 and tile.shape[1] == columns
+        assert self._rows_written + tile.shape[0] <= rows
+        (low, high) = (0, 65535) if self._unsigned else (-32768, 32767)
+        values = numpy.clip(numpy.round(tile), low, high)
+        if self._unsigned:
+            values -= self.UNSIGNED_BZERO
+        stored = values.astype(">i2")
+        self.add_to_data_sum(stored)
+        self._file.write(stored.tobytes())
+        self._rows_written += tile.shape[0]
+
+    def add_to_data_sum(self, stored: ndarray):
+        """
+        Add stored values to the data checksum.  Each 32-bit word of the data is two 16-bit values, so
+        the sum of the words is the sum of the first values of each word, times 2**16, plus the sum of
+        the second values.  Which of a tile's values are "first" depends on the number already written.
+        :param stored:  Matrix of big-endian 16-bit values, as written to the file
+        """
+        halves = stored.view(">u2").ravel()
+        (first, second) = (halves[0::2], halves[1::2])
+        if (self._rows_written * self._shape[1]) % 2 == 1:
+            (first, second) = (second, first)
+        self._high_halves_sum += int(first.sum(dtype=numpy.uint64))
+        self._low_halves_sum += int(second.sum(dtype=numpy.uint64))
+
+    def finish(self):
+        """
+        Complete the file: pad the data, write the header with the checksums, and give the file its real name
+        """
+        assert self._rows_written == self._shape[0]
+        data_bytes = self._shape[0] * self._shape[1] * 2
+        padding = -data_bytes % self.BLOCK_BYTES
+        if padding > 0:
+            self._file.write(bytes(padding))  # Zeros, which leave the checksums unchanged
+        data_sum = self.fold_sum((self._high_halves_sum << 16) + self._low_halves_sum)
+        time_stamp = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        self._header["DATASUM"] = (str(data_sum), f"data unit checksum updated {time_stamp}")
+        self._header["CHECKSUM"] = (self.CHECKSUM_PLACEHOLDER, f"HDU checksum updated {time_stamp}")
+        header_words = numpy.frombuffer(self._header.tostring().encode("ascii"), dtype=">u4")
+        header_sum = self.fold_sum(int(header_words.sum(dtype=numpy.uint64)))
+        hdu_sum = self.fold_sum(header_sum + data_sum)
+        self._header["CHECKSUM"] = self.encode_checksum(~hdu_sum & 0xFFFFFFFF)
+        header_bytes = self._header.tostring().encode("ascii")
+        assert len(header_bytes) % self.BLOCK_BYTES == 0
+        self._file.seek(0)
+        self._file.write(header_bytes)
+        self._file.close()
+        os.replace(self._temporary_path, self._path)
+        self._temporary_path = None
+
+    def abandon(self):
+        """
+        Stop writing, and remove the partly-written file.  (The file at the real path, if any, is untouched.)
+        """
+        if self._temporary_path is not None:
+            self._file.close()
+            os.remove(self._temporary_path)
+            self._temporary_path = None
+
+    @classmethod
+    def fold_sum(cls, value: int) -> int:
+        """
+        Reduce a sum of 32-bit words to their 32-bit ones' complement sum, by adding the carries back in
+        :param value:   Sum (of any size)
+        :return:        32-bit ones' complement sum
+        """
+        while value > 0xFFFFFFFF:
+            value = (value & 0xFFFFFFFF) + (value >> 32)
+        return value
+
+    @classmethod
+    def encode_checksum(cls, value: int) -> str:
+        """
+        Encode a 32-bit checksum as the 16 ASCII characters of the CHECKSUM keyword (the FITS checksum
+        convention): each byte becomes four printable characters with the same sum, avoiding punctuation,
+        and the result is rotated right by one character
+        :param value:   32-bit value (the complement of the HDU's sum)
+        :return:        16-character string
+        """
+        offset = 0x30  # "0"
+        excluded = list(range(0x3A, 0x41)) + list(range(0x5B, 0x61))
+        characters = [0] * 16
+        for byte_index in range(4):
+            byte = (value >> (24 - 8 * byte_index)) & 0xFF
+            quotient = byte // 4 + offset
+            remainder = byte % 4
+            four = [quotient + remainder, quotient, quotient, quotient]
+            adjusted = True
+            while adjusted:
+                adjusted = False
+                for pair_index in (0, 2):
+                    if four[pair_index] in excluded or four[pair_index + 1] in excluded:
+                        four[pair_index] += 1
+                        four[pair_index + 1] -= 1
+                        adjusted = True
+            for (character_index, character) in enumerate(four):
+                characters[4 * character_index + byte_index] = character
+        encoded = bytes(characters).decode("ascii")
+        return encoded[-1] + encoded[:-1]
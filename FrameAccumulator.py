@@ -0,0 +1,121 @@
+#
+#   Running sum of a sequence of image frames.
+#
+#   A mean combine needs only the sum of the frames, so rather than holding the whole stack in
+#   memory, frames are added into an accumulator one at a time as they are read.  Memory use is
+#   then independent of the number of frames.  Sums are float64 unless another type is requested.
+#
+#   Three ways of summing are offered:
+#       Simple          Add each frame into a single sum.  This is exactly what numpy.mean(axis=0)
+#                       does on a stack, so results are identical to combining the whole stack.
+#       Compensated     Neumaier's variant of Kahan summation: a second frame-sized array collects the
+#                       rounding error of each addition, and is added back at the end.  Error does not
+#                       grow with the number of frames, at the cost of a few temporary frames per addition.
+#       Pairwise        Frames are summed in a balanced binary tree (partial sums of 1, 2, 4, 8... frames
+#                       are merged as soon as two of the same size exist).  Error grows only with the
+#                       logarithm of the number of frames; holds at most log2(n) partial sums.
+#
+#   Frames of integers (e.g. 16-bit camera data) can instead be summed in int64, which is exact: there is no
+#   rounding error to manage, so the summation method doesn't matter, and the mean doesn't depend on the
+#   order the frames are added in.  The only rounding is the one division at the end.
+#
+import numpy
+from numpy.core.multiarray import ndarray
+
+from Constants import Constants
+
+
+class FrameAccumulator:
+
+    def __init__(self, shape: (int, int), summation: int = Constants.SUMMATION_SIMPLE,
+                 dtype: numpy.dtype = numpy.float64):
+        """
+        Initialize an empty accumulator for frames of the given shape
+        :param shape:       Dimensions of the frames, in numpy (rows, columns) order
+        :param summation:   How to sum (Constants.SUMMATION_xxx); ignored for integer sums, which are exact
+        :param dtype:       Floating point type the sums are kept in, or numpy.int64 for exact integer sums
+        """
+        assert summation in (Constants.SUMMATION_SIMPLE, Constants.SUMMATION_COMPENSATED,
+                             Constants.SUMMATION_PAIRWISE)
+        self._shape = tuple(shape)
+        self._summation = Constants.SUMMATION_SIMPLE if self.is_integer_sum(dtype) else summation
+        self._dtype = dtype
+        self._count = 0
+        self._sum: ndarray = numpy.zeros(self._shape, dtype=dtype)
+        self._compensation: ndarray = numpy.zeros(self._shape, dtype=dtype) \
+            if self._summation == Constants.SUMMATION_COMPENSATED else None
+        # For pairwise summation, a stack of (number of frames, partial sum), largest at the bottom
+        self._partial_sums: [(int, ndarray)] = []
+
+    def get_shape(self) -> (int, int):
+        return self._shape
+
+    def get_count(self) -> int:
+        return self._count
+
+    @classmethod
+    def is_integer_sum(cls, dtype: numpy.dtype) -> bool:
+        return numpy.issubdtype(dtype, numpy.integer)
+
+    def add(self, frame: ndarray):
+        """
+        Add one frame to the running sum.  The frame is not retained, so its buffer may be re-used.
+        :param frame:   2-dimensional matrix of pixel values, the same shape as the accumulator (and
+                        integers, of 32 bits or fewer, if the sums are integers)
+        """
+        assert frame.shape == self._shape
+        self._count += 1
+        if self._summation == Constants.SUMMATION_SIMPLE:
+            self._sum += frame
+        elif self._summation == Constants.SUMMATION_COMPENSATED:
+            self.add_compensated(frame)
+        else:
+            self.add_pairwise(frame)
+
+    def add_compensated(self, frame: ndarray):
+        """
+        Neumaier summation: whichever of the sum and the new value is larger in magnitude, the low-order
+        bits of the smaller one lost in the addition are recovered and saved in the compensation array
+        :param frame:   Frame to be added
+        """
+        new_sum = self._sum + frame
+        sum_is_larger = numpy.abs(self._sum) >= numpy.abs(frame)
+        self._compensation += numpy.where(sum_is_larger, (self._sum - new_sum) + frame, (frame - new_sum) + self._sum)
+        self._sum = new_sum
+
+    def add_pairwise(self, frame: ndarray):
+        """
+        Push the frame as a partial sum of size 1, then merge equal-sized partial sums, like carrying
+        when incrementing a binary number
+        :param frame:   Frame to be added
+        """
+        self._partial_sums.append((1, numpy.array(frame, dtype=self._dtype)))
+        while len(self._partial_sums) >= 2 and self._partial_sums[-1][0] == self._partial_sums[-2][0]:
+            (count, partial_sum) = self._partial_sums.pop()
+            (_, previous_sum) = self._partial_sums[-1]
+            previous_sum += partial_sum
+            self._partial_sums[-1] = (2 * count, previous_sum)
+
+    def get_sum(self) -> ndarray:
+        """
+        Get the sum of all the frames added so far
+        :return:    2-dimensional matrix of pixel sums
+        """
+        if self._summation == Constants.SUMMATION_SIMPLE:
+            return self._sum
+        elif self._summation == Constants.SUMMATION_COMPENSATED:
+            return self._sum + self._compensation
+        else:
+            # Add the remaining partial sums from smallest to largest
+            result = numpy.zeros(self._shape, dtype=self._dtype)
+            for (_, partial_sum) in reversed(self._partial_sums):
+                result += partial_sum
+            return result
+
+    def get_mean(self) -> ndarray:
+        """
+        Get the mean of all the frames added so far
+        :return:    2-dimensional matrix of pixel means (float64, if the sums are integers)
+        """
+        assert self._count > 0
+        return numpy.true_divide(self.get_sum(), self._count)
@@ -0,0 +1,61 @@
+#
+#   Running per-pixel mean and variance of a sequence of image frames.
+#
+#   Uses Welford's online algorithm, which updates the mean and the sum of squared deviations
+#   from the mean as each frame arrives.  Unlike accumulating the sum and the sum of squares,
+#   it does not lose precision by subtracting two large, nearly equal numbers, so it is safe
+#   for bias frames where the values are large and the variation between frames is small.
+#
+#   Memory use is three frame-sized arrays (count is shared), no matter how many frames are added.
+#
+import numpy
+from numpy.core.multiarray import ndarray
+
+
+class FrameStatistics:
+
+    def __init__(self, shape: (int, int), dtype: numpy.dtype = numpy.float64):
+        """
+        Initialize empty statistics for frames of the given shape
+        :param shape:   Dimensions of the frames, in numpy (rows, columns) order
+        :param dtype:   Floating point type the statistics are kept in
+        """
+        self._shape = tuple(shape)
+        self._count = 0
+        self._mean: ndarray = numpy.zeros(self._shape, dtype=dtype)
+        self._squared_deviations: ndarray = numpy.zeros(self._shape, dtype=dtype)
+        self._delta: ndarray = numpy.empty(self._shape, dtype=dtype)
+
+    def get_shape(self) -> (int, int):
+        return self._shape
+
+    def get_count(self) -> int:
+        return self._count
+
+    def add(self, frame: ndarray):
+        """
+        Update the statistics with one more frame.  The frame is not retained.
+        :param frame:   2-dimensional matrix of pixel values, the same shape as the statistics
+        """
+        assert frame.shape == self._shape
+        self._count += 1
+        # delta = x - old mean;  mean += delta / n;  M2 += delta * (x - new mean)
+        numpy.subtract(frame, self._mean, out=self._delta)
+        self._mean += self._delta / self._count
+        self._delta *= frame - self._mean
+        self._squared_deviations += self._delta
+
+    def get_mean(self) -> ndarray:
+        """
+        Get the mean of each pixel over all the frames added so far
+        """
+        assert self._count > 0
+        return self._mean
+
+    def get_standard_deviation(self) -> ndarray:
+        """
+        Get the population standard deviation (as numpy.std calculates by default) of each pixel
+        over all the frames added so far
+        """
+        assert self._count > 0
+        return numpy.sqrt(self._squared_deviations / self._count)
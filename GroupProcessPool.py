@@ -0,0 +1,198 @@
+#
+#   Pool of worker processes used to combine several independent groups of files at once.
+#
+#   When files are grouped (by size, temperature) each group produces its own master file and
+#   shares no data with the others, so the groups can be combined in parallel.  The combination
+#   math holds the interpreter lock for much of its time, so separate processes (rather than threads)
+#   are used to get all the processor cores working.
+#
+#   Processes are started with the "spawn" method on every platform, so behaviour is the same on
+#   Windows, macOS and Linux, and no threads (e.g. from the GUI) are duplicated into the workers.
+#   Results are delivered in the same order the work was submitted.  When a piece of work fails, the work
+#   not yet started is cancelled, but the work already running is allowed to finish and its results are
+#   still delivered, since it may already have written files.
+#
+#   Cancellation is passed to the workers through an event shared with them when they start.
+#   Code running in a worker gets a session controller watching that event from
+#   make_worker_session_controller, so the usual cancellation checks work unchanged.
+#
+#   A long-running program (the combine daemon) can keep a set of worker processes running between
+#   uses (keep_workers), so each job doesn't pay for starting them and importing the libraries.  Since
+#   those workers start before the work is known, each piece of work is then sent with its own
+#   cancellation event, made by a manager process so it can be passed to a running worker.
+#
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterator, Optional
+
+from MultiOsUtil import MultiOsUtil
+from SessionController import SessionController
+
+
+class GroupProcessPool:
+
+    # How often, while waiting for a worker, we check whether the user has cancelled
+    CANCELLATION_POLL_SECONDS = 0.25
+
+    # Set in each worker process when it starts (or, for kept workers, when each piece of work starts)
+    _worker_cancel_event = None
+
+    # Worker processes kept running between uses, and the manager making their cancellation events
+    _kept_executor = None
+    _kept_manager = None
+    _kept_lock = threading.Lock()
+
+    def __init__(self, number_workers: int):
+        """
+        Initialize the pool
+        :param number_workers:  Number of worker processes
+        """
+        assert number_workers > 0
+        self._number_workers = number_workers
+
+    @classmethod
+    def automatic_worker_count(cls, number_groups: int, bytes_per_group: int) -> int:
+        """
+        Number of worker processes to use when the user hasn't specified one: one per group, but no more
+        than there are processors, or than will fit in the memory currently available
+        :param number_groups:       Number of groups to be processed
+        :param bytes_per_group:     Estimate of memory needed to combine one group
+        :return:                    Number of workers, at least 1
+        """
+        fit_in_memory = MultiOsUtil.available_memory_bytes() // max(1, bytes_per_group)
+        return max(1, min(number_groups, os.cpu_count() or 1, fit_in_memory))
+
+    @classmethod
+    def initialize_worker(cls, cancel_event):
+        """
+        Called in each worker process as it starts, to remember the shared cancellation event
+        :param cancel_event:    Event that will be set if the work is cancelled
+        """
+        cls._worker_cancel_event = cancel_event
+
+    @classmethod
+    def run_in_kept_worker(cls, cancel_event, function: Callable, *arguments):
+        """
+        Called in a kept worker process to do one piece of work, watching the given cancellation event
+        :param cancel_event:    Event that will be set if this work is cancelled
+        :param function:        Function to be run
+        :param arguments:       Arguments for the function
+        :return:                Result of the function
+        """
+        cls._worker_cancel_event = cancel_event
+        return function(*arguments)
+
+    @classmethod
+    def keep_workers(cls, number_workers: int):
+        """
+        Start worker processes that are kept running, and used for all later work instead of
+        starting processes each time.  They run at most the given number of groups at once,
+        whatever number of workers a pool was given.
+        :param number_workers:  Number of worker processes to keep
+        """
+        assert number_workers > 0
+        context = multiprocessing.get_context("spawn")
+        with cls._kept_lock:
+            cls.shutdown_kept_workers_locked()
+            cls._kept_manager = context.Manager()
+            cls._kept_executor = ProcessPoolExecutor(max_workers=number_workers, mp_context=context)
+
+    @classmethod
+    def shutdown_kept_workers(cls):
+        """
+        Stop the kept worker processes, if any; later work starts its own processes again
+        """
+        with cls._kept_lock:
+            cls.shutdown_kept_workers_locked()
+
+    @classmethod
+    def shutdown_kept_workers_locked(cls):
+        if cls._kept_executor is not None:
+            cls._kept_executor.shutdown(wait=True)
+            cls._kept_manager.shutdown()
+            cls._kept_executor = None
+            cls._kept_manager = None
+
+    @classmethod
+    def make_worker_session_controller(cls) -> SessionController:
+        """
+        Make a session controller, for use in a worker process, that reports cancellation of the pool's work
+        """
+        return SessionController(cls._worker_cancel_event)
+
+    def imap_in_order(self, function: Callable,
+                      argument_lists: [tuple],
+                      session_controller: SessionController,
+                      is_failure: Optional[Callable] = None) -> Iterator:
+        """
+        Run the given function in the worker processes, once for each list of arguments, and deliver
+        the results in order as they become available.  The function and arguments must be picklable.
+        If the session controller reports cancellation while we wait, the workers are told to stop;
+        the function is expected to notice that and return (or raise) promptly.
+
+        :param function:            Function to be run (a module-level function or a classmethod)
+        :param argument_lists:      One tuple of arguments for each call
+        :param session_controller:  Controller for this subtask, checked for cancellation while waiting
+        :param is_failure:          Optional function telling if a result is a failure; the work not yet
+                                    started is then cancelled
+        :return:                    Iterator of the function's results, in the order of the argument lists
+                                    (None for work cancelled after a failure)
+        """
+        with self._kept_lock:
+            (kept_executor, kept_manager) = (self._kept_executor, self._kept_manager)
+        if kept_executor is not None:
+            cancel_event = kept_manager.Event()
+            futures = [kept_executor.submit(GroupProcessPool.run_in_kept_worker, cancel_event, function, *arguments)
+                       for arguments in argument_lists]
+            yield from self.results_in_order(futures, cancel_event, session_controller, is_failure)
+        else:
+            context = multiprocessing.get_context("spawn")
+            cancel_event = context.Event()
+            with ProcessPoolExecutor(max_workers=self._number_workers, mp_context=context,
+                                     initializer=GroupProcessPool.initialize_worker,
+                                     initargs=(cancel_event,)) as executor:
+                futures = [executor.submit(function, *arguments) for arguments in argument_lists]
+                yield from self.results_in_order(futures, cancel_event, session_controller, is_failure)
+
+    def results_in_order(self, futures: [concurrent.futures.Future],
+                         cancel_event,
+                         session_controller: SessionController,
+                         is_failure: Optional[Callable] = None) -> Iterator:
+        """
+        Deliver the results of the given work, in order, telling the workers to stop if cancelled.
+        After a failure, the work not yet started is cancelled, and None is delivered in its place;
+        the work already running or finished is still delivered.
+        :param futures:             Futures of the work submitted to the workers
+        :param cancel_event:        Event the workers watch for cancellation
+        :param session_controller:  Controller for this subtask, checked for cancellation while waiting
+        :param is_failure:          Optional function telling if a result is a failure
+        :return:                    Iterator of the results
+        """
+        failed = False
+        try:
+            for future in futures:
+                if failed and future.cancelled():
+                    yield None
+                    continue
+                while True:
+                    try:
+                        result = future.result(timeout=self.CANCELLATION_POLL_SECONDS)
+                        break
+                    except concurrent.futures.TimeoutError:
+                        if session_controller.thread_cancelled():
+                            cancel_event.set()
+                if not failed and is_failure is not None and is_failure(result):
+                    # Work already running may have written files, so let it finish and deliver it
+                    failed = True
+                    for later_future in futures:
+                        later_future.cancel()
+                yield result
+        finally:
+            # If we are leaving early (error, cancellation, or the consumer stopped) stop the
+            # running work and don't start any more
+            cancel_event.set()
+            for future in futures:
+                future.cancel()
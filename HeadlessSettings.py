@@ -0,0 +1,139 @@
+#
+#   Settings storage used when the program runs without its GUI, so command-line runs need not
+#   load Qt.  It reads the preferences the GUI saved (through QSettings) from where QSettings keeps
+#   them on each operating system:
+#       macOS       property list in ~/Library/Preferences
+#       Windows     registry, under HKEY_CURRENT_USER\Software
+#       otherwise   INI file in $XDG_CONFIG_HOME (default ~/.config)
+#   It offers the two QSettings methods the Preferences object uses, value() and setValue().
+#   Saved preferences are only read: a value set here lasts for the rest of the run, and saving
+#   preferences remains the GUI's job.
+#
+#   Values Qt stores in its own encoding (window sizes and positions, "@Variant(...)") are not
+#   decoded, and read as if not present; the command line has no use for them.
+#
+import os
+import sys
+
+
+class HeadlessSettings:
+
+    def __init__(self, organization: str, application: str):
+        """
+        Load the settings saved for the given organization and application
+        :param organization:    Organization name, as given to QSettings
+        :param application:     Application name, as given to QSettings
+        """
+        self._values: {str: object} = {}
+        try:
+            if sys.platform == "darwin":
+                self._values = self.read_property_list(organization, application)
+            elif sys.platform.startswith("win"):
+                self._values = self.read_registry(organization, application)
+            else:
+                self._values = self.read_ini_file(organization, application)
+        except (OSError, ValueError):
+            # Nothing saved yet, or unreadable: every preference takes its default
+            self._values = {}
+
+    def value(self, key: str, defaultValue=None):
+        """
+        Get a setting's value, as QSettings.value does
+        :param key:             Name of the setting
+        :param defaultValue:    Value returned if the setting has not been saved
+        :return:                Saved value, or the default
+        """
+        return self._values.get(key, defaultValue)
+
+    def setValue(self, key: str, value):
+        """
+        Set a setting's value for the rest of this run
+        :param key:     Name of the setting
+        :param value:   New value
+        """
+        self._values[key] = value
+
+    @classmethod
+    def read_property_list(cls, organization: str, application: str) -> {str: object}:
+        """
+        Read the settings QSettings saved on macOS.  The file is named for the organization's internet
+        domain, reversed and in lower case, followed by the application name.
+        :param organization:    Organization name
+        :param application:     Application name
+        :return:                Dictionary of setting values
+        """
+        import plistlib
+        domain = ".".join(reversed(organization.lower().split(".")))
+        path = os.path.expanduser(f"~/Library/Preferences/{domain}.{application}.plist")
+        with open(path, "rb") as plist_file:
+            contents = plistlib.load(plist_file)
+        return {key: value for (key, value) in contents.items() if not isinstance(value, bytes)}
+
+    @classmethod
+    def read_registry(cls, organization: str, application: str) -> {str: object}:
+        """
+        Read the settings QSettings saved in the Windows registry
+        :param organization:    Organization name
+        :param application:     Application name
+        :return:                Dictionary of setting values
+        """
+        import winreg
+        result: {str: object} = {}
+        with winreg.OpenKey(winreg.HKEY_CURRENT_USER, f"Software\\{organization}\\{application}") as key:
+            index = 0
+            while True:
+                try:
+                    (name, value, _) = winreg.EnumValue(key, index)
+                except OSError:
+                    break
+                index += 1
+                if isinstance(value, str):
+                    value = cls.decode_string(value)
+                if value is not None:
+                    result[name] = value
+        return result
+
+    @classmethod
+    def read_ini_file(cls, organization: str, application: str) -> {str: object}:
+        """
+        Read the INI file QSettings saves on Linux and other systems.  Settings without a group
+        are in its [General] section.
+        :param organization:    Organization name
+        :param application:     Application name
+        :return:                Dictionary of setting values
+        """
+        base_directory = os.environ.get("XDG_CONFIG_HOME", os.path.expanduser("~/.config"))
+        path = os.path.join(base_directory, organization, f"{application}.conf")
+        result: {str: object} = {}
+        section = ""
+        with open(path, "r", encoding="utf-8") as ini_file:
+            for line in ini_file:
+                line = line.strip()
+                if line.startswith("[") and line.endswith("]"):
+                    section = line[1:-1]
+                elif "=" in line and section == "General":
+                    (key, value) = line.split("=", 1)
+                    value = cls.decode_string(value.strip())
+                    if value is not None:
+                        result[key.strip()] = value
+        return result
+
+    @classmethod
+    def decode_string(cls, value: str):
+        """
+        Interpret a setting QSettings saved as a string.  Booleans come back as the Python values
+        (QSettings would give the strings "true" and "false"); numbers are left as strings, for the
+        Preferences getters to convert.
+        :param value:   String as saved
+        :return:        Value of the setting, or None if it is in Qt's own encoding
+        """
+        if len(value) >= 2 and value.startswith('"') and value.endswith('"'):
+            value = value[1:-1]
+        if value.startswith("@"):
+            # Qt's own encoding (e.g. "@Variant(...)" or "@Size(...)"), or an escaped "@"
+            return value[1:] if value.startswith("@@") else None
+        if value == "true":
+            return True
+        if value == "false":
+            return False
+        return value
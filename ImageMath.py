@@ -1,8 +1,8 @@
 #
 #   Class to do the math on FITS images to combine them in various ways
 #
-import sys
-from typing import Optional
+import math
+from typing import Optional, Callable
 
 import numpy
 from numpy import ma
@@ -10,35 +10,302 @@ from numpy.core.multiarray import ndarray
 
 import MasterMakerExceptions
 from Console import Console
+from Constants import Constants
 from FileDescriptor import FileDescriptor
-from RmFitsUtil import RmFitsUtil
+from FitsStackReader import FitsStackReader
+from FrameAccumulator import FrameAccumulator
+from FrameStatistics import FrameStatistics
 from SessionController import SessionController
 
 
 class ImageMath:
 
+    # The combination methods work on the image stack one band of rows at a time, so that memory
+    # use is bounded by a given budget rather than by the number and size of the frames.  Each method
+    # makes temporary copies of the band while it works; these factors estimate how many band-sized
+    # arrays are alive at the peak, and are used to size the bands to fit the budget.
+    WORKING_COPIES_MEAN = 1
+    WORKING_COPIES_MEDIAN = 1
+    WORKING_COPIES_MIN_MAX = 3
+    WORKING_COPIES_MIN_MAX_PARTITION = 1
+    WORKING_COPIES_SIGMA_CLIP = 4
+
+    # Precision of the math.  Double precision (float64) is the default.  Single precision (float32) halves
+    # the memory and memory bandwidth used by the combination.  16-bit camera values are represented exactly
+    # in float32, so the median is unaffected, and the output file is rounded to integers anyway.  The
+    # bound on the difference from double precision, in the output file, is:
+    #   Mean, median, min-max:  at most 1 ADU (a different rounding of a mean lying within float32
+    #                           rounding error of a half-integer).  Mean sums are exact while the sum
+    #                           of a pixel's values stays below 2**24; beyond that the relative error
+    #                           of simple summation grows as (number of frames) * 2**-24, which
+    #                           compensated or pairwise summation reduce to about 2**-24.
+    #   Sigma clip:             as above, and in addition values whose z-scores are within float32
+    #                           rounding of the threshold may be kept or dropped differently.
+    #
+    # Exact integer sums.  When the files hold integers (e.g. 16-bit camera data), the sums for the mean,
+    # the min-max clipped mean and the sigma-clipped mean are kept in int64 instead, with the counts, and
+    # divided only once at the end.  Integer sums are exact, so the masters don't depend on the order the
+    # frames are read in, or on how the image is split into bands, and the summation setting doesn't matter.
+
+    @classmethod
+    def integer_dtype_of_files(cls, file_names: [str],
+                               reader_workers: int,
+                               session_controller: SessionController) -> Optional[numpy.dtype]:
+        """
+        Determine the integer type holding the values of all the given files exactly, if they are integer files
+        Exceptions thrown:
+            IncompatibleSizes       The files do not all have the same dimensions
+
+        :param file_names:          Names of the files
+        :param reader_workers:      Number of files to examine concurrently (0 to choose automatically)
+        :param session_controller:  Controller for this subtask, checking for cancellation
+        :return:                    numpy integer type, or None if the files' values need floating point
+        """
+        return FitsStackReader(file_names, reader_workers, session_controller).get_integer_dtype()
+
+    @classmethod
+    def exact_integer_sums(cls, integer_dtype: Optional[numpy.dtype],
+                           values_dtype: Optional[numpy.dtype] = None) -> bool:
+        """
+        Determine if the values of integer files can be summed exactly in int64.  They can if they have
+        no more than 32 bits (so no number of frames we'd combine can overflow the sum) and, if held in
+        floating point while being summed, that type represents every one of them exactly.
+        :param integer_dtype:   Integer type of the files' values (see integer_dtype_of_files), or None
+        :param values_dtype:    Type the values are held in, if not the integer type itself
+        :return:                True if int64 sums are exact
+        """
+        if integer_dtype is None or not numpy.issubdtype(integer_dtype, numpy.integer) \
+                or numpy.dtype(integer_dtype).itemsize > 4:
+            return False
+        if values_dtype is None or numpy.issubdtype(values_dtype, numpy.integer):
+            return True
+        return numpy.dtype(integer_dtype).itemsize * 8 <= numpy.finfo(values_dtype).nmant + 1
+
+    @classmethod
+    def working_dtype_for_precision(cls, precision: int) -> numpy.dtype:
+        """
+        Get the floating point type the combination math uses for the given precision setting
+        :param precision:   Code for precision (Constants.PRECISION_xxx)
+        :return:            numpy floating point type
+        """
+        if precision == Constants.PRECISION_SINGLE:
+            return numpy.dtype(numpy.float32)
+        else:
+            assert precision == Constants.PRECISION_DOUBLE
+            return numpy.dtype(numpy.float64)
+
     @classmethod
     def combine_mean(cls, file_names: [str],
                      console: Console,
-                     session_controller: SessionController) -> ndarray:
+                     session_controller: SessionController,
+                     memory_budget_mb: int = Constants.DEFAULT_MEMORY_BUDGET_MB,
+                     reader_workers: int = 1,
+                     engine: int = Constants.COMBINE_ENGINE_TILED,
+                     summation: int = Constants.SUMMATION_SIMPLE,
+                     working_dtype: numpy.dtype = numpy.float64) -> ndarray:
         """
         Combine the files in the given list using a simple mean (average)
         Check, as reading, that they all have the same dimensions
         :param file_names:          Names of files to be combined
-        :param calibrator:          Calibration object, abstracting precalibration operations
         :param console:             Redirectable console output handler
         :param session_controller:  Controller for this subtask, checking for cancellation
+        :param memory_budget_mb:    Megabytes of memory the image stack may occupy while being combined
+        :param reader_workers:      Number of files to read concurrently (0 to choose automatically)
+        :param engine:              Streaming (frame at a time) or tiled (Constants.COMBINE_ENGINE_xxx)
+        :param summation:           How the streaming engine sums frames (Constants.SUMMATION_xxx)
+        :param working_dtype:       Floating point type the math is done in (see working_dtype_for_precision)
         :return:                    ndarray giving the 2-dimensional matrix of resulting pixel values
         """
         assert len(file_names) > 0  # Otherwise the combine button would have been disabled
         console.push_level()
         console.message("Combining by simple mean", +1)
-        file_data: [ndarray] = RmFitsUtil.read_all_files_data(file_names)
-        cls.check_cancellation(session_controller)
-        mean_result = numpy.mean(file_data, axis=0)
+        if engine == Constants.COMBINE_ENGINE_STREAMING:
+            mean_result = cls.combine_mean_streaming(file_names, summation, reader_workers,
+                                                     console, session_controller, working_dtype)
+        else:
+            assert engine == Constants.COMBINE_ENGINE_TILED
+            mean_result = cls.combine_tiled(file_names,
+                                            lambda band_data: cls.mean_of_band(band_data, working_dtype),
+                                            cls.WORKING_COPIES_MEAN, memory_budget_mb, reader_workers,
+                                            console, session_controller, working_dtype, integer_domain=True)
         console.pop_level()
         return mean_result
 
+    # Streaming mean.  The mean only needs the sum of the frames, so each frame is added into a running
+    # sum as soon as it is read and then discarded.  Memory use is a few frames regardless of how many
+    # files are combined.  With simple summation the result is identical to numpy.mean on the whole stack;
+    # compensated or pairwise summation keep the rounding error from growing with very large stacks.
+    # Integer files are read as integers and summed exactly (see exact_integer_sums).
+
+    @classmethod
+    def combine_mean_streaming(cls, file_names: [str],
+                               summation: int,
+                               reader_workers: int,
+                               console: Console,
+                               session_controller: SessionController,
+                               working_dtype: numpy.dtype = numpy.float64) -> ndarray:
+        """
+        Mean-combine the given files one frame at a time
+        Exceptions thrown:
+            IncompatibleSizes       The files do not all have the same dimensions
+
+        :param file_names:          Names of files to be combined
+        :param summation:           How frames are summed (Constants.SUMMATION_xxx)
+        :param reader_workers:      Number of files to read concurrently (0 to choose automatically)
+        :param console:             Redirectable console output handler
+        :param session_controller:  Controller for this subtask, checking for cancellation
+        :param working_dtype:       Floating point type the math is done in
+        :return:                    ndarray giving the 2-dimensional matrix of resulting pixel values
+        """
+        integer_dtype = cls.integer_dtype_of_files(file_names, reader_workers, session_controller)
+        if cls.exact_integer_sums(integer_dtype):
+            console.message(f"Summing the stored integer values ({integer_dtype.name}) exactly", 0)
+            (frame_dtype, sum_dtype) = (integer_dtype, numpy.int64)
+        else:
+            if summation != Constants.SUMMATION_SIMPLE:
+                console.message(f"Using {Constants.summation_string(summation)} summation", 0)
+            (frame_dtype, sum_dtype) = (working_dtype, working_dtype)
+        accumulator: Optional[FrameAccumulator] = None
+        for frame in FitsStackReader.stream_frames(file_names, reader_workers, session_controller, frame_dtype):
+            if accumulator is None:
+                accumulator = FrameAccumulator(frame.shape, summation, sum_dtype)
+            accumulator.add(frame)
+            cls.check_cancellation(session_controller)
+        return accumulator.get_mean().astype(working_dtype, copy=False)
+
+    @classmethod
+    def mean_of_band(cls, band_data: ndarray,
+                     working_dtype: numpy.dtype = numpy.float64) -> ndarray:
+        """
+        Simple mean down the columns of one band of the image stack
+        :param band_data:       3-dimensional matrix, one layer per file, of a band of rows
+        :param working_dtype:   Floating point type of the result, and of the mean of floating point values
+        :return:                2-dimensional matrix of the mean of each column
+        """
+        if cls.exact_integer_sums(band_data.dtype):
+            sums = numpy.sum(band_data, axis=0, dtype=numpy.int64)
+            return numpy.true_divide(sums, band_data.shape[0]).astype(working_dtype, copy=False)
+        return numpy.mean(band_data, axis=0, dtype=working_dtype)
+
+    # Median by partial sort, in place.
+    #
+    #   numpy.median copies its input before partitioning it, doubling the memory a band needs.  The band
+    #   is a scratch buffer, refilled from the files for every band, so we partition it in place instead:
+    #   numpy.partition moves the middle value (or the two middle values, for an even number of layers) of
+    #   each column into the middle layer(s), and the median is their mean.  This is the same selection and
+    #   the same arithmetic numpy.median does, so the results are identical, including for NaN values: they
+    #   partition to the end of the column, and a column containing any NaN has a NaN median.
+    #   The band may hold the files' stored integers (see combine_tiled); only the middle values are then
+    #   converted to floating point, for the mean.
+
+    @classmethod
+    def median_of_band(cls, band_data: ndarray,
+                       working_dtype: numpy.dtype = numpy.float64) -> ndarray:
+        """
+        Simple median down the columns of one band of the image stack.  The band's contents are rearranged.
+        :param band_data:       3-dimensional matrix, one layer per file, of a band of rows
+        :param working_dtype:   Floating point type of the result, and of the mean of the middle values
+        :return:                2-dimensional matrix of the median of each column
+        """
+        number_layers = band_data.shape[0]
+        lower_middle = (number_layers - 1) // 2
+        upper_middle = number_layers // 2
+        may_contain_nan = numpy.issubdtype(band_data.dtype, numpy.inexact)
+        positions = sorted({lower_middle, upper_middle, number_layers - 1} if may_contain_nan
+                           else {lower_middle, upper_middle})
+        band_data.partition(positions, axis=0)
+        result = numpy.mean(band_data[lower_middle:upper_middle + 1], axis=0, dtype=working_dtype)
+        if may_contain_nan:
+            result[numpy.isnan(band_data[-1])] = numpy.nan
+        return result
+
+    # The "tiled" combination engine.  Rather than reading every file completely into memory and
+    # stacking the results into one enormous 3-dimensional matrix, we read the same band of rows
+    # from every file, combine that band, store it in the result, and move on to the next band.
+    # All of our combination algorithms work independently on each "column" (the values at one x,y
+    # position across all the files) so combining band-by-band gives exactly the same result as
+    # combining the whole stack at once, as long as the band fits in memory.  One band buffer is
+    # allocated, and refilled for each band, so the combiners may use it as scratch space.
+    #
+    # Combiners that only sum, compare and select values before the final average (mean, median, min-max
+    # partition) can ask for the band in the files' integer domain.  16-bit camera data is then held as
+    # uint16 (the BZERO offset already applied) rather than float64: a quarter of the memory and memory
+    # traffic, so bands within a budget are four times larger.  Values are converted to floating point
+    # only for the final average (see exact_integer_sums).
+
+    @classmethod
+    def combine_tiled(cls, file_names: [str],
+                      band_combiner: Callable[[ndarray], ndarray],
+                      working_copies: int,
+                      memory_budget_mb: int,
+                      reader_workers: int,
+                      console: Console,
+                      session_controller: SessionController,
+                      working_dtype: numpy.dtype = numpy.float64,
+                      integer_domain: bool = False) -> ndarray:
+        """
+        Combine the given files one band of rows at a time, using the given function to combine each band
+        Exceptions thrown:
+            IncompatibleSizes       The files do not all have the same dimensions
+
+        :param file_names:          Names of files to be combined
+        :param band_combiner:       Function taking a 3-dimensional band of the stack, returning the 2-d combination
+        :param working_copies:      Number of band-sized arrays the combiner uses at its peak
+        :param memory_budget_mb:    Megabytes of memory the band and its working copies may occupy
+        :param reader_workers:      Number of files to read concurrently (0 to choose automatically)
+        :param console:             Redirectable console output handler
+        :param session_controller:  Controller for this subtask, checking for cancellation
+        :param working_dtype:       Floating point type the bands are read into and combined in
+        :param integer_domain:      Read the bands as the files' integers, if they are integer files
+        :return:                    ndarray giving the 2-dimensional matrix of resulting pixel values
+        """
+        reader = FitsStackReader(file_names, reader_workers, session_controller)
+        (rows, columns) = reader.get_dimensions()
+        band_dtype = numpy.dtype(working_dtype)
+        if integer_domain:
+            integer_dtype = reader.get_integer_dtype()
+            if integer_dtype is not None:
+                band_dtype = integer_dtype
+                console.message(f"Working on the stored integer values ({band_dtype.name})", 0)
+        band_rows = cls.band_rows_for_budget(len(file_names), columns, working_copies, memory_budget_mb,
+                                             band_dtype)
+        number_bands = math.ceil(rows / band_rows)
+        if number_bands > 1:
+            console.message(f"Processing {rows:,} rows in {number_bands} bands of {band_rows:,} rows "
+                            f"to stay within {memory_budget_mb:,} MB", 0)
+        result = numpy.empty((rows, columns), dtype=working_dtype)
+        band_buffer = numpy.empty((len(file_names), min(rows, band_rows), columns), dtype=band_dtype)
+        for band_index in range(number_bands):
+            cls.check_cancellation(session_controller)
+            first_row = band_index * band_rows
+            end_row = min(rows, first_row + band_rows)
+            if number_bands > 1:
+                console.message(f"Band {band_index + 1} of {number_bands}", +1, temp=True)
+            band_data = reader.read_band(first_row, end_row, out=band_buffer[:, :end_row - first_row])
+            cls.check_cancellation(session_controller)
+            result[first_row:end_row] = band_combiner(band_data)
+        return result
+
+    @classmethod
+    def band_rows_for_budget(cls, number_files: int,
+                             columns: int,
+                             working_copies: int,
+                             memory_budget_mb: int,
+                             working_dtype: numpy.dtype = numpy.float64) -> int:
+        """
+        Calculate how many image rows can be processed at once within a memory budget
+        :param number_files:        Number of files (layers) in the stack
+        :param columns:             Width of the images
+        :param working_copies:      Number of band-sized arrays the combination uses at its peak
+        :param memory_budget_mb:    Memory budget in megabytes
+        :param working_dtype:       Type of the band arrays
+        :return:                    Number of rows per band; always at least 1
+        """
+        assert memory_budget_mb > 0
+        bytes_per_row = number_files * columns * numpy.dtype(working_dtype).itemsize * working_copies
+        budget_bytes = memory_budget_mb * 1024 * 1024
+        return max(1, budget_bytes // bytes_per_row)
+
     # Calculate the min-max clipped mean for the specified column.
     # See the explanation in the previous method or what we're doing.
     # We'll sort the list to more efficiently delete items - we don't need to search
@@ -459,13 +726,10 @@ class ImageMath:
         :return:                        2-dimensional matrix representing resulting combined image
         """
         console.push_level()
-        console.message(f"Using min-max clip with {number_dropped_values} iterations", +1)
         masked_array = ma.MaskedArray(file_data)
         drop_counter = 1
         while drop_counter <= number_dropped_values:
             cls.check_cancellation(session_controller)
-            console.push_level()
-            console.message(f"Iteration {drop_counter} of {number_dropped_values}.", +1)
             drop_counter += 1
             # Find the minimums in all columns.  This will give a 2d matrix the same size as the images
             # with the column-minimum in each position
@@ -477,16 +741,12 @@ class ImageMath:
             # we want to find all of them)
             masked_array = ma.masked_where(masked_array == minimum_values, masked_array)
             cls.check_cancellation(session_controller)
-            console.message("Masked minimums.", +1, temp=True)
 
             # Now find and mask the maximums, same approach
             maximum_values = masked_array.max(axis=0)
             masked_array = ma.masked_where(masked_array == maximum_values, masked_array)
             cls.check_cancellation(session_controller)
-            console.message("Masked maximums.", +1, temp=True)
-            console.pop_level()
 
-        console.message(f"Calculating mean of remaining data.", 0)
         masked_means = numpy.mean(masked_array, axis=0)
         cls.check_cancellation(session_controller)
         # If the means matrix contains any masked values, that means that in that column the clipping
@@ -505,20 +765,49 @@ class ImageMath:
             cp = "s" if repairs > 1 else ""
             np = "" if repairs > 1 else "s"
             console.message(f"{repairs} column{cp} need{np} repair.", +1)
-            for index in range(repairs):
-                cls.check_cancellation(session_controller)
-                # print(".", end="\n" if (index > 0) and (index % 50 == 0) else "")
-                column_x = x_coordinates[index]
-                column_y = y_coordinates[index]
-                column = file_data[:, column_x, column_y]
-                min_max_clipped_mean: int = round(cls.calc_mm_clipped_mean(column, number_dropped_values - 1,
-                                                                           console, session_controller))
-                masked_means[column_x, column_y] = min_max_clipped_mean
+            columns = file_data[:, x_coordinates, y_coordinates]
+            masked_means[x_coordinates, y_coordinates] = cls.repair_columns(columns, number_dropped_values - 1,
+                                                                            session_controller)
             # We've replaced the problematic columns, now the mean should calculate cleanly
             assert not ma.is_masked(masked_means)
         console.pop_level()
         return masked_means.round()
 
+    # Min-max clip using a partial sort.
+    #
+    #   numpy.partition, given the positions k-1 and n-k, rearranges each column so that the k smallest
+    #   values come first and the k largest come last, in one pass and without fully sorting the column.
+    #   The clipped mean is then just the mean of the middle n-2k layers.  Unlike version 5 above, exactly
+    #   k values are dropped from each end even when there are ties with the minimum or maximum, so no
+    #   column can ever be entirely eliminated and no repair pass is needed.  The partition is done in
+    #   place on the band (which is a scratch buffer, refilled for each band), so the only temporary memory
+    #   is the one-layer mean.  As with the median, the band may hold the files' stored integers.
+
+    @classmethod
+    def min_max_clip_partition(cls, band_data: ndarray,
+                               number_dropped_values: int,
+                               session_controller: SessionController,
+                               working_dtype: numpy.dtype = numpy.float64) -> ndarray:
+        """
+        Min-max clipped mean down the columns of one band of the image stack, dropping exactly the given
+        number of lowest and highest values from each column.  The band's contents are rearranged.
+        :param band_data:               3-dimensional matrix, one layer per file, of a band of rows
+        :param number_dropped_values:   Number of min and max values to drop from each column
+        :param session_controller:      Controller for this subtask, checking for cancellation
+        :param working_dtype:           Floating point type of the result, and of the mean
+        :return:                        2-dimensional matrix of the rounded clipped means
+        """
+        number_layers = band_data.shape[0]
+        assert 0 <= number_dropped_values and 2 * number_dropped_values < number_layers
+        if number_dropped_values > 0:
+            band_data.partition((number_dropped_values - 1, number_layers - number_dropped_values), axis=0)
+            cls.check_cancellation(session_controller)
+        kept_values = band_data[number_dropped_values:number_layers - number_dropped_values]
+        if cls.exact_integer_sums(band_data.dtype):
+            sums = numpy.sum(kept_values, axis=0, dtype=numpy.int64)
+            return numpy.true_divide(sums, len(kept_values)).round().astype(working_dtype, copy=False)
+        return numpy.mean(kept_values, axis=0, dtype=working_dtype).round()
+
     # Combine given files using "sigma clip"
     #
     # In the following explanation, "column" means all of the points at a given image (x,y) coordinate,
@@ -553,28 +842,185 @@ class ImageMath:
     def combine_sigma_clip(cls, file_names: [str],
                            sigma_threshold: float,
                            console: Console,
-                           session_controller: SessionController) -> Optional[ndarray]:
+                           session_controller: SessionController,
+                           memory_budget_mb: int = Constants.DEFAULT_MEMORY_BUDGET_MB,
+                           reader_workers: int = 1,
+                           engine: int = Constants.COMBINE_ENGINE_TILED,
+                           working_dtype: numpy.dtype = numpy.float64) -> Optional[ndarray]:
         """
         Combine the given list of images to a single image using sigma clip algorithm, where values more than
         a given number of standard deviations from the mean are dropped, then the remaining values averaged.
         :param file_names:              list of names of files to be combined
         :param sigma_threshold:         Z-score threshold for dropping outliers
-        :param calibrator:              Object providing any needed image precalibration service
         :param console:                 redirectable console output handler
         :param session_controller:      parent controller for this subtask (to check for cancellation)
+        :param memory_budget_mb:        Megabytes of memory the image stack may occupy while being combined
+        :param reader_workers:          Number of files to read concurrently (0 to choose automatically)
+        :param engine:                  Streaming (frame at a time) or tiled (Constants.COMBINE_ENGINE_xxx)
+        :param working_dtype:           Floating point type the math is done in (see working_dtype_for_precision)
         :return:                        2-dimensional matrix representing resulting combined image
         """
         console.push_level()
         console.message(f"Combine by sigma-clipped mean, z-score threshold {sigma_threshold}", +1)
-        file_data = numpy.asarray(RmFitsUtil.read_all_files_data(file_names))
 
-        console.message("Calculating unclipped means", +1)
+        if engine == Constants.COMBINE_ENGINE_STREAMING:
+            (result, number_masked) = cls.sigma_clip_streaming(file_names, sigma_threshold, reader_workers,
+                                                               console, session_controller, working_dtype)
+        else:
+            assert engine == Constants.COMBINE_ENGINE_TILED
+            console.message("Calculating z-scores, eliminating data outside threshold, "
+                            "and calculating adjusted means", +1)
+
+            # Each band reports how many values it discarded, so we can total them for the whole image
+            discarded_counts: [int] = []
+            integer_sums = cls.exact_integer_sums(cls.integer_dtype_of_files(file_names, reader_workers,
+                                                                             session_controller),
+                                                  working_dtype)
+
+            def clip_one_band(band_data: ndarray) -> ndarray:
+                (band_result, band_discarded) = cls.sigma_clip_band(band_data, sigma_threshold,
+                                                                    console, session_controller, integer_sums)
+                discarded_counts.append(band_discarded)
+                return band_result
+
+            result = cls.combine_tiled(file_names, clip_one_band, cls.WORKING_COPIES_SIGMA_CLIP,
+                                       memory_budget_mb, reader_workers, console, session_controller,
+                                       working_dtype)
+            number_masked = sum(discarded_counts)
+
+        # Calculate and display how much data we are ignoring
+        total_pixels = len(file_names) * result.size
+        percentage_masked = 100.0 * number_masked / total_pixels
+        console.message(f"Discarded {number_masked:,} pixels of {total_pixels:,} "
+                        f"({percentage_masked:.3f}% of data)", +1)
+        console.pop_level()
+        return result
+
+    # Streaming sigma clip.  Rather than holding the whole stack, the frames are read twice.
+    #   Pass 1:     Each frame updates running per-pixel means and variances (Welford's algorithm)
+    #   Pass 2:     Each frame's z-scores are computed against those statistics, and only the values
+    #               within the threshold are added to per-pixel sums and counts
+    # Peak memory is a handful of frame-sized arrays regardless of the number of frames.  Results match
+    # the tiled method to within floating-point rounding of the means and standard deviations.
+    # For integer files, the kept values are summed exactly in int64 (see exact_integer_sums).
+    # Pixels where every value was clipped are repaired, as in the tiled method, with a min-max clipped
+    # mean; that needs their full columns, which are gathered in a third pass only if there are any.
+
+    @classmethod
+    def sigma_clip_streaming(cls, file_names: [str],
+                             sigma_threshold: float,
+                             reader_workers: int,
+                             console: Console,
+                             session_controller: SessionController,
+                             working_dtype: numpy.dtype = numpy.float64) -> (ndarray, int):
+        """
+        Sigma-clip the given files, reading them one frame at a time
+        Exceptions thrown:
+            IncompatibleSizes       The files do not all have the same dimensions
+
+        :param file_names:              Names of files to be combined
+        :param sigma_threshold:         Z-score threshold for dropping outliers
+        :param reader_workers:          Number of files to read concurrently (0 to choose automatically)
+        :param console:                 Redirectable console output handler
+        :param session_controller:      Controller for this subtask, checking for cancellation
+        :param working_dtype:           Floating point type the math is done in
+        :return:                        Tuple: 2-d matrix of the clipped means, and number of values discarded
+        """
+        console.message("Calculating means and standard deviations", +1)
+        statistics: Optional[FrameStatistics] = None
+        for frame in FitsStackReader.stream_frames(file_names, reader_workers, session_controller, working_dtype):
+            if statistics is None:
+                statistics = FrameStatistics(frame.shape, working_dtype)
+            statistics.add(frame)
+            cls.check_cancellation(session_controller)
+        column_means = statistics.get_mean()
+        column_stdevs = statistics.get_standard_deviation()
+        # Zero deviation would give division-by-zero; see sigma_clip_band
+        column_stdevs[column_stdevs == 0.0] = numpy.finfo(working_dtype).max
+
+        console.message("Calculating z-scores, eliminating data outside threshold, and calculating adjusted means",
+                        0)
+        integer_dtype = cls.integer_dtype_of_files(file_names, reader_workers, session_controller)
+        integer_sums = cls.exact_integer_sums(integer_dtype, working_dtype)
+        kept_sums = numpy.zeros(statistics.get_shape(), dtype=numpy.int64 if integer_sums else working_dtype)
+        kept_counts = numpy.zeros(statistics.get_shape(), dtype=numpy.int64)
+        for frame in FitsStackReader.stream_frames(file_names, reader_workers, session_controller, working_dtype):
+            if frame.shape != statistics.get_shape():
+                raise MasterMakerExceptions.IncompatibleSizes
+            within_threshold = numpy.logical_not(abs(frame - column_means) / column_stdevs > sigma_threshold)
+            # The values are whole numbers, so converting them to int64 for an integer sum is exact
+            numpy.add(kept_sums, numpy.where(within_threshold, frame, 0.0), out=kept_sums, casting="unsafe")
+            kept_counts += within_threshold
+            cls.check_cancellation(session_controller)
+        number_masked = len(file_names) * kept_sums.size - int(kept_counts.sum())
+
+        eliminated_columns_map = kept_counts == 0
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            result = numpy.divide(kept_sums, kept_counts).astype(working_dtype, copy=False)
+        if eliminated_columns_map.any():
+            console.message("Means array still contains masked values; min-max clipping those columns.", 0,
+                            temp=True)
+            coordinates = numpy.nonzero(eliminated_columns_map)
+            columns = numpy.empty((len(file_names), len(coordinates[0])), dtype=working_dtype)
+            for (index, frame) in enumerate(FitsStackReader.stream_frames(file_names, reader_workers,
+                                                                           session_controller, working_dtype)):
+                columns[index] = frame[coordinates]
+                cls.check_cancellation(session_controller)
+            result[coordinates] = cls.repair_columns(columns, 2, session_controller)
+        return result.round(), number_masked
+
+    @classmethod
+    def repair_columns(cls, columns: ndarray,
+                       number_dropped_values: int,
+                       session_controller: SessionController) -> ndarray:
+        """
+        Calculate the rounded min-max clipped mean of each of a set of columns that clipping eliminated
+        entirely.  Gives the same results as calling calc_mm_clipped_mean on each column, but does all
+        the columns at once with array operations.
+
+        calc_mm_clipped_mean drops every instance of the minimum, k times, then every instance of the
+        maximum, k times; i.e. it drops the k smallest and k largest *distinct* values.  If that empties
+        the column it tries again with k-1, and with nothing left at k=1 it uses the whole column.
+        So, with the columns sorted and each value given its rank among the column's distinct values
+        (0 to r-1), we keep ranks k through r-1-k, where k is reduced to (r-1)//2 if the column has too
+        few distinct values.  At k=0 that keeps the whole column.
+
+        :param columns:                 2-dimensional matrix, one column of values (all files) per pixel to repair
+        :param number_dropped_values:   Number of min and max values to drop from each column
+        :param session_controller:      Controller for this subtask, checking for cancellation
+        :return:                        1-dimensional array of the repaired value for each column
+        """
+        cls.check_cancellation(session_controller)
+        sorted_columns = numpy.sort(columns, axis=0)
+        value_changes = sorted_columns[1:] != sorted_columns[:-1]
+        distinct_ranks = numpy.zeros(sorted_columns.shape, dtype=numpy.int64)
+        numpy.cumsum(value_changes, axis=0, out=distinct_ranks[1:])
+        number_distinct = distinct_ranks[-1] + 1
+        drops = numpy.minimum(number_dropped_values, (number_distinct - 1) // 2)
+        keep = (distinct_ranks >= drops) & (distinct_ranks <= number_distinct - 1 - drops)
+        cls.check_cancellation(session_controller)
+        kept_sums = numpy.where(keep, sorted_columns, 0.0).sum(axis=0)
+        return (kept_sums / numpy.count_nonzero(keep, axis=0)).round()
+
+    @classmethod
+    def sigma_clip_band(cls, file_data: ndarray,
+                        sigma_threshold: float,
+                        console: Console,
+                        session_controller: SessionController,
+                        integer_sums: bool = False) -> (ndarray, int):
+        """
+        Sigma-clip one band of the image stack, as described in the comments above
+        :param file_data:               3-dimensional matrix, one layer per file, of a band of rows
+        :param sigma_threshold:         Z-score threshold for dropping outliers
+        :param console:                 redirectable console output handler
+        :param session_controller:      parent controller for this subtask (to check for cancellation)
+        :param integer_sums:            The values are whole numbers; sum the kept ones exactly in int64
+        :return:                        Tuple: 2-d matrix of the clipped means, and number of values discarded
+        """
         column_means = numpy.mean(file_data, axis=0)
         cls.check_cancellation(session_controller)
-        console.message("Calculating standard deviations", 0)
         column_stdevs = numpy.std(file_data, axis=0)
         cls.check_cancellation(session_controller)
-        console.message("Calculating z-scores", 0)
 
         # Now what we'd like to do is just:
         #    z_scores = abs(file_data - column_means) / column_stdevs
@@ -584,72 +1030,70 @@ class ImageMath:
         # In that case we wouldn't want to eliminate any anyway, so we'll set the
         # zero stdevs to a large number, which causes the z-scores to be small, which
         # causes no values to be eliminated.
-        column_stdevs[column_stdevs == 0.0] = sys.float_info.max
+        column_stdevs[column_stdevs == 0.0] = numpy.finfo(column_stdevs.dtype).max
         z_scores = abs(file_data - column_means) / column_stdevs
         cls.check_cancellation(session_controller)
 
-        console.message("Eliminated data outside threshold", 0)
         exceeds_threshold = z_scores > sigma_threshold
         cls.check_cancellation(session_controller)
-
-        # Calculate and display how much data we are ignoring
-        dimensions = exceeds_threshold.shape
-        total_pixels = dimensions[0] * dimensions[1] * dimensions[2]
         number_masked = numpy.count_nonzero(exceeds_threshold)
-        percentage_masked = 100.0 * number_masked / total_pixels
-        console.message(f"Discarded {number_masked:,} pixels of {total_pixels:,} "
-                        f"({percentage_masked:.3f}% of data)", +1)
-
-        masked_array = ma.masked_array(file_data, exceeds_threshold)
-        cls.check_cancellation(session_controller)
 
-        console.message("Calculating adjusted means", -1)
-        masked_means = ma.mean(masked_array, axis=0)
+        if integer_sums:
+            kept_sums = numpy.sum(file_data, axis=0, dtype=numpy.int64, where=numpy.logical_not(exceeds_threshold))
+            kept_counts = file_data.shape[0] - numpy.count_nonzero(exceeds_threshold, axis=0)
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                kept_means = numpy.divide(kept_sums, kept_counts).astype(file_data.dtype, copy=False)
+            masked_means = ma.masked_array(kept_means, kept_counts == 0)
+        else:
+            masked_array = ma.masked_array(file_data, exceeds_threshold)
+            cls.check_cancellation(session_controller)
+            masked_means = ma.mean(masked_array, axis=0)
         cls.check_cancellation(session_controller)
 
         # If the means matrix contains any masked values, that means that in that column the clipping
         # eliminated *all* the data.  We will find the offending columns and re-calculate those using
         # simple min-max clipping.
         if ma.is_masked(masked_means):
-            console.message("Means array still contains masked values; min-max clipping those columns.", 0)
+            console.message("Means array still contains masked values; min-max clipping those columns.", 0,
+                            temp=True)
             #  Get the mask, and get a 2D matrix showing which columns were entirely masked
             eliminated_columns_map = ndarray.all(exceeds_threshold, axis=0)
             masked_coordinates = numpy.where(eliminated_columns_map)
             x_coordinates = masked_coordinates[0]
             y_coordinates = masked_coordinates[1]
             assert len(x_coordinates) == len(y_coordinates)
-            for index in range(len(x_coordinates)):
-                cls.check_cancellation(session_controller)
-                column_x = x_coordinates[index]
-                column_y = y_coordinates[index]
-                column = file_data[:, column_x, column_y]
-                min_max_clipped_mean: int = round(cls.calc_mm_clipped_mean(column, 2, console, session_controller))
-                masked_means[column_x, column_y] = min_max_clipped_mean
+            columns = file_data[:, x_coordinates, y_coordinates]
+            masked_means[x_coordinates, y_coordinates] = cls.repair_columns(columns, 2, session_controller)
             # We've replaced the problematic columns, now the mean should calculate cleanly
             assert not ma.is_masked(masked_means)
-        console.pop_level()
         result = masked_means.round().filled()
-        return result
+        return result, number_masked
 
     @classmethod
     def combine_median(cls, file_names: [str],
                        console: Console,
-                       session_controller: SessionController) -> ndarray:
+                       session_controller: SessionController,
+                       memory_budget_mb: int = Constants.DEFAULT_MEMORY_BUDGET_MB,
+                       reader_workers: int = 1,
+                       working_dtype: numpy.dtype = numpy.float64) -> ndarray:
         """
         Combine the files in the given list using a simple median
         Check, as reading, that they all have the same dimensions
         :param file_names:          Names of files to be combined
-        :param calibrator:          Calibration object, abstracting precalibration operations
         :param console:             Redirectable console output handler
         :param session_controller:  Controller for this subtask, checking for cancellation
+        :param memory_budget_mb:    Megabytes of memory the image stack may occupy while being combined
+        :param reader_workers:      Number of files to read concurrently (0 to choose automatically)
+        :param working_dtype:       Floating point type the math is done in (see working_dtype_for_precision)
         :return:                    ndarray giving the 2-dimensional matrix of resulting pixel values
         """
         assert len(file_names) > 0  # Otherwise the combine button would have been disabled
         console.push_level()
         console.message("Combine by simple Median", +1)
-        file_data = RmFitsUtil.read_all_files_data(file_names)
-        cls.check_cancellation(session_controller)
-        median_result = numpy.median(file_data, axis=0)
+        median_result = cls.combine_tiled(file_names,
+                                          lambda band_data: cls.median_of_band(band_data, working_dtype),
+                                          cls.WORKING_COPIES_MEDIAN, memory_budget_mb, reader_workers,
+                                          console, session_controller, working_dtype, integer_domain=True)
         console.pop_level()
         return median_result
 
@@ -697,23 +1141,44 @@ class ImageMath:
     def combine_min_max_clip(cls, file_names: [str],
                              number_dropped_values: int,
                              console: Console,
-                             session_controller: SessionController) -> Optional[ndarray]:
+                             session_controller: SessionController,
+                             memory_budget_mb: int = Constants.DEFAULT_MEMORY_BUDGET_MB,
+                             reader_workers: int = 1,
+                             engine: int = Constants.MIN_MAX_ENGINE_MASKED,
+                             working_dtype: numpy.dtype = numpy.float64) -> Optional[ndarray]:
         """
         Combine the files in the given list using min-max clip algorithm
         Check, as reading, that they all have the same dimensions
         :param file_names:              Names of files to be combined
         :param number_dropped_values    Number of min and max values to drop from each column
-        :param calibrator:              Calibration object, abstracting precalibration operations
         :param console:                 Redirectable console output handler
         :param session_controller:      Controller for this subtask, checking for cancellation
+        :param memory_budget_mb:        Megabytes of memory the image stack may occupy while being combined
+        :param reader_workers:          Number of files to read concurrently (0 to choose automatically)
+        :param engine:                  Which min-max implementation (Constants.MIN_MAX_ENGINE_xxx)
+        :param working_dtype:           Floating point type the math is done in (see working_dtype_for_precision)
         :return:                        ndarray giving the 2-dimensional matrix of resulting pixel values
         """
-        success: bool
         assert len(file_names) > 0  # Otherwise the combine button would have been disabled
-        # Get the data to be processed
-        file_data_list: [ndarray] = RmFitsUtil.read_all_files_data(file_names)
-        cls.check_cancellation(session_controller)
-        file_data = numpy.asarray(file_data_list)
+        console.push_level()
+        if engine == Constants.MIN_MAX_ENGINE_PARTITION:
+            number_to_drop = min(number_dropped_values, (len(file_names) - 1) // 2)
+            if number_to_drop < number_dropped_values:
+                console.message(f"Only {len(file_names)} files; dropping {number_to_drop} "
+                                f"values from each end instead of {number_dropped_values}", +1)
+            console.message(f"Using min-max clip, dropping {number_to_drop} values from each end", +1)
+            result = cls.combine_tiled(file_names,
+                                       lambda band_data: cls.min_max_clip_partition(band_data, number_to_drop,
+                                                                                    session_controller,
+                                                                                    working_dtype),
+                                       cls.WORKING_COPIES_MIN_MAX_PARTITION, memory_budget_mb, reader_workers,
+                                       console, session_controller, working_dtype, integer_domain=True)
+            cls.check_cancellation(session_controller)
+            console.pop_level()
+            return result
+
+        assert engine == Constants.MIN_MAX_ENGINE_MASKED
+        console.message(f"Using min-max clip with {number_dropped_values} iterations", +1)
 
         # Do the math using each algorithm, and display how long it takes
 
@@ -763,10 +1228,14 @@ class ImageMath:
         # cls.compare_results(result0, result5, "5")
         #
         # return result0
-        result5 = cls.min_max_clip_version_5(file_data, number_dropped_values, console,
-                                             session_controller)
+        result = cls.combine_tiled(file_names,
+                                   lambda band_data: cls.min_max_clip_version_5(band_data, number_dropped_values,
+                                                                                console,
+                                                                                session_controller).filled(),
+                                   cls.WORKING_COPIES_MIN_MAX, memory_budget_mb, reader_workers,
+                                   console, session_controller, working_dtype)
         cls.check_cancellation(session_controller)
-        result = result5.filled()
+        console.pop_level()
         return result
 
     @classmethod
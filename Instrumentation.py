@@ -0,0 +1,150 @@
+#
+#   Lightweight record of where the time and memory of a session go.
+#
+#   Code marks a stage of the work (header scanning, pixel reading, combining, writing, moving
+#   files) by running it inside "with Instrumentation.stage(name):".  For each stage name we total
+#   the number of times it ran, its wall-clock time, and the processor time used by the whole process
+#   while it ran.  Memory is reported only as the peak resident memory of the process: the operating
+#   system gives the high-water mark since the process started, not the peak during any one stage.
+#
+#   Stages may be nested (e.g. pixel reads inside a combine).  Wall time is recorded both including
+#   nested stages and excluding them ("self" time), so the self times of the stages add up to the
+#   time spent in instrumented code without counting anything twice.  Stages running at the same time
+#   on different threads (e.g. writing one group while combining the next) each count their own time.
+#
+#   Records are kept for the whole process and are thread-safe.  Worker processes return their
+#   records (take_records) to be merged into the parent's (merge_records).
+#
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+from Console import Console
+from MultiOsUtil import MultiOsUtil
+
+
+class Instrumentation:
+
+    # Names of the stages recorded
+    STAGE_HEADER_SCAN = "Header scan"
+    STAGE_GROUPING = "Grouping"
+    STAGE_PREFETCH = "Prefetch"
+    STAGE_PIXEL_READ = "Pixel read"
+    STAGE_COMBINE = "Combine math"
+    STAGE_FITS_WRITE = "FITS write"
+    STAGE_FILE_MOVES = "File moves"
+
+    _lock = threading.Lock()
+    _records: {str: {}} = {}
+    # Per thread, the stack of stages running, each with the wall time of its nested stages so far
+    _thread_state = threading.local()
+
+    @classmethod
+    @contextmanager
+    def stage(cls, name: str):
+        """
+        Record the work done inside the "with" block as the given stage
+        :param name:    Name of the stage (one of the STAGE_xxx constants)
+        """
+        running = getattr(cls._thread_state, "running", None)
+        if running is None:
+            running = []
+            cls._thread_state.running = running
+        nested_seconds = [0.0]
+        running.append(nested_seconds)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            wall_seconds = time.perf_counter() - wall_start
+            cpu_seconds = time.process_time() - cpu_start
+            running.pop()
+            if len(running) > 0:
+                running[-1][0] += wall_seconds
+            cls.add_record(name, {"calls": 1,
+                                  "wall_seconds": wall_seconds,
+                                  "self_seconds": wall_seconds - nested_seconds[0],
+                                  "cpu_seconds": cpu_seconds})
+
+    @classmethod
+    def add_record(cls, name: str, record: {}):
+        """
+        Add the measurements of one or more runs of a stage to its totals
+        :param name:    Name of the stage
+        :param record:  Measurements, as kept by this class
+        """
+        with cls._lock:
+            totals = cls._records.get(name)
+            if totals is None:
+                cls._records[name] = dict(record)
+            else:
+                for key in ("calls", "wall_seconds", "self_seconds", "cpu_seconds"):
+                    totals[key] += record[key]
+
+    @classmethod
+    def reset(cls):
+        """
+        Discard everything recorded so far, e.g. at the start of a session
+        """
+        with cls._lock:
+            cls._records = {}
+
+    @classmethod
+    def take_records(cls) -> {str: {}}:
+        """
+        Get the records so far, and discard them
+        :return:    Dictionary, by stage name, of the stage's totals
+        """
+        with cls._lock:
+            result = cls._records
+            cls._records = {}
+        return result
+
+    @classmethod
+    def merge_records(cls, records: {str: {}}):
+        """
+        Add records taken elsewhere (e.g. in a worker process) to those here
+        :param records:     Dictionary, by stage name, of stage totals, as given by take_records
+        """
+        for (name, record) in records.items():
+            cls.add_record(name, record)
+
+    @classmethod
+    def get_report(cls) -> {}:
+        """
+        Get the records as a dictionary suitable for saving as JSON
+        :return:    Dictionary with a list of stages, in the order they were first recorded
+        """
+        with cls._lock:
+            stages = [{"stage": name, **record} for (name, record) in cls._records.items()]
+        return {"stages": stages,
+                "peak_memory_bytes": MultiOsUtil.peak_memory_bytes()}
+
+    @classmethod
+    def write_report(cls, path: str):
+        """
+        Write the records to a JSON file
+        :param path:    Path of the file to be written
+        """
+        with open(path, "w") as report_file:
+            json.dump(cls.get_report(), report_file, indent=2)
+
+    @classmethod
+    def output_summary(cls, console: Console):
+        """
+        Output a table of the records on the given console
+        :param console:     Redirectable console output object
+        """
+        report = cls.get_report()
+        console.push_level()
+        console.message("Time by stage (self time excludes nested stages):", +1)
+        console.push_level()
+        console.message(f"{'Stage':14s} {'Calls':>7s} {'Wall s':>9s} {'Self s':>9s} {'CPU s':>9s}", +1)
+        for stage in report["stages"]:
+            console.message(f"{stage['stage']:14s} {stage['calls']:7d} {stage['wall_seconds']:9.3f} "
+                            f"{stage['self_seconds']:9.3f} {stage['cpu_seconds']:9.3f}", 0)
+        console.pop_level()
+        console.message(f"Peak memory of this process: {report['peak_memory_bytes'] / (1024 * 1024):.1f} MB", 0)
+        console.pop_level()
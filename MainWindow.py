@@ -313,7 +313,7 @@ class MainWindow(QMainWindow):
         """'Pick Files' button or 'Open' menu item are selected.  Get the input files from the user."""
         dialog = QFileDialog()
         file_names, _ = QFileDialog.getOpenFileNames(dialog, "Pick Files", "",
-                                                     f"FITS files(*.fit)",
+                                                     f"FITS files(*.fit *.fits *.fts *.fz *.fit.gz *.fits.gz)",
                                                      # options=QFileDialog.ReadOnly | QFileDialog.DontUseNativeDialog)
                                                      options=QFileDialog.ReadOnly)
         if len(file_names) == 0:
@@ -321,7 +321,9 @@ class MainWindow(QMainWindow):
             pass
         else:
             try:
-                file_descriptions = RmFitsUtil.make_file_descriptions(file_names)
+                file_descriptions = RmFitsUtil.make_file_descriptions(file_names,
+                                                                      self._data_model.get_reader_workers(),
+                                                                      cache=self._data_model.get_descriptor_cache())
                 self._table_model.set_file_descriptors(file_descriptions)
                 self._table_model.sort(0, PyQt5.QtCore.Qt.AscendingOrder)  # Column 0, ascending order
             except FileNotFoundError as exception:
@@ -1,66 +1,47 @@
 #!/Library/Frameworks/Python.framework/Versions/3.8/bin/python3.8
+import multiprocessing
 import sys
-from argparse import ArgumentParser
-
-from PyQt5 import QtWidgets
 
+from CommandLineArguments import CommandLineArguments
 from CommandLineHandler import CommandLineHandler
 from DataModel import DataModel
-from MainWindow import MainWindow
 # First phase in development of automated calibration frame combination.
 # This program combines Bias Frames into a master bias.  If run without parameters, a GUI
 # window opens.  If run given a list of file names as args, then those are immediately processed
 # without the UI interaction.  Preferences control how they are combined and where the result goes.
+# Qt is loaded only when the GUI is opened, so command-line runs (and the worker processes, which
+# import this module) start quickly and need no display.
 from Preferences import Preferences
 
 # Set up command line arguments
-arg_parser = ArgumentParser(description="Combine Bias-Frame FITS files into a master bias")
-arg_parser.add_argument("-g", "--gui", action="store_true",
-                        help="Force GUI interface to open, ignoring other arguments")
-
-# combination algorithm options - only one may be used
-method_arg_group = arg_parser.add_mutually_exclusive_group()
-method_arg_group.add_argument("-m", "--mean", action="store_true",
-                              help="Combine by simple mean")
-method_arg_group.add_argument("-n", "--median", action="store_true",
-                              help="Combine by simple median")
-method_arg_group.add_argument("-mm", "--minmax", type=int, metavar="<# values to clip>",
-                              help="Min-max clipping of <n> values, then mean")
-method_arg_group.add_argument("-s", "--sigma", type=float, metavar="<z threshold>",
-                              help="Remove values with z-score greater than threshold, then mean")
-
-# Grouping
-arg_parser.add_argument("-gs", "--groupsize", action="store_true",
-                              help="Group files by size (dimensions and binning)")
-arg_parser.add_argument("-gt", "--grouptemperature", type=float, metavar="<Grouping bandwidth>",
-                              help="Group by temperature with given bandwidth")
-arg_parser.add_argument("-mg", "--minimumgroup", type=int, metavar="<Minimum group size>",
-                              help="Ignore groups smaller than given size")
-arg_parser.add_argument("-od", "--outputdirectory", type=str, metavar="Output directory",
-                        help="Directory to receive outputs of grouped combines")
-
-# File disposition and other options
-arg_parser.add_argument("-v", "--moveinputs", metavar="<directory>",
-                        help="After successful processing, move input files to directory")
-arg_parser.add_argument("-t", "--ignoretype", action="store_true",
-                        help="Ignore the internal FITS file type (flat, dark, bias, etc)")
-arg_parser.add_argument("-o", "--output", metavar="<output path>",
-                        help="Name of output file (default: constructed name at location of inputs)")
-
-arg_parser.add_argument("filenames", nargs="*")
-args = arg_parser.parse_args()
-
-preferences: Preferences = Preferences()
-data_model: DataModel = DataModel(preferences)
-
-# If no arguments were given, or if the --gui argument was given, open the GUI window
-if len(sys.argv) == 1 or args.gui:
-    app = QtWidgets.QApplication(sys.argv)
-    window = MainWindow(preferences, data_model)
-    window.set_up_ui()
-    window.ui.show()
-    app.exec_()
-else:
-    # We're operating in pure command-line mode
-    command_line_handler = CommandLineHandler(args, data_model)
-    command_line_handler.execute()
+arg_parser = CommandLineArguments.make_parser()
+
+# Worker processes (used to combine groups in parallel) import this module too; only the
+# main program should parse the arguments and run
+if __name__ == "__main__":
+    # Needed for worker processes when running as a packaged (frozen) application
+    multiprocessing.freeze_support()
+
+    args = arg_parser.parse_args()
+
+    # If no arguments were given, or if the --gui argument was given, open the GUI window
+    if len(sys.argv) == 1 or args.gui:
+        from PyQt5 import QtWidgets
+        from MainWindow import MainWindow
+
+        preferences: Preferences = Preferences(use_qt=True)
+        data_model: DataModel = DataModel(preferences)
+        app = QtWidgets.QApplication(sys.argv)
+        window = MainWindow(preferences, data_model)
+        window.set_up_ui()
+        window.ui.show()
+        app.exec_()
+    elif args.daemon is not None:
+        # Stay running, combining files as jobs are submitted
+        from CombineDaemon import CombineDaemon
+        CombineDaemon(args, DataModel(Preferences()), args.batchjobs or 1).serve(args.daemon)
+    else:
+        # We're operating in pure command-line mode
+        data_model = DataModel(Preferences())
+        command_line_handler = CommandLineHandler(args, data_model)
+        command_line_handler.execute()
@@ -40,3 +40,15 @@ class TestException(Exception):
 
 class SessionCancelled(Exception):
     pass
+
+#
+#   A batch manifest can't be read, or describes its jobs wrongly
+#
+
+
+class InvalidManifest(Exception):
+    def __init__(self, message: str):
+        self._message = message
+
+    def get_message(self) -> str:
+        return self._message
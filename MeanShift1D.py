@@ -0,0 +1,139 @@
+#
+#   Mean shift clustering specialised for one-dimensional data, such as the temperatures of frames.
+#
+#   Finds the same clusters as the general mean_shift.MeanShift with its gaussian kernel: each point
+#   climbs to a peak of the kernel density estimate of all the points, stopping when a step is shorter
+#   than MIN_DISTANCE, and points that end up within GROUP_DISTANCE_TOLERANCE of each other form a cluster.
+#
+#   The general version shifts one point at a time in a Python loop and then compares every shifted
+#   point with every other, so it slows down with the square of the number of files.  Here:
+#       - points with the same value (common, since temperatures are reported to a fixed precision)
+#         are collapsed into one distinct value, weighted by its count, both as data for the kernel and
+#         as points to be shifted (they would follow identical paths), so the work depends on the number
+#         of distinct values rather than the number of files;
+#       - all the distinct values are shifted together, with array operations;
+#       - clusters are found by sorting the shifted points and splitting wherever neighbours are at least
+#         the tolerance apart.
+#   The general grouper puts a point that is near two existing groups into the later one, where this
+#   version joins the groups; as mean shift leaves points either on top of each other (same peak) or
+#   well apart (different peaks), the clusters are the same in practice.
+#
+#   Temperatures that are not quantized (every file different) can be binned first: values are rounded
+#   to the nearest multiple of a given bin width, which should be small compared with the bandwidth.
+#
+import numpy
+from numpy.core.multiarray import ndarray
+
+import mean_shift as ms
+
+
+class MeanShift1D:
+
+    # Distinct starting values are shifted in chunks, so the matrix of kernel weights
+    # (starting values by points) doesn't exceed this many elements
+    MAXIMUM_CHUNK_ELEMENTS = 256 * 1024
+
+    def cluster(self, points: ndarray, kernel_bandwidth: float, bin_width: float = 0.0) -> ms.MeanShiftResult:
+        """
+        Cluster the given one-dimensional points
+        :param points:              Values to be clustered, as a vector or a single-column matrix
+        :param kernel_bandwidth:    Bandwidth (standard deviation) of the gaussian kernel
+        :param bin_width:           If not zero, round the values to multiples of this before clustering
+        :return:                    Result with the shifted points and a cluster id for each point,
+                                    ids numbered in order of each cluster's first point
+        """
+        assert kernel_bandwidth > 0
+        assert bin_width >= 0
+        values = numpy.asarray(points, dtype=numpy.float64).reshape(-1)
+        if len(values) == 0:
+            return ms.MeanShiftResult(points, numpy.array(points, dtype=numpy.float64),
+                                      numpy.zeros(0, dtype=int))
+        if bin_width > 0:
+            values = numpy.round(values / bin_width) * bin_width
+        (distinct_values, distinct_index, counts) = numpy.unique(values, return_inverse=True, return_counts=True)
+        peaks = self.cluster_weighted(distinct_values, counts, kernel_bandwidth)
+        shifted_values = peaks[distinct_index.reshape(-1)]
+        cluster_ids = self.group_shifted_values(shifted_values)
+        return ms.MeanShiftResult(points, shifted_values.reshape(numpy.shape(points)), cluster_ids)
+
+    def cluster_weighted(self, values: ndarray, weights: ndarray, kernel_bandwidth: float) -> ndarray:
+        """
+        Shift weighted values to the peaks of their kernel density estimate.  A value with weight w
+        counts as w points with that value.
+        :param values:              Distinct values to be clustered
+        :param weights:             Weight (e.g. number of occurrences) of each value
+        :param kernel_bandwidth:    Bandwidth (standard deviation) of the gaussian kernel
+        :return:                    Final position of each value; values with positions less than
+                                    GROUP_DISTANCE_TOLERANCE apart are in the same cluster
+        """
+        assert len(values) == len(weights)
+        data = numpy.asarray(values, dtype=numpy.float64)
+        return self.shift_to_peaks(data, data, numpy.asarray(weights, dtype=numpy.float64), kernel_bandwidth)
+
+    def shift_to_peaks(self, starting_values: ndarray, data: ndarray, data_weights: ndarray,
+                       kernel_bandwidth: float) -> ndarray:
+        """
+        Shift each of the starting values repeatedly, towards the weighted mean of the data around it,
+        until it stops moving.  A value is no longer shifted once a step is shorter than MIN_DISTANCE;
+        shifting stops when no value moved further than that in the last round.
+        :param starting_values:     Values to be shifted
+        :param data:                Distinct values of the points, defining the density whose peaks are sought
+        :param data_weights:        Weight of each data value
+        :param kernel_bandwidth:    Bandwidth of the gaussian kernel
+        :return:                    Final positions of the starting values
+        """
+        positions = numpy.array(starting_values, dtype=numpy.float64)
+        still_shifting = numpy.ones(len(positions), dtype=bool)
+        longest_step = numpy.inf
+        while longest_step > ms.MIN_DISTANCE:
+            active = numpy.flatnonzero(still_shifting)
+            new_positions = self.shift_positions(positions[active], data, data_weights, kernel_bandwidth)
+            steps = numpy.abs(new_positions - positions[active])
+            positions[active] = new_positions
+            still_shifting[active[steps < ms.MIN_DISTANCE]] = False
+            longest_step = steps.max()
+        return positions
+
+    def shift_positions(self, positions: ndarray, data: ndarray, data_weights: ndarray,
+                        kernel_bandwidth: float) -> ndarray:
+        """
+        Move each position to the mean of the data, weighted by the data weights and by the gaussian
+        kernel centred on the position.
+        The kernel's normalizing constant cancels out of the weighted mean, so it isn't calculated.
+        :param positions:           Current positions
+        :param data:                Distinct values of the points
+        :param data_weights:        Weight of each data value
+        :param kernel_bandwidth:    Bandwidth of the gaussian kernel
+        :return:                    New positions
+        """
+        result = numpy.empty_like(positions)
+        weighted_data = data * data_weights
+        chunk_size = max(1, self.MAXIMUM_CHUNK_ELEMENTS // len(data))
+        for start in range(0, len(positions), chunk_size):
+            chunk = positions[start:start + chunk_size]
+            weights = (chunk[:, numpy.newaxis] - data[numpy.newaxis, :]) / kernel_bandwidth
+            numpy.square(weights, out=weights)
+            weights *= -0.5
+            numpy.exp(weights, out=weights)
+            result[start:start + chunk_size] = numpy.dot(weights, weighted_data) / numpy.dot(weights, data_weights)
+        return result
+
+    @classmethod
+    def group_shifted_values(cls, shifted_values: ndarray) -> ndarray:
+        """
+        Assign cluster ids to shifted values: sorted, a new cluster starts wherever the gap to the
+        previous value is at least GROUP_DISTANCE_TOLERANCE.  Ids are then renumbered so they count up
+        in order of each cluster's first appearance, as the general grouper numbers them.
+        :param shifted_values:  Final positions of all the points
+        :return:                Cluster id of each point
+        """
+        order = numpy.argsort(shifted_values, kind="stable")
+        new_cluster = numpy.diff(shifted_values[order]) >= ms.GROUP_DISTANCE_TOLERANCE
+        sorted_ids = numpy.concatenate(([0], numpy.cumsum(new_cluster)))
+        cluster_ids = numpy.empty(len(shifted_values), dtype=int)
+        cluster_ids[order] = sorted_ids
+        # Renumber by first appearance
+        (_, first_index) = numpy.unique(cluster_ids, return_index=True)
+        renumbering = numpy.empty(len(first_index), dtype=int)
+        renumbering[numpy.argsort(first_index)] = numpy.arange(len(first_index))
+        return renumbering[cluster_ids]
@@ -2,9 +2,11 @@
 # Helps locate resource files, end-running around the problems I've been having
 # with the various native bundle packaging utilities that I can't get working
 import os
+import sys
 
 
 class MultiOsUtil:
+    APPLICATION_DIRECTORY_NAME = "MasterBiasMaker"
 
     # Generate a file's full path, given the file name, and having the
     # file reside in the same directory where the running program resides
@@ -21,3 +23,86 @@ class MultiOsUtil:
         path_to_file = f"{directory_name}/{file_name}"
         return path_to_file
 
+
+    # Determine how much physical memory is available, so work can be sized to fit.
+    # Each operating system has its own way of telling us.
+
+    @classmethod
+    def available_memory_bytes(cls) -> int:
+        """
+        Estimate the physical memory currently available to the program
+        :return:    Number of bytes available (total memory, or a conservative guess, if unknown)
+        """
+        if sys.platform.startswith("win"):
+            import ctypes
+
+            class MemoryStatus(ctypes.Structure):
+                _fields_ = [("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong),
+                            ("ullTotalPhys", ctypes.c_ulonglong), ("ullAvailPhys", ctypes.c_ulonglong),
+                            ("ullTotalPageFile", ctypes.c_ulonglong), ("ullAvailPageFile", ctypes.c_ulonglong),
+                            ("ullTotalVirtual", ctypes.c_ulonglong), ("ullAvailVirtual", ctypes.c_ulonglong),
+                            ("ullAvailExtendedVirtual", ctypes.c_ulonglong)]
+            status = MemoryStatus()
+            status.dwLength = ctypes.sizeof(MemoryStatus)
+            if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+                return int(status.ullAvailPhys)
+        else:
+            page_size = os.sysconf("SC_PAGE_SIZE")
+            try:
+                return os.sysconf("SC_AVPHYS_PAGES") * page_size
+            except (ValueError, OSError):
+                # Not available on macOS; assume half of physical memory is free
+                try:
+                    return os.sysconf("SC_PHYS_PAGES") * page_size // 2
+                except (ValueError, OSError):
+                    pass
+        return 2 * 1024 * 1024 * 1024
+
+    # Determine the most physical memory this process has occupied so far (its peak resident set size)
+
+    @classmethod
+    def peak_memory_bytes(cls) -> int:
+        """
+        Get the peak resident memory of this process since it started
+        :return:    Number of bytes, or 0 if the operating system doesn't tell us
+        """
+        if sys.platform.startswith("win"):
+            import ctypes
+            from ctypes import wintypes
+
+            class ProcessMemoryCounters(ctypes.Structure):
+                _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                            ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                            ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                            ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                            ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                            ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+            counters = ProcessMemoryCounters()
+            counters.cb = ctypes.sizeof(ProcessMemoryCounters)
+            if ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),
+                                                        ctypes.byref(counters), counters.cb):
+                return int(counters.PeakWorkingSetSize)
+            return 0
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Reported in bytes on macOS, kilobytes elsewhere
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    # Locate the per-user directory where the program can keep its own files (e.g. caches),
+    # following each operating system's convention.  The directory is created if necessary.
+
+    @classmethod
+    def user_data_directory(cls) -> str:
+        """
+        Determine, and create if necessary, the directory where this program keeps per-user data files
+        :return:    Absolute path of the directory
+        """
+        if sys.platform == "darwin":
+            base_directory = os.path.expanduser("~/Library/Application Support")
+        elif sys.platform.startswith("win"):
+            base_directory = os.environ.get("APPDATA", os.path.expanduser("~"))
+        else:
+            base_directory = os.environ.get("XDG_CONFIG_HOME", os.path.expanduser("~/.config"))
+        directory = os.path.join(base_directory, cls.APPLICATION_DIRECTORY_NAME)
+        os.makedirs(directory, exist_ok=True)
+        return directory
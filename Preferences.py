@@ -1,9 +1,22 @@
-from PyQt5.QtCore import QSettings, QSize, QPoint
+#
+#   Preferences permanently store default settings for future sessions.  With the GUI they are kept
+#   with Qt's QSettings; command-line runs read the same stored values through HeadlessSettings,
+#   so Qt is never loaded.
+#
+from typing import TYPE_CHECKING
 
 from Constants import Constants
+from HeadlessSettings import HeadlessSettings
 
+if TYPE_CHECKING:
+    from PyQt5.QtCore import QSize, QPoint
+
+
+class Preferences:
+    # Names under which the preferences are stored
+    ORGANIZATION_NAME = "EarwigHavenObservatory.com"
+    APPLICATION_NAME = "MasterBiasMaker_b"
 
-class Preferences(QSettings):
     # The following are the preferences available
 
     # How should frames be combined?  Stored as an integer corresponding to one of
@@ -41,13 +54,71 @@ class Preferences(QSettings):
     # How much, as a percentage, can temperatures vary before being considered a different group?
     TEMPERATURE_GROUP_BANDWIDTH = "temperature_group_bandwidth"
 
+    # Width of bins temperatures are rounded into before clustering (zero for no binning)
+    TEMPERATURE_BIN_WIDTH = "temperature_bin_width"
+
     # Should we ignore small groups (probably haven't finished collecting them yet)?  How small
     IGNORE_GROUPS_FEWER_THAN = "ignore_groups_fewer_than"
     MINIMUM_GROUP_SIZE = "minimum_group_size"
 
-    def __init__(self):
-        QSettings.__init__(self, "EarwigHavenObservatory.com", "MasterBiasMaker_b")
-        # print(f"Preferences file path: {self.fileName()}")
+    # How much memory, in megabytes, may the image stack occupy while being combined?
+    MEMORY_BUDGET_MB = "memory_budget_mb"
+
+    # How many files are read concurrently?  Zero means choose automatically.
+    READER_WORKERS = "reader_workers"
+
+    # How many groups are combined at once, in separate processes?  Zero means choose automatically.
+    GROUP_WORKERS = "group_workers"
+
+    # Should file descriptions be kept in a cache so unchanged files needn't have their headers re-read?
+    USE_DESCRIPTOR_CACHE = "use_descriptor_cache"
+
+    # Should a summary of time and memory used by each stage of the work be shown after a session?
+    SHOW_STAGE_TIMES = "show_stage_times"
+
+    # How is min-max clipping computed?  One of the MIN_MAX_ENGINE_xxx constants in the Constants class
+    MIN_MAX_ENGINE = "min_max_engine"
+
+    # Are frames combined one at a time into running sums (where the method allows), or as a whole
+    # stack in bands?  And how are the running sums kept?  Constants COMBINE_ENGINE_xxx and SUMMATION_xxx
+    COMBINE_ENGINE = "combine_engine"
+    SUMMATION = "summation"
+
+    # What floating point precision is the combination math done in?  Constants PRECISION_xxx
+    PRECISION = "precision"
+
+    # How are the master's pixel values stored?  Constants OUTPUT_FORMAT_xxx
+    OUTPUT_FORMAT = "output_format"
+
+    def __init__(self, use_qt: bool = False):
+        """
+        Open the stored preferences
+        :param use_qt:  Store through Qt's QSettings (for the GUI), rather than the Qt-free reader
+        """
+        if use_qt:
+            from PyQt5.QtCore import QSettings
+            self._settings = QSettings(self.ORGANIZATION_NAME, self.APPLICATION_NAME)
+            # print(f"Preferences file path: {self._settings.fileName()}")
+        else:
+            self._settings = HeadlessSettings(self.ORGANIZATION_NAME, self.APPLICATION_NAME)
+
+    # Access to the stored values, with the QSettings method names the getters and setters use
+
+    def value(self, key: str, defaultValue=None):
+        return self._settings.value(key, defaultValue=defaultValue)
+
+    def setValue(self, key: str, value):
+        self._settings.setValue(key, value)
+
+    def bool_value(self, key: str, defaultValue: bool) -> bool:
+        """
+        Get a stored boolean.  QSettings, with its INI file and registry formats, gives a saved boolean
+        back as the string "true" or "false", so that is decoded as HeadlessSettings does.
+        """
+        value = self.value(key, defaultValue=defaultValue)
+        if isinstance(value, str):
+            return HeadlessSettings.decode_string(value) is True
+        return bool(value)
 
     # Getters and setters for preferences values
 
@@ -113,34 +184,34 @@ class Preferences(QSettings):
 
     # Main window size when resized
 
-    def get_main_window_size(self) -> QSize:
+    def get_main_window_size(self) -> "QSize":
         return self.value(self.MAIN_WINDOW_SIZE, defaultValue=None)
 
-    def set_main_window_size(self, size: QSize):
+    def set_main_window_size(self, size: "QSize"):
         self.setValue(self.MAIN_WINDOW_SIZE, size)
 
     # Main window position when moved
 
-    def get_main_window_position(self) -> QPoint:
+    def get_main_window_position(self) -> "QPoint":
         return self.value(self.MAIN_WINDOW_POSITION, defaultValue=None)
 
-    def set_main_window_position(self, position: QPoint):
+    def set_main_window_position(self, position: "QPoint"):
         self.setValue(self.MAIN_WINDOW_POSITION, position)
 
     # Console window size when resized
 
-    def get_console_window_size(self) -> QSize:
+    def get_console_window_size(self) -> "QSize":
         return self.value(self.CONSOLE_WINDOW_SIZE, defaultValue=None)
 
-    def set_console_window_size(self, size: QSize):
+    def set_console_window_size(self, size: "QSize"):
         self.setValue(self.CONSOLE_WINDOW_SIZE, size)
 
     # Console window position when moved
 
-    def get_console_window_position(self) -> QPoint:
+    def get_console_window_position(self) -> "QPoint":
         return self.value(self.CONSOLE_WINDOW_POSITION, defaultValue=None)
 
-    def set_console_window_position(self, position: QPoint):
+    def set_console_window_position(self, position: "QPoint"):
         self.setValue(self.CONSOLE_WINDOW_POSITION, position)
 
     # Are we processing multiple file sets at once using grouping?
@@ -168,6 +239,17 @@ class Preferences(QSettings):
         assert 0.1 <= bandwidth <= 50
         self.setValue(self.TEMPERATURE_GROUP_BANDWIDTH, bandwidth)
 
+    # Width of bins temperatures are rounded into before clustering (zero for no binning)
+
+    def get_temperature_bin_width(self) -> float:
+        result = float(self.value(self.TEMPERATURE_BIN_WIDTH, defaultValue=Constants.DEFAULT_TEMPERATURE_BIN_WIDTH))
+        assert 0 <= result <= 50
+        return result
+
+    def set_temperature_bin_width(self, value: float):
+        assert 0 <= value <= 50
+        self.setValue(self.TEMPERATURE_BIN_WIDTH, value)
+
     # Should we ignore small groups (probably haven't finished collecting them yet)?  How small?
 
     def get_ignore_groups_fewer_than(self) -> bool:
@@ -181,3 +263,107 @@ class Preferences(QSettings):
 
     def set_minimum_group_size(self, value: int):
         self.setValue(self.MINIMUM_GROUP_SIZE, value)
+
+    # How much memory, in megabytes, may the image stack occupy while being combined?
+
+    def get_memory_budget_mb(self) -> int:
+        result = int(self.value(self.MEMORY_BUDGET_MB, defaultValue=Constants.DEFAULT_MEMORY_BUDGET_MB))
+        assert result > 0
+        return result
+
+    def set_memory_budget_mb(self, value: int):
+        assert value > 0
+        self.setValue(self.MEMORY_BUDGET_MB, value)
+
+    # How many files are read concurrently?  Zero means choose automatically.
+
+    def get_reader_workers(self) -> int:
+        result = int(self.value(self.READER_WORKERS, defaultValue=Constants.DEFAULT_READER_WORKERS))
+        assert result >= 0
+        return result
+
+    def set_reader_workers(self, value: int):
+        assert value >= 0
+        self.setValue(self.READER_WORKERS, value)
+
+    # How many groups are combined at once, in separate processes?  Zero means choose automatically.
+
+    def get_group_workers(self) -> int:
+        result = int(self.value(self.GROUP_WORKERS, defaultValue=Constants.DEFAULT_GROUP_WORKERS))
+        assert result >= 0
+        return result
+
+    def set_group_workers(self, value: int):
+        assert value >= 0
+        self.setValue(self.GROUP_WORKERS, value)
+
+    # Should file descriptions be kept in a cache so unchanged files needn't have their headers re-read?
+
+    def get_use_descriptor_cache(self) -> bool:
+        return self.bool_value(self.USE_DESCRIPTOR_CACHE, defaultValue=True)
+
+    def set_use_descriptor_cache(self, use_cache: bool):
+        self.setValue(self.USE_DESCRIPTOR_CACHE, use_cache)
+
+    # Should a summary of time and memory used by each stage of the work be shown after a session?
+
+    def get_show_stage_times(self) -> bool:
+        return self.bool_value(self.SHOW_STAGE_TIMES, defaultValue=False)
+
+    def set_show_stage_times(self, show: bool):
+        self.setValue(self.SHOW_STAGE_TIMES, show)
+
+    # How is min-max clipping computed?
+
+    def get_min_max_engine(self) -> int:
+        result = int(self.value(self.MIN_MAX_ENGINE, defaultValue=Constants.MIN_MAX_ENGINE_MASKED))
+        assert result == Constants.MIN_MAX_ENGINE_PARTITION or result == Constants.MIN_MAX_ENGINE_MASKED
+        return result
+
+    def set_min_max_engine(self, value: int):
+        assert value == Constants.MIN_MAX_ENGINE_PARTITION or value == Constants.MIN_MAX_ENGINE_MASKED
+        self.setValue(self.MIN_MAX_ENGINE, value)
+
+    # Are frames combined one at a time into running sums (where the method allows), or as a whole stack?
+
+    def get_combine_engine(self) -> int:
+        result = int(self.value(self.COMBINE_ENGINE, defaultValue=Constants.COMBINE_ENGINE_TILED))
+        assert result == Constants.COMBINE_ENGINE_STREAMING or result == Constants.COMBINE_ENGINE_TILED
+        return result
+
+    def set_combine_engine(self, value: int):
+        assert value == Constants.COMBINE_ENGINE_STREAMING or value == Constants.COMBINE_ENGINE_TILED
+        self.setValue(self.COMBINE_ENGINE, value)
+
+    # How are the running sums of the streaming engine kept?
+
+    def get_summation(self) -> int:
+        result = int(self.value(self.SUMMATION, defaultValue=Constants.SUMMATION_SIMPLE))
+        assert result in (Constants.SUMMATION_SIMPLE, Constants.SUMMATION_COMPENSATED, Constants.SUMMATION_PAIRWISE)
+        return result
+
+    def set_summation(self, value: int):
+        assert value in (Constants.SUMMATION_SIMPLE, Constants.SUMMATION_COMPENSATED, Constants.SUMMATION_PAIRWISE)
+        self.setValue(self.SUMMATION, value)
+
+    # What floating point precision is the combination math done in?
+
+    def get_precision(self) -> int:
+        result = int(self.value(self.PRECISION, defaultValue=Constants.PRECISION_DOUBLE))
+        assert result == Constants.PRECISION_DOUBLE or result == Constants.PRECISION_SINGLE
+        return result
+
+    def set_precision(self, value: int):
+        assert value == Constants.PRECISION_DOUBLE or value == Constants.PRECISION_SINGLE
+        self.setValue(self.PRECISION, value)
+
+    # How are the master's pixel values stored?
+
+    def get_output_format(self) -> int:
+        result = int(self.value(self.OUTPUT_FORMAT, defaultValue=Constants.OUTPUT_FORMAT_SIGNED_16))
+        assert result == Constants.OUTPUT_FORMAT_SIGNED_16 or result == Constants.OUTPUT_FORMAT_UNSIGNED_16
+        return result
+
+    def set_output_format(self, value: int):
+        assert value == Constants.OUTPUT_FORMAT_SIGNED_16 or value == Constants.OUTPUT_FORMAT_UNSIGNED_16
+        self.setValue(self.OUTPUT_FORMAT, value)
@@ -0,0 +1,138 @@
+#
+#   Pool of worker threads used to read many files concurrently.
+#
+#   Reading files one at a time leaves fast storage (NVMe, network file systems) mostly idle,
+#   since there is only ever one request outstanding.  This pool keeps several reads in flight
+#   at once.  The number of reads in flight is bounded, so that if the results are large (e.g. image
+#   data) memory use is limited, and results are always delivered in the same order as the inputs.
+#
+#   Reading is I/O-bound, and numpy and the file system calls release the interpreter lock while
+#   they work, so threads (rather than processes) are sufficient and avoid any copying of results.
+#
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Iterable, Iterator, Optional
+
+import MasterMakerExceptions
+from SessionController import SessionController
+
+
+class ReaderPool:
+
+    # Upper limit when the number of workers is chosen automatically
+    MAXIMUM_AUTOMATIC_WORKERS = 8
+
+    # Name of the pools' threads, by which code can tell it is running in one
+    THREAD_NAME_PREFIX = "ReaderPool"
+
+    def __init__(self, number_workers: int, maximum_in_flight: int = 0):
+        """
+        Initialize the pool
+        :param number_workers:      Number of concurrent reader threads; 0 to choose automatically
+        :param maximum_in_flight:   Most items started but not yet delivered; 0 for twice the workers
+        """
+        assert number_workers >= 0
+        assert maximum_in_flight >= 0
+        self._number_workers = number_workers if number_workers > 0 else self.automatic_worker_count()
+        self._maximum_in_flight = maximum_in_flight if maximum_in_flight > 0 else 2 * self._number_workers
+        self._maximum_in_flight = max(self._maximum_in_flight, self._number_workers)
+
+    @classmethod
+    def automatic_worker_count(cls) -> int:
+        """
+        Number of reader threads to use when the user hasn't specified one
+        """
+        return max(1, min(cls.MAXIMUM_AUTOMATIC_WORKERS, os.cpu_count() or 1))
+
+    @classmethod
+    def in_worker_thread(cls) -> bool:
+        """
+        Determine if the calling code is running in a reader pool's worker thread, where it should
+        not start more threads of its own (the pool already keeps the processors busy)
+        """
+        return threading.current_thread().name.startswith(cls.THREAD_NAME_PREFIX)
+
+    def get_number_workers(self) -> int:
+        return self._number_workers
+
+    def imap_in_order(self, function: Callable,
+                      items: Iterable,
+                      session_controller: Optional[SessionController] = None,
+                      progress_callback: Optional[Callable[[int, int], None]] = None) -> Iterator:
+        """
+        Apply the given function to each of the given items using the pool of threads, and
+        deliver the results, in input order, as they become available.
+        Exceptions thrown:
+            SessionCancelled    The session controller reports that we have been cancelled
+            (any exception)     Raised by the function, re-raised when its result would be delivered
+
+        :param function:            Function to be applied to each item
+        :param items:               Inputs to the function
+        :param session_controller:  Optional controller, checked for cancellation and given progress reports
+        :param progress_callback:   Optional function called with (items completed, total items)
+        :return:                    Iterator of results in the same order as the items
+        """
+        item_list = list(items)
+        total = len(item_list)
+        if self._number_workers == 1:
+            # No need for the thread machinery
+            for index, item in enumerate(item_list):
+                self.check_cancellation(session_controller)
+                result = function(item)
+                self.report_progress(index + 1, total, session_controller, progress_callback)
+                yield result
+            return
+
+        with ThreadPoolExecutor(max_workers=self._number_workers,
+                                thread_name_prefix=self.THREAD_NAME_PREFIX) as executor:
+            in_flight: deque = deque()
+            next_index = 0
+            completed = 0
+            try:
+                while completed < total:
+                    # Keep the pipeline full, up to the in-flight limit
+                    while next_index < total and len(in_flight) < self._maximum_in_flight:
+                        self.check_cancellation(session_controller)
+                        in_flight.append(executor.submit(function, item_list[next_index]))
+                        next_index += 1
+                    oldest: Future = in_flight.popleft()
+                    result = oldest.result()
+                    completed += 1
+                    self.report_progress(completed, total, session_controller, progress_callback)
+                    self.check_cancellation(session_controller)
+                    yield result
+            finally:
+                # If we are leaving early (cancellation, error, or the consumer stopped) don't start
+                # any more of the queued work
+                for future in in_flight:
+                    future.cancel()
+
+    def map_in_order(self, function: Callable,
+                     items: Iterable,
+                     session_controller: Optional[SessionController] = None,
+                     progress_callback: Optional[Callable[[int, int], None]] = None) -> list:
+        """
+        Apply the given function to each of the given items using the pool of threads,
+        and return a list of the results in input order.  See imap_in_order.
+        """
+        return list(self.imap_in_order(function, items, session_controller, progress_callback))
+
+    @classmethod
+    def report_progress(cls, completed: int, total: int,
+                        session_controller: Optional[SessionController],
+                        progress_callback: Optional[Callable[[int, int], None]]):
+        if session_controller is not None:
+            session_controller.set_progress(completed, total)
+        if progress_callback is not None:
+            progress_callback(completed, total)
+
+    @classmethod
+    def check_cancellation(cls, session_controller: Optional[SessionController]):
+        """
+        Check with parent task to see if we have been cancelled.  Raise exception if so.
+        :param session_controller:      Parent controller object, or None if not cancellable
+        """
+        if session_controller is not None and session_controller.thread_cancelled():
+            raise MasterMakerExceptions.SessionCancelled
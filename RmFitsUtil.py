@@ -1,11 +1,23 @@
+from typing import Callable, Optional
+
 from astropy.io import fits
 from numpy.core.multiarray import ndarray
 
+from DescriptorCache import DescriptorCache
 from FileDescriptor import FileDescriptor
+from FitsHeaderScanner import FitsHeaderScanner
+from FitsImageMap import FitsImageMap
+from FitsTileWriter import FitsTileWriter
+from Instrumentation import Instrumentation
+from ReaderPool import ReaderPool
+from SessionController import SessionController
 
 
 class RmFitsUtil:
 
+    # Number of rows of a combined image converted and written at a time
+    WRITE_TILE_ROWS = 256
+
     # Take a best guess at what kind of file this is.  Use FITS header if present, but if that
     # is not present, then guess from file name, looking for keywords such as Dark, Bias, Flat,
     # Lum, Light, or a common filter name.  Optional array of light keywords can be given.
@@ -57,62 +69,75 @@ class RmFitsUtil:
         y_size = 0
         exposure = 0.0
         temperature = 0.0
-        with fits.open(file_name) as file:
-            primary = file[0]
-            header = primary.header
-            # Image type
-            if 'PICTTYPE' in header:
-                # This keyword codes the file type directly
-                result = int(header['PICTTYPE'])
-            elif 'IMAGETYP' in header:
-                type_code = header['IMAGETYP'].upper()
-                if 'BIAS' in type_code:
-                    result = FileDescriptor.FILE_TYPE_BIAS
-                elif 'DARK' in type_code:
-                    result = FileDescriptor.FILE_TYPE_DARK
-                elif 'FLAT' in type_code:
-                    result = FileDescriptor.FILE_TYPE_FLAT
-                elif 'LIGHT' in type_code:
-                    result = FileDescriptor.FILE_TYPE_LIGHT
-                else:
-                    result = FileDescriptor.FILE_TYPE_UNKNOWN
+        header = cls.read_descriptor_keywords(file_name)
+        # Image type
+        if 'PICTTYPE' in header:
+            # This keyword codes the file type directly
+            result = int(header['PICTTYPE'])
+        elif 'IMAGETYP' in header:
+            type_code = header['IMAGETYP'].upper()
+            if 'BIAS' in type_code:
+                result = FileDescriptor.FILE_TYPE_BIAS
+            elif 'DARK' in type_code:
+                result = FileDescriptor.FILE_TYPE_DARK
+            elif 'FLAT' in type_code:
+                result = FileDescriptor.FILE_TYPE_FLAT
+            elif 'LIGHT' in type_code:
+                result = FileDescriptor.FILE_TYPE_LIGHT
+            else:
+                result = FileDescriptor.FILE_TYPE_UNKNOWN
+        else:
+            fn_upper = file_name.upper()
+            if 'BIAS' in fn_upper:
+                result = FileDescriptor.FILE_TYPE_BIAS
+            elif 'DARK' in fn_upper:
+                result = FileDescriptor.FILE_TYPE_DARK
+            elif 'FLAT' in fn_upper:
+                result = FileDescriptor.FILE_TYPE_FLAT
             else:
-                fn_upper = file_name.upper()
-                if 'BIAS' in fn_upper:
-                    result = FileDescriptor.FILE_TYPE_BIAS
-                elif 'DARK' in fn_upper:
-                    result = FileDescriptor.FILE_TYPE_DARK
-                elif 'FLAT' in fn_upper:
-                    result = FileDescriptor.FILE_TYPE_FLAT
-                else:
-                    result = FileDescriptor.FILE_TYPE_UNKNOWN
-                    for keyword in light_keywords:
-                        if keyword.upper() in fn_upper:
-                            result = FileDescriptor.FILE_TYPE_LIGHT
-            # Binning values
-            x_binning, y_binning, filter_name = 0, 0, ""
-            if "XBINNING" in header:
-                x_binning = header["XBINNING"]
-            if "YBINNING" in header:
-                y_binning = header["YBINNING"]
-            # Filter name
-            if "FILTER" in header:
-                filter_name = header["FILTER"]
-            # Dimensions
-            if "NAXIS" in header:
-                number_axes = header["NAXIS"]
-                assert number_axes == 2
-                x_size = header["NAXIS1"]
-                y_size = header["NAXIS2"]
-            # Exposure
-            if "EXPOSURE" in header:
-                exposure = header["EXPOSURE"]
-            elif "EXPTIME" in header:
-                exposure = header["EXPTIME"]
-            # Temperature
-            if "CCD-TEMP" in header:
-                temperature = header["CCD-TEMP"]
-            return result, x_size, y_size, x_binning, y_binning, filter_name, exposure, temperature
+                result = FileDescriptor.FILE_TYPE_UNKNOWN
+                for keyword in light_keywords:
+                    if keyword.upper() in fn_upper:
+                        result = FileDescriptor.FILE_TYPE_LIGHT
+        # Binning values
+        x_binning, y_binning, filter_name = 0, 0, ""
+        if "XBINNING" in header:
+            x_binning = header["XBINNING"]
+        if "YBINNING" in header:
+            y_binning = header["YBINNING"]
+        # Filter name
+        if "FILTER" in header:
+            filter_name = header["FILTER"]
+        # Dimensions
+        if "NAXIS" in header:
+            number_axes = header["NAXIS"]
+            assert number_axes == 2
+            x_size = header["NAXIS1"]
+            y_size = header["NAXIS2"]
+        # Exposure
+        if "EXPOSURE" in header:
+            exposure = header["EXPOSURE"]
+        elif "EXPTIME" in header:
+            exposure = header["EXPTIME"]
+        # Temperature
+        if "CCD-TEMP" in header:
+            temperature = header["CCD-TEMP"]
+        return result, x_size, y_size, x_binning, y_binning, filter_name, exposure, temperature
+
+    @classmethod
+    def read_descriptor_keywords(cls, file_name: str):
+        """
+        Get the header keywords needed to describe the given file (from the compressed image's header,
+        for a tile-compressed file).  We use the fast header-only scanner, and fall back to astropy only
+        if the scanner can't parse the header.
+        :param file_name:   Path to FITS file
+        :return:            Dictionary-like collection of keyword values (supports "in" and indexing)
+        """
+        try:
+            return FitsHeaderScanner.read_image_header(file_name)
+        except ValueError:
+            with fits.open(file_name) as hdul:
+                return hdul[FitsImageMap.image_hdu_index(hdul)].header
 
     @classmethod
     def create_combined_fits_file(cls, name: str,
@@ -123,10 +148,13 @@ class RmFitsUtil:
                                   temperature: float,
                                   filter_name: str,
                                   binning: int,
-                                  comment: str):
+                                  comment: str,
+                                  unsigned: bool = False):
         """Write a new FITS file with the given data and name.
         Create a FITS header in the file by copying the header from a given existing file
-        and adding a given comment"""
+        and adding a given comment.  The values are rounded to 16-bit integers, signed or unsigned.
+        The data is written a band of rows at a time, so no full-size integer copy is made, and the
+        file appears under its name only when it is complete."""
 
         #  Create header
         header = fits.Header()
@@ -140,15 +168,15 @@ class RmFitsUtil:
         header["PICTTYPE"] = file_type_code
         header["IMAGETYP"] = image_type_string
 
-        # Create primary HDU
-        data_16_bit = data.round().astype("i2")
-        primary_hdu = fits.PrimaryHDU(data_16_bit, header=header)
-
-        # Create HDUL
-        hdul = fits.HDUList([primary_hdu])
-
-        # Write to file
-        hdul.writeto(name, output_verify="fix", overwrite=True, checksum=True)
+        with Instrumentation.stage(Instrumentation.STAGE_FITS_WRITE):
+            writer = FitsTileWriter(name, data.shape, header, unsigned)
+            try:
+                for first_row in range(0, data.shape[0], cls.WRITE_TILE_ROWS):
+                    writer.write_tile(data[first_row:first_row + cls.WRITE_TILE_ROWS])
+                writer.finish()
+            except BaseException:
+                writer.abandon()
+                raise
 
     @classmethod
     def fits_file_type_string(cls, file_type):
@@ -168,40 +196,61 @@ class RmFitsUtil:
         else:
             return "UNKNOWN"
 
-    @classmethod
-    def read_all_files_data(cls, file_names: [str]) -> [ndarray]:
-        """
-        Read ndarray data arrays for all the given file names.
-        :param file_names:  List of file names
-        :return:            List of 2-dimensional matrices of pixel values
-        """
-        result_array: [ndarray] = []
-        for name in file_names:
-            result_array.append(cls.fits_data_from_path(name))
-        return result_array
+    # Size of the reads used to prefetch files
+    PREFETCH_CHUNK_BYTES = 1024 * 1024
 
     @classmethod
-    def fits_data_from_path(cls, file_name: str) -> ndarray:
+    def prefetch_files(cls, file_names: [str],
+                       reader_workers: int = 1,
+                       session_controller: Optional[SessionController] = None):
         """
-        Get the image data from a fits file for one file, given the file path
-        :param file_name:   Path to fits file to be read
-        :return:            Matrix of pixel values representing the image
+        Read the given files through, discarding the contents, so they are in the operating system's file
+        cache when they are next read.  Used to read one group of files while another is being combined.
+        Progress is not reported, since the prefetch runs alongside other work that reports it.
+        Exceptions thrown:
+            SessionCancelled    The session controller reports that we have been cancelled
+        :param file_names:          Paths of the files to be read
+        :param reader_workers:      Number of files to read concurrently (0 to choose automatically)
+        :param session_controller:  Optional controller for this subtask, checked for cancellation
         """
-        with fits.open(file_name) as hdul:
-            primary = hdul[0]
-            # Exposure and temperature
-            return primary.data.astype(float)
+        def read_through(file_name: str):
+            buffer = bytearray(cls.PREFETCH_CHUNK_BYTES)
+            with open(file_name, "rb", buffering=0) as file:
+                while file.readinto(buffer) > 0:
+                    ReaderPool.check_cancellation(session_controller)
+
+        reader_pool = ReaderPool(reader_workers)
+        for _ in reader_pool.imap_in_order(read_through, file_names):
+            ReaderPool.check_cancellation(session_controller)
 
     @classmethod
-    def make_file_descriptions(cls, file_names: [str]) -> [FileDescriptor]:
+    def make_file_descriptions(cls, file_names: [str],
+                               reader_workers: int = 1,
+                               session_controller: Optional[SessionController] = None,
+                               progress_callback: Optional[Callable[[int, int], None]] = None,
+                               cache: Optional[DescriptorCache] = None) -> [FileDescriptor]:
         """
         Make a list of file descriptors for the files in the given list of names
-        :param file_names:  List of names to be described
-        :return:            List of descriptors
+        :param file_names:          List of names to be described
+        :param reader_workers:      Number of files to read concurrently (0 to choose automatically)
+        :param session_controller:  Optional controller for this subtask, for cancellation and progress
+        :param progress_callback:   Optional function called with (files read, total files to be read)
+        :param cache:               Optional cache of previously-read descriptors
+        :return:                    List of descriptors, in the same order as the names
         """
-        result: [FileDescriptor] = []
-        for absolute_path in file_names:
-            descriptor = RmFitsUtil.make_file_descriptor(absolute_path)
-            result.append(descriptor)
-        return result
+        reader_pool = ReaderPool(reader_workers)
+        with Instrumentation.stage(Instrumentation.STAGE_HEADER_SCAN):
+            if cache is None:
+                return reader_pool.map_in_order(RmFitsUtil.make_file_descriptor, file_names,
+                                                session_controller, progress_callback)
+            # Get what we can from the cache, and read only the files that weren't there (or have changed)
+            cached_descriptors: {str: FileDescriptor} = cache.lookup_many(file_names)
+            names_to_read = [name for name in file_names if name not in cached_descriptors]
+            file_statuses = cache.file_statuses(names_to_read)
+            new_descriptors: [FileDescriptor] = reader_pool.map_in_order(RmFitsUtil.make_file_descriptor,
+                                                                         names_to_read,
+                                                                         session_controller, progress_callback)
+            cache.store_many(new_descriptors, file_statuses)
+            cached_descriptors.update(zip(names_to_read, new_descriptors))
+            return [cached_descriptors[name] for name in file_names]
 
@@ -1,29 +1,49 @@
 # Class with an instance shared by the main event controller and the session worker
 # Using mutex-lock, basic status such as "cancel the thread" can be set by the main controller
-# and safely read and responded to by the worker.
-from PyQt5.QtCore import QMutex
+# and safely read and responded to by the worker.  The lock is a plain threading lock, not Qt's,
+# so the command line runs without loading Qt.
+# A controller in a worker process can also be given a cancel event shared with the parent process.
+import threading
 
 
 class SessionController:
 
-    def __init__(self):
-        self._mutex = QMutex()
+    def __init__(self, cancel_event=None):
+        """
+        Initialize the controller
+        :param cancel_event:    Optional event (e.g. multiprocessing.Event) that also cancels when set
+        """
+        self._lock = threading.Lock()
+        self._cancel_event = cancel_event
         self._thread_ok_to_run = True
+        self._progress_completed = 0
+        self._progress_total = 0
 
     def cancel_thread(self):
         """Set flag to cancel the controlled thread"""
-        self._mutex.lock()
-        self._thread_ok_to_run = False
-        self._mutex.unlock()
+        with self._lock:
+            self._thread_ok_to_run = False
 
     def thread_running(self):
         """Indicate if the controlled thread is still running"""
-        self._mutex.lock()
-        result = self._thread_ok_to_run
-        self._mutex.unlock()
+        with self._lock:
+            result = self._thread_ok_to_run
+        if result and self._cancel_event is not None:
+            result = not self._cancel_event.is_set()
         return result
 
     def thread_cancelled(self):
         """Indicate if the controlled thread is cancelled"""
         return not self.thread_running()
 
+    def set_progress(self, completed: int, total: int):
+        """Record progress of the controlled thread through its current step"""
+        with self._lock:
+            self._progress_completed = completed
+            self._progress_total = total
+
+    def get_progress(self) -> (int, int):
+        """Get progress of the controlled thread: items completed and total items in current step"""
+        with self._lock:
+            result = (self._progress_completed, self._progress_total)
+        return result
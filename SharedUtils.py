@@ -6,15 +6,17 @@ import shutil
 import sys
 import glob
 from datetime import datetime
-
-from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QColor
-from PyQt5.QtWidgets import QWidget
+from typing import TYPE_CHECKING
 
 from Constants import Constants
 from FileDescriptor import FileDescriptor
 from Validators import Validators
 
+# Qt is only needed by the GUI's helpers here, so it is imported in them, not when the command line runs
+if TYPE_CHECKING:
+    from PyQt5.QtGui import QColor
+    from PyQt5.QtWidgets import QWidget
+
 
 class SharedUtils:
     VALID_FIELD_BACKGROUND_COLOUR = "white"
@@ -24,12 +26,14 @@ class SharedUtils:
     ERROR_FIELD_BACKGROUND_COLOUR = f"#{_error_red:02X}{_error_green:02X}{_error_blue:02X}"
 
     @classmethod
-    def valid_or_error_field_color(cls, validity: bool) -> QColor:
+    def valid_or_error_field_color(cls, validity: bool) -> "QColor":
         """
         Return a QT colour for a form field that is valid (white) or in error (light red)
         :param validity:    Flag if valid or not
         :return:            QColour for field
         """
+        from PyQt5.QtCore import Qt
+        from PyQt5.QtGui import QColor
         if validity:
             result = QColor(Qt.white)
         else:
@@ -41,7 +45,7 @@ class SharedUtils:
     #
 
     @classmethod
-    def background_validity_color(cls, field: QWidget, is_valid: bool):
+    def background_validity_color(cls, field: "QWidget", is_valid: bool):
         """
         set background colour of field if it has not passed validation
         :param field:       Field (QWidget) whose background to set
@@ -135,6 +139,24 @@ class SharedUtils:
         """
         return os.path.join(parent_path, sub_directory_name)
 
+    # Find a name for a new file that doesn't replace an existing file
+
+    @classmethod
+    def unused_file_path(cls, path: str) -> str:
+        """
+        Get a path for a new file that won't replace an existing one: the given path if nothing is there,
+        otherwise the path with "-2", "-3", etc. added before the extension
+        :param path:    Proposed path
+        :return:        Path where no file exists
+        """
+        (root, extension) = os.path.splitext(path)
+        result = path
+        suffix = 1
+        while os.path.exists(result):
+            suffix += 1
+            result = f"{root}-{suffix}{extension}"
+        return result
+
     # Make sure the given directory exists, as a directory.
     #   - No non-directory file of that name (fail if so)
     #   - If directory already exists as a directory, all good; succeed
@@ -284,17 +306,29 @@ class SharedUtils:
             percent_difference = difference / abs(first_value)
         return percent_difference <= tolerance
 
+    # File name extensions of FITS files: plain, gzip-compressed, and tile-compressed (fpack)
+    FITS_FILE_EXTENSIONS = (".fit", ".fits", ".fts", ".fit.gz", ".fits.gz", ".fts.gz", ".fz")
+
+    @classmethod
+    def is_fits_file_name(cls, name: str) -> bool:
+        """
+        Determine if a file name has one of the extensions of FITS files (case insensitive)
+        :param name:    File name or path
+        :return:        True if a FITS file
+        """
+        return name.lower().endswith(cls.FITS_FILE_EXTENSIONS)
+
     @classmethod
     def files_in_directory(cls, directory_path: str, recursive: bool) -> [str]:
         """
         Get list of all FITS file names in directory, optionally recursive into subdirectories
         :param directory_path:      Directory whose contents are to be listed
         :param recursive:           Should recursive descent be used?
-        :return:                    List of names of files ending in .FIT or .FITS (case insensitive)
+        :return:                    List of names of FITS files, by their extensions (see is_fits_file_name)
         """
         search_string = os.path.join(directory_path, "**")
         all_files = glob.glob(search_string, recursive=recursive)
-        result_list = (f for f in all_files if f.lower().endswith(".fit") or f.lower().endswith(".fits"))
+        result_list = (f for f in all_files if cls.is_fits_file_name(f))
         # contents = os.listdir(directory_path)
         # result_list: [str] = []
         # for entry in contents:
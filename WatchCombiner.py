@@ -0,0 +1,208 @@
+#
+#   Build master files incrementally from frames as they arrive in a watched directory.
+#
+#   Each arriving frame's header is read straight away, and the frame is added to a pending group of
+#   frames with the same size (dimensions and binning) and, if grouping by temperature, a similar
+#   temperature.  A group's master is made as soon as the group reaches the frame count, or once no
+#   frame has been added to it for the quiet time (e.g. the camera has finished taking biases for the
+#   night), so the master is ready minutes after its last frame.  Quiet groups smaller than the minimum
+#   group size, if one is set, are dropped without making a master.
+#
+#   Since frames arrive one at a time, temperature groups are formed as they come: a frame joins the group
+#   of its size whose mean temperature is nearest its own, if within the temperature bandwidth, otherwise
+#   it starts a new group.  (Batch runs cluster all the temperatures at once with mean shift instead.)
+#
+import time
+
+import MasterMakerExceptions
+from Console import Console
+from DataModel import DataModel
+from DirectoryWatcher import DirectoryWatcher
+from FileCombiner import FileCombiner
+from FileDescriptor import FileDescriptor
+from FitsImageMap import FitsImageMap
+from RmFitsUtil import RmFitsUtil
+from SessionController import SessionController
+from SharedUtils import SharedUtils
+
+
+class WatchCombiner:
+
+    # Longest time we wait for files before checking for quiet groups and cancellation
+    MAXIMUM_WAIT_SECONDS = 5.0
+
+    def __init__(self, data_model: DataModel,
+                 output_directory: str,
+                 frame_count: int,
+                 quiet_seconds: float,
+                 console: Console,
+                 session_controller: SessionController):
+        """
+        Initialize with no pending groups
+        :param data_model:          Data model giving the combination options
+        :param output_directory:    Directory to receive the master files
+        :param frame_count:         Make a group's master when it has this many frames (0 for no limit)
+        :param quiet_seconds:       Make a group's master when no frame has been added for this long
+        :param console:             Re-directable console output object
+        :param session_controller:  Controller through which watching can be stopped
+        """
+        assert frame_count >= 0
+        assert quiet_seconds > 0
+        self._data_model = data_model
+        self._output_directory = output_directory
+        self._frame_count = frame_count
+        self._quiet_seconds = quiet_seconds
+        self._console = console
+        self._session_controller = session_controller
+        # Masters of the same kind can be made within a minute, so would otherwise get the same name
+        self._file_combiner = FileCombiner(session_controller, lambda file_name: None, keep_existing_outputs=True)
+        # Pending groups, each a dictionary with the frames' size key, descriptors, and the time one was last added
+        self._groups: [{}] = []
+
+    def watch(self, watcher: DirectoryWatcher):
+        """
+        Add frames to groups as the watcher reports them, making masters as groups are ready,
+        until the session controller reports cancellation
+        :param watcher:     Watcher of the directory the frames arrive in
+        """
+        self._console.message(f"Watching for frames"
+                              f"{'' if watcher.is_using_inotify() else ' (polling the directory)'}", 0)
+        cache = self._data_model.get_descriptor_cache()
+        if cache is not None and cache.get_unavailable_message() is not None:
+            self._console.message(cache.get_unavailable_message(), 0)
+        while self._session_controller.thread_running():
+            file_names = watcher.wait_for_files(min(self.MAXIMUM_WAIT_SECONDS, self._quiet_seconds))
+            if len(file_names) > 0:
+                self.add_files(file_names)
+            self.make_ready_masters(time.monotonic())
+
+    def add_files(self, file_names: [str]):
+        """
+        Read the headers of newly arrived files, and add each bias frame to its group
+        :param file_names:  Paths of the files
+        """
+        try:
+            descriptors = RmFitsUtil.make_file_descriptions(file_names, self._data_model.get_reader_workers(),
+                                                            self._session_controller,
+                                                            cache=self._data_model.get_descriptor_cache())
+        except (OSError, ValueError, AssertionError) as exception:
+            # One unreadable file spoils the lot; add the others one at a time
+            if len(file_names) > 1:
+                for file_name in file_names:
+                    self.add_files([file_name])
+            else:
+                self._console.message(f"Ignoring {file_names[0]}: unable to read it ({exception})", 0)
+            return
+        now = time.monotonic()
+        for descriptor in descriptors:
+            if not self._data_model.get_ignore_file_type() \
+                    and descriptor.get_type() != FileDescriptor.FILE_TYPE_BIAS:
+                self._console.message(f"Ignoring {descriptor.get_name()}: not a bias frame", 0)
+                continue
+            if not self.is_data_complete(descriptor):
+                self._console.message(f"Ignoring {descriptor.get_name()}: "
+                                      f"file is shorter than its header declares", 0)
+                continue
+            group = self.find_group(descriptor)
+            if any(member.get_absolute_path() == descriptor.get_absolute_path()
+                   for member in group["descriptors"]):
+                continue  # Rewritten while waiting in its group
+            group["descriptors"].append(descriptor)
+            group["last_added"] = now
+            self._console.message(f"Added {descriptor.get_name()} to group of {len(group['descriptors'])} "
+                                  f"files {descriptor.get_size_key()}, "
+                                  f"mean temperature {self.mean_temperature(group):.1f}", 0)
+            if 0 < self._frame_count <= len(group["descriptors"]):
+                self._groups.remove(group)
+                self.make_master(group, f"reached {self._frame_count} frames")
+
+    @classmethod
+    def is_data_complete(cls, descriptor: FileDescriptor) -> bool:
+        """
+        Determine if a frame's file holds all its image data, so a truncated file (e.g. an interrupted copy),
+        whose header is readable, isn't put in a group only to spoil the group's master
+        :param descriptor:  Description of the frame
+        :return:            False if the data is incomplete or can't be examined
+        """
+        try:
+            return FitsImageMap(descriptor.get_absolute_path()).is_data_complete()
+        except (OSError, ValueError):
+            return False
+
+    def find_group(self, descriptor: FileDescriptor) -> {}:
+        """
+        Find the pending group the given frame belongs in, starting a new group if there is none
+        :param descriptor:  Description of the frame
+        :return:            The group
+        """
+        size_key = descriptor.get_size_key()
+        candidates = [group for group in self._groups if group["size_key"] == size_key]
+        if self._data_model.get_group_by_temperature():
+            bandwidth = self._data_model.get_temperature_group_bandwidth()
+            distances = [(abs(self.mean_temperature(group) - descriptor.get_temperature()), group)
+                         for group in candidates]
+            candidates = [group for (distance, group) in sorted(distances, key=lambda pair: pair[0])
+                          if distance <= bandwidth]
+        if len(candidates) > 0:
+            return candidates[0]
+        group = {"size_key": size_key, "descriptors": [], "last_added": time.monotonic()}
+        self._groups.append(group)
+        return group
+
+    @classmethod
+    def mean_temperature(cls, group: {}) -> float:
+        descriptors = group["descriptors"]
+        return sum(descriptor.get_temperature() for descriptor in descriptors) / max(1, len(descriptors))
+
+    def make_ready_masters(self, now: float):
+        """
+        Make masters from the groups that have been quiet long enough.  (Groups reaching the frame
+        count are made as the frame completing them is added.)
+        :param now:     Current time, from time.monotonic()
+        """
+        minimum_group_size = self._data_model.get_minimum_group_size() \
+            if self._data_model.get_ignore_groups_fewer_than() else 0
+        for group in list(self._groups):
+            number_frames = len(group["descriptors"])
+            if now - group["last_added"] >= self._quiet_seconds:
+                self._groups.remove(group)
+                if number_frames < minimum_group_size:
+                    self._console.message(f"Ignoring quiet group of {number_frames} files {group['size_key']}: "
+                                          f"fewer than {minimum_group_size}", 0)
+                else:
+                    self.make_master(group, f"no new frames for {self._quiet_seconds:g} seconds")
+
+    def make_master(self, group: {}, reason: str):
+        """
+        Combine a group's frames into a master file in the output directory
+        :param group:       The group
+        :param reason:      Why the master is being made now, for the console
+        """
+        descriptors: [FileDescriptor] = group["descriptors"]
+        self._console.message(f"Making master from {len(descriptors)} files {group['size_key']}: {reason}", 0)
+        disposition_folder = SharedUtils.substitute_date_time_filter_in_string(
+            self._data_model.get_disposition_subfolder_name())
+        # A failed group leaves the console indented where it stopped; failures are reported at this level
+        message_level = self._console.get_message_level()
+        try:
+            self._file_combiner.process_one_group(self._data_model, descriptors, self._output_directory,
+                                                  self._data_model.get_master_combine_method(),
+                                                  disposition_folder, self._console)
+        except FileNotFoundError as exception:
+            self.report_failure(f"file \"{exception.filename}\" has gone", message_level)
+        except PermissionError as exception:
+            self.report_failure(f"unable to write \"{exception.filename}\"", message_level)
+        except MasterMakerExceptions.SessionCancelled:
+            raise
+        except Exception as exception:
+            # One bad group (e.g. a corrupt frame) mustn't stop the watch
+            self.report_failure(f"group failed with {type(exception).__name__}: {exception}", message_level)
+
+    def report_failure(self, reason: str, message_level: int):
+        """
+        Report on the console that a group's master was not made
+        :param reason:          Why not
+        :param message_level:   Console indentation level to report at
+        """
+        self._console.set_message_level(message_level)
+        self._console.message(f"Master not made: {reason}", 0)